@@ -0,0 +1,299 @@
+"""
+Micro benchmarks for the optimized model parts, runnable without the checkpoint.
+
+The models are instantiated with random weights from a small config derived from
+optimizedSD/v1-inference.yaml (benchmarks/configs/tiny-inference.yaml), so timings are only
+comparable between runs with the same config and device. Pass the real config to measure
+full-size layers on a GPU (the weights are still random, no checkpoint is loaded).
+
+    python benchmarks/bench.py --device cpu --out bench.json
+    python benchmarks/bench.py --device cuda --config optimizedSD/v1-inference.yaml --resolutions 512,768
+    python benchmarks/bench.py --out new.json --compare bench.json
+
+Benchmarks:
+    sampler     full sampling loop per sampler, reported per step
+    attention   one splitAttention.CrossAttention call at the highest latent resolution
+    offload     moving the unet halves and the VAE between cpu and GPU (cuda only)
+    decode      VAE decode of a latent batch
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from contextlib import contextmanager, redirect_stderr, redirect_stdout
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "optimizedSD"))
+
+from ldm.util import instantiate_from_config
+from pipeline import is_cuda, precision_scope
+from splitAttention import CrossAttention
+
+ALL_SAMPLERS = ["plms", "ddim", "euler", "euler_a", "heun", "dpm2", "dpm2_a", "lms"]
+
+
+def int_list(s):
+    return [int(v) for v in s.split(",") if v.strip()]
+
+
+def str_list(s):
+    return [v.strip() for v in s.split(",") if v.strip()]
+
+
+def sync(device):
+    if is_cuda(device):
+        torch.cuda.synchronize(device)
+
+
+@contextmanager
+def quiet(enabled=True):
+    if not enabled:
+        yield
+        return
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull), redirect_stderr(devnull):
+        yield
+
+
+def measure(fn, device, repeat, warmup=1):
+    """Runs fn warmup + repeat times and returns the wall times (s) of the timed runs."""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        sync(device)
+        tic = time.perf_counter()
+        fn()
+        sync(device)
+        times.append(time.perf_counter() - tic)
+    return times
+
+
+def make_record(bench, params, times, device, **extra):
+    t = np.array(times) * 1e3
+    record = {
+        "bench": bench,
+        "params": params,
+        "mean_ms": float(t.mean()),
+        "min_ms": float(t.min()),
+        "max_ms": float(t.max()),
+        "std_ms": float(t.std()),
+        "repeat": len(times),
+    }
+    if is_cuda(device):
+        record["peak_mem_mb"] = torch.cuda.max_memory_allocated(device) / 1e6
+    record.update(extra)
+    return record
+
+
+def record_key(record):
+    return record["bench"] + "|" + json.dumps(record["params"], sort_keys=True)
+
+
+def load_models(config, device, precision):
+    config = OmegaConf.load(config)
+    torch.manual_seed(0)
+
+    model = instantiate_from_config(config.modelUNet).eval()
+    model.cdevice = device
+    model.turbo = True
+    model.resident = True
+    model.to(device)
+
+    modelCS = instantiate_from_config(config.modelCondStage).eval()
+    modelCS.cond_stage_model.device = device
+    modelCS.to(device)
+
+    modelFS = instantiate_from_config(config.modelFirstStage).eval()
+    modelFS.to(device)
+
+    if precision == "autocast" and is_cuda(device):
+        model.half()
+        modelCS.half()
+    return model, modelCS, modelFS, config
+
+
+def bench_sampler(opt, model, modelCS, b, H, W, sampler):
+    with torch.no_grad(), precision_scope(opt.device, opt.precision):
+        c = modelCS.get_learned_conditioning(b * ["a painting of a virus monster playing guitar"])
+        uc = modelCS.get_learned_conditioning(b * [""])
+    shape = [b, opt.C, H // opt.f, W // opt.f]
+
+    def run():
+        with torch.no_grad(), precision_scope(opt.device, opt.precision), quiet(not opt.verbose):
+            model.make_schedule(ddim_num_steps=opt.steps, ddim_eta=0.0, verbose=False)
+            model.sample(S=opt.steps, conditioning=c, seed=opt.seed, shape=shape, verbose=False,
+                         unconditional_guidance_scale=opt.scale, unconditional_conditioning=uc,
+                         eta=0.0, sampler=sampler)
+
+    times = measure(run, opt.device, opt.repeat, opt.warmup)
+    params = {"sampler": sampler, "batch": b, "H": H, "W": W, "steps": opt.steps}
+    return make_record("sampler", params, times, opt.device,
+                       per_step_ms=float(np.mean(times)) * 1e3 / opt.steps)
+
+
+def bench_attention(opt, unet_config, b, H, W, att_step):
+    p = unet_config.params
+    heads = p.num_heads
+    dim = p.model_channels
+    # classifier free guidance runs the conditional and unconditional batch together
+    n = 2 * b
+    if (n * heads) % att_step != 0:
+        return None
+    attn = CrossAttention(dim, context_dim=p.context_dim, heads=heads, dim_head=dim // heads, att_step=att_step)
+    attn = attn.eval().to(opt.device)
+    x = torch.randn(n, (H // opt.f) * (W // opt.f), dim, device=opt.device)
+    context = torch.randn(n, 77, p.context_dim, device=opt.device)
+
+    def run():
+        with torch.no_grad(), precision_scope(opt.device, opt.precision):
+            attn(x, context)
+
+    times = measure(run, opt.device, opt.repeat, opt.warmup)
+    params = {"batch": b, "H": H, "W": W, "att_step": att_step, "tokens": x.shape[1]}
+    return make_record("attention", params, times, opt.device)
+
+
+def bench_offload(opt, name, modules):
+    size = sum(p.numel() * p.element_size() for m in modules for p in m.parameters()) / 1e6
+
+    def run():
+        for m in modules:
+            m.to("cpu")
+        sync(opt.device)
+        for m in modules:
+            m.to(opt.device)
+
+    times = measure(run, opt.device, opt.repeat, opt.warmup)
+    return make_record("offload", {"module": name}, times, opt.device,
+                       size_mb=size, gb_per_s=2 * size / 1e3 / float(np.mean(times)))
+
+
+def bench_decode(opt, modelFS, b, H, W):
+    z = torch.randn(b, opt.C, H // opt.f, W // opt.f, device=opt.device)
+
+    def run():
+        with torch.no_grad(), precision_scope(opt.device, opt.precision):
+            modelFS.decode_first_stage(z)
+
+    times = measure(run, opt.device, opt.repeat, opt.warmup)
+    return make_record("decode", {"batch": b, "H": H, "W": W}, times, opt.device)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(results, path, threshold):
+    """Prints the change against an older result file, returns the number of regressions."""
+    with open(path, "r") as f:
+        old = {record_key(r): r for r in json.load(f)["results"]}
+    regressions = 0
+    for r in results:
+        prev = old.get(record_key(r))
+        if prev is None:
+            continue
+        change = r["mean_ms"] / prev["mean_ms"] - 1
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{record_key(r)}: {prev['mean_ms']:.2f} -> {r['mean_ms']:.2f} ms ({100 * change:+.1f}%){flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmarks for the optimized model parts")
+    parser.add_argument("--config", type=str, default=os.path.join(ROOT, "benchmarks/configs/tiny-inference.yaml"))
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--precision", type=str, choices=["full", "autocast"], default="autocast")
+    parser.add_argument("--benchmarks", type=str_list, default=["sampler", "attention", "offload", "decode"])
+    parser.add_argument("--samplers", type=str_list, default=ALL_SAMPLERS)
+    parser.add_argument("--batch_sizes", type=int_list, default=[1, 2])
+    parser.add_argument("--resolutions", type=int_list, default=[256, 512], help="square image sizes in pixels")
+    parser.add_argument("--att_steps", type=int_list, default=[1, 4], help="CrossAttention.att_step values")
+    parser.add_argument("--steps", type=int, default=10, help="sampling steps per sampler run")
+    parser.add_argument("--scale", type=float, default=7.5)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--C", type=int, default=4, help="latent channels")
+    parser.add_argument("--f", type=int, default=8, help="downsampling factor")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--out", type=str, default=None, help="write the results to this json file")
+    parser.add_argument("--compare", type=str, default=None, help="older result file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="slowdown counted as regression")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the sampler")
+    opt = parser.parse_args()
+
+    if not is_cuda(opt.device):
+        opt.precision = "full"
+
+    tic = time.time()
+    model, modelCS, modelFS, config = load_models(opt.config, opt.device, opt.precision)
+    grid = [(b, r, r) for b in opt.batch_sizes for r in opt.resolutions]
+    results = []
+
+    def add(record):
+        if record is None:
+            return
+        results.append(record)
+        extra = f", {record['per_step_ms']:.2f} ms/step" if "per_step_ms" in record else ""
+        print(f"{record['bench']:<10} {json.dumps(record['params'])}: {record['mean_ms']:.2f} ms{extra}")
+
+    if "sampler" in opt.benchmarks:
+        for sampler in opt.samplers:
+            for b, H, W in grid:
+                add(bench_sampler(opt, model, modelCS, b, H, W, sampler))
+
+    if "attention" in opt.benchmarks:
+        for b, H, W in grid:
+            for att_step in opt.att_steps:
+                add(bench_attention(opt, config.modelUNet.params.unetConfigEncode, b, H, W, att_step))
+
+    if "offload" in opt.benchmarks:
+        if is_cuda(opt.device):
+            add(bench_offload(opt, "unet", [model.model1, model.model2]))
+            add(bench_offload(opt, "first_stage", [modelFS]))
+        else:
+            print("skipping offload benchmark, it needs a cuda device")
+
+    if "decode" in opt.benchmarks:
+        for b, H, W in grid:
+            add(bench_decode(opt, modelFS, b, H, W))
+
+    meta = {
+        "config": os.path.relpath(opt.config, ROOT),
+        "device": opt.device,
+        "device_name": torch.cuda.get_device_name(opt.device) if is_cuda(opt.device) else platform.processor(),
+        "precision": opt.precision,
+        "torch": torch.__version__,
+        "git": git_revision(),
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "seconds": time.time() - tic,
+    }
+    if opt.out:
+        with open(opt.out, "w") as f:
+            json.dump({"meta": meta, "results": results}, f, indent=2)
+        print(f"Results written to {opt.out}")
+
+    if opt.compare:
+        regressions = compare(results, opt.compare, opt.threshold)
+        if regressions:
+            print(f"{regressions} regressions above {100 * opt.threshold:.0f}%")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
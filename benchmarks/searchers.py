@@ -0,0 +1,238 @@
+"""
+Recall / latency benchmark of retrieval searcher configurations.
+
+Every candidate configuration is built on a random sample of a retrieval database and
+searched with held out database rows as queries. Reported per configuration: recall@k
+against exact search on the same sample, queries per second at several batch sizes, build
+time, peak memory allocated by the build (NumPy allocations, so built-in indices only) and
+the size of the index arrays. The fastest configuration reaching --recall at
+--reference_batch is written to <searcher>/recommended.json, which train_searcher.py uses
+to build the searcher and load_index applies to the search parameters of a built-in index.
+
+    python benchmarks/searchers.py --database data/rdm/retrieval_databases/openimages \\
+        --searcher data/rdm/searchers/openimages --out searchers.json
+
+Timings of a sample only carry over to the full pool if the sample is of similar size, use
+--sample_size 0 to benchmark on the whole database.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ldm.modules.retrieval.database import open_database
+from ldm.modules.retrieval.index import RECOMMENDED_FILE, ExactIndex, IVFPQIndex
+
+try:
+    import scann
+except ImportError:
+    scann = None
+
+
+def int_list(s):
+    return [int(v) for v in s.split(",") if v.strip()]
+
+
+def float_list(s):
+    return [float(v) for v in s.split(",") if v.strip()]
+
+
+def index_mb(index):
+    if isinstance(index, ExactIndex):
+        return index.embeddings.nbytes / 1e6
+    if isinstance(index, IVFPQIndex):
+        arrays = [index.centroids, index.codebooks] + [s[key] for s in index.segments for key in s]
+        return sum(a.nbytes for a in arrays) / 1e6
+    return None
+
+
+def build(fn):
+    """Runs fn and returns its result, the build time (s) and the peak traced memory (MB)."""
+    tracemalloc.start()
+    tic = time.perf_counter()
+    index = fn()
+    seconds = time.perf_counter() - tic
+    peak = tracemalloc.get_traced_memory()[1] / 1e6
+    tracemalloc.stop()
+    return index, seconds, peak
+
+
+def recall(nns, truth):
+    k = truth.shape[1]
+    return float(np.mean([len(np.intersect1d(a[:k], b)) / k for a, b in zip(nns, truth)]))
+
+
+def measure(search, queries, k, batch_sizes, min_queries=64):
+    """Neighbors of all queries (largest batch size) and the queries per second per batch size."""
+    qps, nns = {}, None
+    for b in batch_sizes:
+        # small batches are slow, time them on a prefix of the queries
+        n = len(queries) if b >= min_queries else min(len(queries), max(min_queries, 8 * b))
+        tic = time.perf_counter()
+        out = [search(queries[s:min(s + b, n)], k) for s in range(0, n, b)]
+        qps[b] = n / (time.perf_counter() - tic)
+        if n == len(queries):
+            nns = np.concatenate(out)
+    if nns is None:
+        nns = search(queries, k)
+    return nns, qps
+
+
+def builtin_candidates(pool, opt):
+    """(algorithm, params, index builder, search time variants) of the built-in indices."""
+    k = opt.knn
+    yield "exact", {}, lambda: ExactIndex(pool), [{}]
+    for ratio in opt.leaves_per_sqrt_n:
+        num_leaves = max(int(ratio * np.sqrt(len(pool))), 1)
+        for dims_per_block in opt.dims_per_block:
+            def make(num_leaves=num_leaves, dims_per_block=dims_per_block):
+                index = IVFPQIndex.train(pool, num_leaves, dims_per_block)
+                index.add(pool)
+                index.reorder = pool
+                return index
+            variants = [{"leaves_to_search_fraction": f, "reorder_k": r * k}
+                        for f in opt.leaves_to_search for r in opt.reorder_factors]
+            yield "ivfpq", {"leaves_per_sqrt_n": ratio, "dims_per_block": dims_per_block}, make, variants
+
+
+def builtin_search(index, variant):
+    if isinstance(index, IVFPQIndex):
+        index.num_leaves_to_search = max(int(round(variant["leaves_to_search_fraction"] * index.num_leaves)), 1)
+        index.reorder_k = variant["reorder_k"]
+    return lambda q, k: index.search_batched(q, final_num_neighbors=k)[0]
+
+
+def scann_candidates(pool, opt):
+    """The three scaNN searchers train_searcher.py chooses from by pool size."""
+    k = opt.knn
+
+    def builder():
+        return scann.scann_ops_pybind.builder(pool, k, "dot_product")
+
+    yield "brute_force", {}, lambda: builder().score_brute_force().build(), [{}]
+    for dims_per_block in opt.dims_per_block:
+        for aiq in opt.aiq_thresholds:
+            params = {"dims_per_block": dims_per_block, "aiq_threshold": aiq}
+            for r in opt.reorder_factors:
+                yield "ah", dict(params, reorder_k=r * k), \
+                    lambda d=dims_per_block, a=aiq, r=r: builder().score_ah(
+                        d, anisotropic_quantization_threshold=a).reorder(r * k).build(), [{}]
+            for ratio in opt.leaves_per_sqrt_n:
+                num_leaves = max(int(ratio * np.sqrt(len(pool))), 1)
+                variants = [{"leaves_to_search_fraction": f} for f in opt.leaves_to_search]
+
+                def make(d=dims_per_block, a=aiq, num_leaves=num_leaves):
+                    return builder().tree(num_leaves=num_leaves, num_leaves_to_search=max(num_leaves // 20, 1),
+                                          training_sample_size=len(pool) // 10) \
+                        .score_ah(d, anisotropic_quantization_threshold=a).reorder(2 * k).build()
+                yield "partitioned_ah", dict(params, leaves_per_sqrt_n=ratio, reorder_k=2 * k), make, variants
+
+
+def scann_search(searcher, variant, num_leaves=None):
+    if "leaves_to_search_fraction" in variant:
+        leaves = max(int(round(variant["leaves_to_search_fraction"] * num_leaves)), 1)
+        return lambda q, k: searcher.search_batched(q, final_num_neighbors=k, leaves_to_search=leaves)[0]
+    return lambda q, k: searcher.search_batched(q, final_num_neighbors=k)[0]
+
+
+def recommend(results, target_recall, reference_batch):
+    """Fastest result with at least target_recall, else the one with the best recall."""
+    good = [r for r in results if r["recall"] >= target_recall]
+    if good:
+        return max(good, key=lambda r: r["qps"][str(reference_batch)])
+    return max(results, key=lambda r: r["recall"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="recall and latency of retrieval searcher configurations")
+    parser.add_argument("--database", type=str, default="data/rdm/retrieval_databases/openimages")
+    parser.add_argument("--searcher", type=str, default=None,
+                        help="searcher directory to write recommended.json to (default: none written)")
+    parser.add_argument("--backends", type=str, default="builtin,scann",
+                        help="comma separated, scann is skipped if not installed")
+    parser.add_argument("--knn", type=int, default=20)
+    parser.add_argument("--sample_size", type=int, default=100000, help="pool rows to build on, 0: all")
+    parser.add_argument("--queries", type=int, default=1000, help="held out rows used as queries")
+    parser.add_argument("--batch_sizes", type=int_list, default=[1, 8, 64])
+    parser.add_argument("--reference_batch", type=int, default=8, help="batch size the recommendation is fastest at")
+    parser.add_argument("--recall", type=float, default=0.95, help="recall@k the recommendation has to reach")
+    parser.add_argument("--leaves_per_sqrt_n", type=float_list, default=[0.5, 1., 2.],
+                        help="partition counts as multiples of sqrt(pool size)")
+    parser.add_argument("--leaves_to_search", type=float_list, default=[0.025, 0.05, 0.1, 0.2],
+                        help="fractions of the partitions searched")
+    parser.add_argument("--reorder_factors", type=int_list, default=[1, 2, 4], help="reorder_k as multiples of k")
+    parser.add_argument("--dims_per_block", type=int_list, default=[2, 4])
+    parser.add_argument("--aiq_thresholds", type=float_list, default=[0.2])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", type=str, default=None, help="write all results to this json file")
+    opt = parser.parse_args()
+    assert opt.reference_batch in opt.batch_sizes, "--reference_batch has to be one of --batch_sizes"
+
+    db = open_database(opt.database)
+    rng = np.random.default_rng(opt.seed)
+    n = min(opt.sample_size or len(db), len(db) - opt.queries)
+    rows = rng.choice(len(db), n + opt.queries, replace=False)
+    pool = db.neighbor_embeddings(np.sort(rows[:n]))
+    queries = db.neighbor_embeddings(rows[n:])
+    print(f"Benchmarking on {n} of {len(db)} rows with {len(queries)} queries, k={opt.knn}")
+
+    truth = ExactIndex(pool).search_batched(queries, final_num_neighbors=opt.knn)[0]
+    backends = [b for b in opt.backends.split(",") if b]
+    if "scann" in backends and scann is None:
+        print("scann is not installed, skipping its searchers")
+        backends.remove("scann")
+
+    results = []
+    for backend in backends:
+        candidates = builtin_candidates(pool, opt) if backend == "builtin" else scann_candidates(pool, opt)
+        for algorithm, params, make, variants in candidates:
+            index, build_s, peak_mb = build(make)
+            for variant in variants:
+                if backend == "builtin":
+                    search = builtin_search(index, variant)
+                else:
+                    num_leaves = max(int(params.get("leaves_per_sqrt_n", 0) * np.sqrt(n)), 1)
+                    search = scann_search(index, variant, num_leaves)
+                nns, qps = measure(search, queries, opt.knn, opt.batch_sizes)
+                record = {"backend": backend, "algorithm": algorithm, "params": dict(params, **variant),
+                          "recall": recall(nns, truth), "qps": {str(b): q for b, q in qps.items()},
+                          "build_s": build_s,
+                          "build_peak_mb": peak_mb if backend == "builtin" else None,
+                          "index_mb": index_mb(index)}
+                results.append(record)
+                print(f"{backend:<8} {algorithm:<15} {json.dumps(record['params'])}: recall {record['recall']:.3f}, "
+                      + ", ".join(f"{q:.0f} qps @{b}" for b, q in qps.items()) + f", build {build_s:.1f} s")
+            del index
+
+    best = recommend(results, opt.recall, opt.reference_batch)
+    print(f"Recommended: {best['backend']} {best['algorithm']} {json.dumps(best['params'])}, "
+          f"recall {best['recall']:.3f}, {best['qps'][str(opt.reference_batch)]:.0f} qps @{opt.reference_batch}")
+    if best["recall"] < opt.recall:
+        print(f"No configuration reached a recall of {opt.recall}, recommending the most accurate one")
+
+    meta = {"database": opt.database, "rows": len(db), "sample_size": n, "queries": len(queries), "k": opt.knn,
+            "device_name": platform.processor(), "date": time.strftime("%Y-%m-%d %H:%M:%S")}
+    if opt.searcher:
+        os.makedirs(opt.searcher, exist_ok=True)
+        recommended = {"backend": best["backend"], "algorithm": best["algorithm"], "params": best["params"],
+                       "measured": dict(meta, recall=best["recall"], qps=best["qps"])}
+        with open(os.path.join(opt.searcher, RECOMMENDED_FILE), "w") as f:
+            json.dump(recommended, f, indent=2)
+        print(f"Recommendation written to {os.path.join(opt.searcher, RECOMMENDED_FILE)}")
+    if opt.out:
+        with open(opt.out, "w") as f:
+            json.dump({"meta": meta, "results": results}, f, indent=2)
+        print(f"Results written to {opt.out}")
+
+
+if __name__ == "__main__":
+    main()
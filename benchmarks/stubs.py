@@ -0,0 +1,35 @@
+import zlib
+
+import torch
+import torch.nn as nn
+
+
+class StubTextEncoder(nn.Module):
+    """
+    Stand-in for FrozenCLIPEmbedder without tokenizer or pretrained weights. Every word is
+    hashed into a small random embedding table, so the same prompt always gives the same
+    (meaningless) conditioning of shape (batch, max_length, context_dim).
+    """
+    def __init__(self, context_dim=768, max_length=77, vocab_size=4096, device="cpu"):
+        super().__init__()
+        self.device = device
+        self.max_length = max_length
+        self.vocab_size = vocab_size
+        self.embedding = nn.Embedding(vocab_size, context_dim)
+        self.proj = nn.Linear(context_dim, context_dim)
+
+    def tokenize(self, text):
+        if isinstance(text, str):
+            text = [text]
+        tokens = torch.zeros(len(text), self.max_length, dtype=torch.long)
+        for i, t in enumerate(text):
+            ids = [zlib.crc32(w.encode()) % self.vocab_size for w in t.split()][:self.max_length]
+            tokens[i, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+        return tokens
+
+    def forward(self, text):
+        tokens = self.tokenize(text).to(self.device)
+        return self.proj(self.embedding(tokens))
+
+    def encode(self, text):
+        return self(text)
@@ -23,6 +23,7 @@ from ldm.modules.ema import LitEma
 from ldm.modules.distributions.distributions import normal_kl, DiagonalGaussianDistribution
 from ldm.models.autoencoder import VQModelInterface, IdentityFirstStage, AutoencoderKL
 from ldm.modules.diffusionmodules.util import make_beta_schedule, extract_into_tensor, noise_like
+from ldm.modules.diffusionmodules.tiling import apply_tiled, get_tile_grid
 from ldm.models.diffusion.ddim import DDIMSampler
 
 
@@ -598,11 +599,25 @@ class LatentDiffusion(DDPM):
             weighting = weighting * L_weighting
         return weighting
 
-    def get_fold_unfold(self, x, kernel_size, stride, uf=1, df=1):  # todo load once not every time, shorten code
+    def _weighting_key(self):
+        p = self.split_input_params
+        tie = (p["clip_min_tie_weight"], p["clip_max_tie_weight"]) if p["tie_braker"] else None
+        return (p["clip_min_weight"], p["clip_max_weight"]), tie
+
+    def get_fold_unfold(self, x, kernel_size, stride, uf=1, df=1):
         """
         :param x: img of size (bs, c, h, w)
         :return: n img crops of size (n, bs, c, kernel_size[0], kernel_size[1])
+
+        The tables are built once per shape, see get_tile_grid for what the model itself uses.
         """
+        key = (tuple(x.shape), tuple(kernel_size), tuple(stride), uf, df, x.device, x.dtype, self._weighting_key())
+        cache = self.__dict__.setdefault("_fold_unfold_cache", {})
+        if key not in cache:
+            cache[key] = self._make_fold_unfold(x, kernel_size, stride, uf, df)
+        return cache[key]
+
+    def _make_fold_unfold(self, x, kernel_size, stride, uf=1, df=1):
         bs, nc, h, w = x.shape
 
         # number of crops in image
@@ -650,6 +665,19 @@ class LatentDiffusion(DDPM):
 
         return fold, unfold, normalization, weighting
 
+    def get_tile_grid(self, x, ks, stride, uf=1, df=1):
+        """Cached TileGrid of x with the window weighting of split_input_params."""
+        clip_weight, tie_weight = self._weighting_key()
+        return get_tile_grid(x.shape[-2], x.shape[-1], ks, stride, uf=uf, df=df, clip_weight=clip_weight,
+                             tie_weight=tie_weight, device=x.device, dtype=x.dtype)
+
+    def apply_tiled(self, fn, x, grid):
+        """
+        Runs fn over the windows of grid, split_input_params["tile_batch"] (default 4) windows
+        stacked into the batch dimension per call.
+        """
+        return apply_tiled(fn, x, grid, self.split_input_params.get("tile_batch", 4))
+
     @torch.no_grad()
     def get_input(self, batch, k, return_first_stage_outputs=False, force_c_encode=False,
                   cond_key=None, return_original_cond=False, bs=None):
@@ -717,39 +745,14 @@ class LatentDiffusion(DDPM):
                 ks = self.split_input_params["ks"]  # eg. (128, 128)
                 stride = self.split_input_params["stride"]  # eg. (64, 64)
                 uf = self.split_input_params["vqf"]
-                bs, nc, h, w = z.shape
-                if ks[0] > h or ks[1] > w:
-                    ks = (min(ks[0], h), min(ks[1], w))
-                    print("reducing Kernel")
-
-                if stride[0] > h or stride[1] > w:
-                    stride = (min(stride[0], h), min(stride[1], w))
-                    print("reducing stride")
-
-                fold, unfold, normalization, weighting = self.get_fold_unfold(z, ks, stride, uf=uf)
-
-                z = unfold(z)  # (bn, nc * prod(**ks), L)
-                # 1. Reshape to img shape
-                z = z.view((z.shape[0], -1, ks[0], ks[1], z.shape[-1]))  # (bn, nc, ks[0], ks[1], L )
-
-                # 2. apply model loop over last dim
+                # crops are decoded in groups and blended at uf times their size
+                grid = self.get_tile_grid(z, ks, stride, uf=uf)
                 if isinstance(self.first_stage_model, VQModelInterface):
-                    output_list = [self.first_stage_model.decode(z[:, :, :, :, i],
-                                                                 force_not_quantize=predict_cids or force_not_quantize)
-                                   for i in range(z.shape[-1])]
+                    kwargs = dict(force_not_quantize=predict_cids or force_not_quantize)
                 else:
-
-                    output_list = [self.first_stage_model.decode(z[:, :, :, :, i])
-                                   for i in range(z.shape[-1])]
-
-                o = torch.stack(output_list, axis=-1)  # # (bn, nc, ks[0], ks[1], L)
-                o = o * weighting
-                # Reverse 1. reshape to img shape
-                o = o.view((o.shape[0], -1, o.shape[-1]))  # (bn, nc * ks[0] * ks[1], L)
-                # stitch crops together
-                decoded = fold(o)
-                decoded = decoded / normalization  # norm is shape (1, 1, h, w)
-                return decoded
+                    kwargs = {}
+                return self.apply_tiled(lambda crops, start, end: self.first_stage_model.decode(crops, **kwargs),
+                                        z, grid)
             else:
                 if isinstance(self.first_stage_model, VQModelInterface):
                     return self.first_stage_model.decode(z, force_not_quantize=predict_cids or force_not_quantize)
@@ -777,39 +780,14 @@ class LatentDiffusion(DDPM):
                 ks = self.split_input_params["ks"]  # eg. (128, 128)
                 stride = self.split_input_params["stride"]  # eg. (64, 64)
                 uf = self.split_input_params["vqf"]
-                bs, nc, h, w = z.shape
-                if ks[0] > h or ks[1] > w:
-                    ks = (min(ks[0], h), min(ks[1], w))
-                    print("reducing Kernel")
-
-                if stride[0] > h or stride[1] > w:
-                    stride = (min(stride[0], h), min(stride[1], w))
-                    print("reducing stride")
-
-                fold, unfold, normalization, weighting = self.get_fold_unfold(z, ks, stride, uf=uf)
-
-                z = unfold(z)  # (bn, nc * prod(**ks), L)
-                # 1. Reshape to img shape
-                z = z.view((z.shape[0], -1, ks[0], ks[1], z.shape[-1]))  # (bn, nc, ks[0], ks[1], L )
-
-                # 2. apply model loop over last dim
-                if isinstance(self.first_stage_model, VQModelInterface):  
-                    output_list = [self.first_stage_model.decode(z[:, :, :, :, i],
-                                                                 force_not_quantize=predict_cids or force_not_quantize)
-                                   for i in range(z.shape[-1])]
+                # crops are decoded in groups and blended at uf times their size
+                grid = self.get_tile_grid(z, ks, stride, uf=uf)
+                if isinstance(self.first_stage_model, VQModelInterface):
+                    kwargs = dict(force_not_quantize=predict_cids or force_not_quantize)
                 else:
-
-                    output_list = [self.first_stage_model.decode(z[:, :, :, :, i])
-                                   for i in range(z.shape[-1])]
-
-                o = torch.stack(output_list, axis=-1)  # # (bn, nc, ks[0], ks[1], L)
-                o = o * weighting
-                # Reverse 1. reshape to img shape
-                o = o.view((o.shape[0], -1, o.shape[-1]))  # (bn, nc * ks[0] * ks[1], L)
-                # stitch crops together
-                decoded = fold(o)
-                decoded = decoded / normalization  # norm is shape (1, 1, h, w)
-                return decoded
+                    kwargs = {}
+                return self.apply_tiled(lambda crops, start, end: self.first_stage_model.decode(crops, **kwargs),
+                                        z, grid)
             else:
                 if isinstance(self.first_stage_model, VQModelInterface):
                     return self.first_stage_model.decode(z, force_not_quantize=predict_cids or force_not_quantize)
@@ -830,32 +808,8 @@ class LatentDiffusion(DDPM):
                 stride = self.split_input_params["stride"]  # eg. (64, 64)
                 df = self.split_input_params["vqf"]
                 self.split_input_params['original_image_size'] = x.shape[-2:]
-                bs, nc, h, w = x.shape
-                if ks[0] > h or ks[1] > w:
-                    ks = (min(ks[0], h), min(ks[1], w))
-                    print("reducing Kernel")
-
-                if stride[0] > h or stride[1] > w:
-                    stride = (min(stride[0], h), min(stride[1], w))
-                    print("reducing stride")
-
-                fold, unfold, normalization, weighting = self.get_fold_unfold(x, ks, stride, df=df)
-                z = unfold(x)  # (bn, nc * prod(**ks), L)
-                # Reshape to img shape
-                z = z.view((z.shape[0], -1, ks[0], ks[1], z.shape[-1]))  # (bn, nc, ks[0], ks[1], L )
-
-                output_list = [self.first_stage_model.encode(z[:, :, :, :, i])
-                               for i in range(z.shape[-1])]
-
-                o = torch.stack(output_list, axis=-1)
-                o = o * weighting
-
-                # Reverse reshape to img shape
-                o = o.view((o.shape[0], -1, o.shape[-1]))  # (bn, nc * ks[0] * ks[1], L)
-                # stitch crops together
-                decoded = fold(o)
-                decoded = decoded / normalization
-                return decoded
+                grid = self.get_tile_grid(x, ks, stride, df=df)
+                return self.apply_tiled(lambda crops, start, end: self.first_stage_model.encode(crops), x, grid)
 
             else:
                 return self.first_stage_model.encode(x)
@@ -905,83 +859,63 @@ class LatentDiffusion(DDPM):
             ks = self.split_input_params["ks"]  # eg. (128, 128)
             stride = self.split_input_params["stride"]  # eg. (64, 64)
 
-            h, w = x_noisy.shape[-2:]
-
-            fold, unfold, normalization, weighting = self.get_fold_unfold(x_noisy, ks, stride)
-
-            z = unfold(x_noisy)  # (bn, nc * prod(**ks), L)
-            # Reshape to img shape
-            z = z.view((z.shape[0], -1, ks[0], ks[1], z.shape[-1]))  # (bn, nc, ks[0], ks[1], L )
-            z_list = [z[:, :, :, :, i] for i in range(z.shape[-1])]
+            grid = self.get_tile_grid(x_noisy, ks, stride)
+            c_key = next(iter(cond.keys()))  # get key
 
             if self.cond_stage_key in ["image", "LR_image", "segmentation",
                                        'bbox_img'] and self.model.conditioning_key:  # todo check for completeness
-                c_key = next(iter(cond.keys()))  # get key
                 c = next(iter(cond.values()))  # get value
                 assert (len(c) == 1)  # todo extend to list with more than one elem
                 c = c[0]  # get element
 
-                c = unfold(c)
-                c = c.view((c.shape[0], -1, ks[0], ks[1], c.shape[-1]))  # (bn, nc, ks[0], ks[1], L )
-
-                cond_list = [{c_key: [c[:, :, :, :, i]]} for i in range(c.shape[-1])]
+                # spatial conditioning is cropped like the input
+                def window_cond(start, end):
+                    return {c_key: [grid.crop(c, start, end)]}
 
             elif self.cond_stage_key == 'coordinates_bbox':
                 assert 'original_image_size' in self.split_input_params, 'BoudingBoxRescaling is missing original_image_size'
 
-                # assuming padding of unfold is always 0 and its dilation is always 1
-                n_patches_per_row = int((w - ks[0]) / stride[0] + 1)
                 full_img_h, full_img_w = self.split_input_params['original_image_size']
                 # as we are operating on latents, we need the factor from the original image size to the
                 # spatial latent size to properly rescale the crops for regenerating the bbox annotations
                 num_downs = self.first_stage_model.encoder.num_resolutions - 1
                 rescale_latent = 2 ** (num_downs)
 
-                # get top left postions of patches as conforming for the bbbox tokenizer, therefore we
-                # need to rescale the tl patch coordinates to be in between (0,1)
-                tl_patch_coordinates = [(rescale_latent * stride[0] * (patch_nr % n_patches_per_row) / full_img_w,
-                                         rescale_latent * stride[1] * (patch_nr // n_patches_per_row) / full_img_h)
-                                        for patch_nr in range(z.shape[-1])]
-
-                # patch_limits are tl_coord, width and height coordinates as (x_tl, y_tl, h, w)
-                patch_limits = [(x_tl, y_tl,
-                                 rescale_latent * ks[0] / full_img_w,
-                                 rescale_latent * ks[1] / full_img_h) for x_tl, y_tl in tl_patch_coordinates]
-                # patch_values = [(np.arange(x_tl,min(x_tl+ks, 1.)),np.arange(y_tl,min(y_tl+ks, 1.))) for x_tl, y_tl in tl_patch_coordinates]
+                # patch_limits are tl_coord, width and height coordinates as (x_tl, y_tl, h, w), with the
+                # top left positions of the patches rescaled to be in between (0,1) for the bbox tokenizer
+                patch_limits = [(rescale_latent * x_tl / full_img_w, rescale_latent * y_tl / full_img_h,
+                                 rescale_latent * grid.ks[1] / full_img_w,
+                                 rescale_latent * grid.ks[0] / full_img_h) for y_tl, x_tl in grid.positions]
 
                 # tokenize crop coordinates for the bounding boxes of the respective patches
-                patch_limits_tknzd = [torch.LongTensor(self.bbox_tokenizer._crop_encoder(bbox))[None].to(self.device)
-                                      for bbox in patch_limits]  # list of length l with tensors of shape (1, 2)
-                print(patch_limits_tknzd[0].shape)
+                patch_limits_tknzd = torch.stack([torch.LongTensor(self.bbox_tokenizer._crop_encoder(bbox))
+                                                  for bbox in patch_limits]).to(self.device)  # (l, 2)
                 # cut tknzd crop position from conditioning
                 assert isinstance(cond, dict), 'cond must be dict to be fed into model'
                 cut_cond = cond['c_crossattn'][0][..., :-2].to(self.device)
-                print(cut_cond.shape)
+                b = cut_cond.shape[0]
 
-                adapted_cond = torch.stack([torch.cat([cut_cond, p], dim=1) for p in patch_limits_tknzd])
-                adapted_cond = rearrange(adapted_cond, 'l b n -> (l b) n')
-                print(adapted_cond.shape)
-                adapted_cond = self.get_learned_conditioning(adapted_cond)
-                print(adapted_cond.shape)
-                adapted_cond = rearrange(adapted_cond, '(l b) n d -> l b n d', l=z.shape[-1])
-                print(adapted_cond.shape)
+                adapted_cond = torch.cat([cut_cond.repeat(len(grid), 1),
+                                          patch_limits_tknzd.repeat_interleave(b, dim=0)], dim=1)  # ((l b), n)
+                adapted_cond = self.get_learned_conditioning(adapted_cond)  # ((l b), n, d), window-major
 
-                cond_list = [{'c_crossattn': [e]} for e in adapted_cond]
+                def window_cond(start, end):
+                    return {'c_crossattn': [adapted_cond[start * b:end * b]]}
 
             else:
-                cond_list = [cond for i in range(z.shape[-1])]  # Todo make this more efficient
-
-            # apply model by loop over crops
-            output_list = [self.model(z_list[i], t, **cond_list[i]) for i in range(z.shape[-1])]
-            assert not isinstance(output_list[0],
-                                  tuple)  # todo cant deal with multiple model outputs check this never happens
-
-            o = torch.stack(output_list, axis=-1)
-            o = o * weighting
-            # Reverse reshape to img shape
-            o = o.view((o.shape[0], -1, o.shape[-1]))  # (bn, nc * ks[0] * ks[1], L)
-            # stitch crops together
-            x_recon = fold(o) / normalization
+                # the same conditioning for every window, expanded along the batch dimension
+                def window_cond(start, end):
+                    n = end - start
+                    return {key: [v.repeat(n, *([1] * (v.dim() - 1))) for v in values]
+                            for key, values in cond.items()}
+
+            def denoise(crops, start, end):
+                out = self.model(crops, t.repeat(end - start), **window_cond(start, end))
+                assert not isinstance(out, tuple)  # todo cant deal with multiple model outputs check this never happens
+                return out
+
+            # apply model to groups of crops stacked into the batch dimension and stitch them together
+            x_recon = self.apply_tiled(denoise, x_noisy, grid)
 
         else:
             x_recon = self.model(x_noisy, t, **cond)
@@ -0,0 +1,506 @@
+"""
+Shared sampling engine for the DDIM, PLMS and k-diffusion samplers.
+
+    GuidedModel     the model wrapper every sampler goes through: eps(x, t) runs
+                    model.apply_model with classifier free guidance (the conditional and the
+                    unconditional batch in one call), denoise(x, sigma, schedule) turns that
+                    into the denoiser of the k-diffusion samplers
+    GuidanceSchedule
+                    on which steps guidance runs (an interval of noise levels) and how its
+                    scale changes over the steps
+    Schedules       everything derived from the alphas_cumprod of a model (DDIM step tables,
+                    k-diffusion sigmas), computed once per set of arguments and device and
+                    cached on the model, see get_schedules
+    step rules      ddim_step / plms_step for one step of the DDIM-style samplers, and the
+                    k-diffusion loops in K_SAMPLERS, run through sample_k
+
+The k-diffusion samplers are based on https://github.com/crowsonkb/k-diffusion. Their sigmas
+stay in float32 while the per-sample sigmas passed to the model follow the dtype of x, so the
+same code runs in half precision on the GPU and in full precision on the CPU.
+
+DDIMSampler and PLMSSampler (used with LatentDiffusion) and the UNet of optimizedSD use it.
+"""
+
+import math
+
+import numpy as np
+import torch
+from scipy import integrate
+from tqdm.auto import trange
+
+from ldm.modules.diffusionmodules.util import make_ddim_sampling_parameters, make_ddim_timesteps, noise_like, \
+    make_ddim_step_coefficients
+
+
+def append_dims(x, target_dims):
+    """Appends dimensions to the end of a tensor until it has target_dims dimensions."""
+    dims_to_append = target_dims - x.ndim
+    if dims_to_append < 0:
+        raise ValueError(f'input has {x.ndim} dims but target_dims is {target_dims}, which is less')
+    return x[(...,) + (None,) * dims_to_append]
+
+
+def append_zero(x):
+    return torch.cat([x, x.new_zeros([1])])
+
+
+def to_d(x, sigma, denoised):
+    """Converts a denoiser output to a Karras ODE derivative."""
+    return (x - denoised) / append_dims(sigma, x.ndim)
+
+
+def get_ancestral_step(sigma_from, sigma_to):
+    """Calculates the noise level (sigma_down) to step down to and the amount
+    of noise to add (sigma_up) when doing an ancestral sampling step."""
+    sigma_up = (sigma_to ** 2 * (sigma_from ** 2 - sigma_to ** 2) / sigma_from ** 2) ** 0.5
+    sigma_down = (sigma_to ** 2 - sigma_up ** 2) ** 0.5
+    return sigma_down, sigma_up
+
+
+def linear_multistep_coeff(order, t, i, j):
+    if order - 1 > i:
+        raise ValueError(f'Order {order} too high for step {i}')
+    def fn(tau):
+        prod = 1.
+        for k in range(order):
+            if j == k:
+                continue
+            prod *= (tau - t[i - k]) / (t[i - j] - t[i - k])
+        return prod
+    return integrate.quad(fn, t[i], t[i + 1], epsrel=1e-4)[0]
+
+
+def _cat_cond(uncond, cond):
+    if isinstance(cond, dict):
+        return {k: [torch.cat([u, c]) for u, c in zip(uncond[k], cond[k])] if isinstance(cond[k], list)
+                else torch.cat([uncond[k], cond[k]]) for k in cond}
+    return torch.cat([uncond, cond])
+
+
+class GuidanceSchedule(object):
+    """
+    When and how strongly classifier free guidance is applied.
+
+    :param sigma_min, sigma_max: guidance only runs on steps whose noise level sigma (about
+        0.03 to 14.6 for stable diffusion) is in this interval, the other steps only run the
+        conditional half of the batch.
+    :param curve: how the scale changes from the first to the last step, "constant", "linear"
+        or "cosine" (slow at both ends).
+    :param end_scale: scale at the last step for the linear and cosine curves.
+    """
+    CURVES = ("constant", "linear", "cosine")
+
+    def __init__(self, sigma_min=0., sigma_max=float("inf"), curve="constant", end_scale=None):
+        assert curve in self.CURVES, f"unknown guidance curve {curve}"
+        self.sigma_min = sigma_min
+        self.sigma_max = sigma_max
+        self.curve = curve
+        self.end_scale = end_scale
+
+    def applies(self, sigma):
+        return sigma is None or self.sigma_min <= sigma <= self.sigma_max
+
+    def scale(self, scale, i, n):
+        """Guidance scale of step i of n for the base scale `scale`."""
+        if self.curve == "constant" or self.end_scale is None or n <= 1:
+            return scale
+        f = i / (n - 1)
+        if self.curve == "cosine":
+            f = (1 - math.cos(math.pi * f)) / 2
+        return scale + (self.end_scale - scale) * f
+
+    def __repr__(self):
+        return (f"GuidanceSchedule(sigma in [{self.sigma_min}, {self.sigma_max}], {self.curve}"
+                f"{'' if self.end_scale is None else f' to {self.end_scale}'})")
+
+
+def parse_sigma_interval(s):
+    """--cfg_interval "0.3,5" -> (0.3, 5.), either end may be left empty."""
+    lo, hi = (s.split(",") + [""])[:2]
+    return float(lo) if lo.strip() else 0., float(hi) if hi.strip() else float("inf")
+
+
+def make_guidance_schedule(interval=None, curve="constant", end_scale=None):
+    """GuidanceSchedule from the command line options, None if they are all at their defaults."""
+    if interval is None and (curve == "constant" or end_scale is None):
+        return None
+    sigma_min, sigma_max = interval if interval is not None else (0., float("inf"))
+    return GuidanceSchedule(sigma_min, sigma_max, curve, end_scale)
+
+
+class GuidedModel(object):
+    """
+    Noise prediction of `model` (anything with apply_model(x, t, cond)) for one conditioning,
+    with classifier free guidance if `uncond` is given and scale != 1.
+
+    Guidance can be dropped (scale 1, only the conditional half of the batch is run) for the
+    last `skip_last` steps, for all remaining steps once the guidance delta, the mean
+    |e_t - e_t_uncond| relative to the mean |e_t|, falls below `skip_delta`, and outside the
+    noise levels of the GuidanceSchedule `cfg_schedule`, which also sets the scale per step.
+    The samplers call start_step(i, n, sigma) before every step for this.
+    """
+    def __init__(self, model, cond, uncond=None, scale=1., score_corrector=None, corrector_kwargs=None,
+                 skip_last=0, skip_delta=0., cfg_schedule=None):
+        self.model = model
+        self.cond = cond
+        self.scale = scale
+        self.guided = uncond is not None and scale != 1.
+        # the unconditional and conditional batch are concatenated once per run, not every step
+        self.cond_in = _cat_cond(uncond, cond) if self.guided else cond
+        self.score_corrector = score_corrector
+        self.corrector_kwargs = corrector_kwargs or {}
+        self.skip_last = skip_last
+        self.skip_delta = skip_delta
+        self.cfg_schedule = cfg_schedule
+        self.converged = False
+        self.unguided = False
+        self.step_scale = scale
+        self.skipped = 0
+
+    def start_step(self, i, n, sigma=None):
+        """Decides whether and with which scale step i of n, at noise level sigma, runs guidance."""
+        if not self.guided:
+            return
+        self.step_scale = self.scale
+        unguided = self.converged or n - i <= self.skip_last
+        if self.cfg_schedule is not None:
+            self.step_scale = self.cfg_schedule.scale(self.scale, i, n)
+            unguided = unguided or not self.cfg_schedule.applies(sigma)
+        self.unguided = unguided or self.step_scale == 1.
+        self.skipped += self.unguided
+
+    def report(self, n):
+        if self.skipped:
+            print(f"Ran {self.skipped} of {n} steps without the unconditional pass")
+
+    def eps(self, x, t):
+        if not self.guided or self.unguided:
+            e_t = self.model.apply_model(x, t, self.cond)
+        else:
+            e_t_uncond, e_t = self.model.apply_model(torch.cat([x] * 2), torch.cat([t] * 2), self.cond_in).chunk(2)
+            if self.skip_delta > 0:
+                # one host sync per step, only paid when the threshold is used
+                delta = (e_t - e_t_uncond).abs().mean() / e_t.abs().mean().clamp(min=1e-8)
+                self.converged = delta.item() < self.skip_delta
+            e_t = e_t_uncond + self.step_scale * (e_t - e_t_uncond)
+
+        if self.score_corrector is not None:
+            assert self.model.parameterization == "eps"
+            e_t = self.score_corrector.modify_score(self.model, e_t, x, t, self.cond, **self.corrector_kwargs)
+        return e_t
+
+    def denoise(self, x, sigma, schedule):
+        """k-diffusion denoiser: the prediction of x_0 from x at noise levels sigma (one per sample)."""
+        c_out, c_in = [append_dims(v, x.ndim) for v in schedule.get_scalings(sigma)]
+        return x + self.eps(x * c_in, schedule.sigma_to_t(sigma)) * c_out
+
+
+class KarrasSchedule(object):
+    """The noise levels of a discrete DDPM schedule, for the k-diffusion samplers."""
+    def __init__(self, alphas_cumprod):
+        self.sigmas = ((1 - alphas_cumprod) / alphas_cumprod) ** 0.5
+        self.sigma_data = 1.
+        self._steps = {}
+
+    def get_sigmas(self, n):
+        """n noise levels evenly spaced in t from the highest to the lowest, plus 0."""
+        if n not in self._steps:
+            t_max = len(self.sigmas) - 1
+            t = torch.linspace(t_max, 0, n, device=self.sigmas.device)
+            self._steps[n] = append_zero(self.t_to_sigma(t))
+        return self._steps[n]
+
+    def sigma_to_t(self, sigma):
+        dists = torch.abs(sigma - self.sigmas[:, None])
+        low_idx, high_idx = torch.sort(torch.topk(dists, dim=0, k=2, largest=False).indices, dim=0)[0]
+        low, high = self.sigmas[low_idx], self.sigmas[high_idx]
+        w = (low - sigma) / (low - high)
+        w = w.clamp(0, 1)
+        t = (1 - w) * low_idx + w * high_idx
+        return t.view(sigma.shape)
+
+    def t_to_sigma(self, t):
+        t = t.float()
+        low_idx, high_idx, w = t.floor().long(), t.ceil().long(), t.frac()
+        return (1 - w) * self.sigmas[low_idx] + w * self.sigmas[high_idx]
+
+    def get_scalings(self, sigma):
+        c_out = -sigma
+        c_in = 1 / (sigma ** 2 + self.sigma_data ** 2) ** 0.5
+        return c_out, c_in
+
+
+class Schedules(object):
+    """Schedules derived from the alphas_cumprod of one model, cached per arguments and device."""
+    def __init__(self, alphas_cumprod):
+        self.alphas_cumprod = alphas_cumprod.detach().cpu()
+        # noise level of every timestep, for the GuidanceSchedule of the DDIM-style samplers
+        self.sigmas = (((1 - self.alphas_cumprod) / self.alphas_cumprod) ** 0.5).tolist()
+        self.cache = {}
+
+    def _get(self, key, factory):
+        if key not in self.cache:
+            self.cache[key] = factory()
+        return self.cache[key]
+
+    def karras(self, device):
+        device = torch.device(device)
+        return self._get(("karras", device),
+                         lambda: KarrasSchedule(self.alphas_cumprod.to(device, torch.float32)))
+
+    def ddim(self, ddim_num_steps, ddim_eta=0., ddim_discretize="uniform", verbose=False):
+        """
+        DDIM schedule with ddim_num_steps steps as a dict of timesteps, sigmas, alphas,
+        alphas_prev, sqrt_one_minus_alphas and the step coefficients of ddim_step, plus the
+        coefficients for sampling with all of the original steps. Tensors are on the cpu.
+        """
+        def make():
+            ac = self.alphas_cumprod
+            timesteps = make_ddim_timesteps(ddim_discr_method=ddim_discretize, num_ddim_timesteps=ddim_num_steps,
+                                            num_ddpm_timesteps=len(ac), verbose=verbose)
+            sigmas, alphas, alphas_prev = make_ddim_sampling_parameters(alphacums=ac, ddim_timesteps=timesteps,
+                                                                        eta=ddim_eta, verbose=verbose)
+            ac_prev = torch.cat([ac.new_ones(1), ac[:-1]])
+            sigmas_original = ddim_eta * torch.sqrt((1 - ac_prev) / (1 - ac) * (1 - ac / ac_prev))
+            return {
+                "timesteps": timesteps,
+                "sigmas": sigmas,
+                "alphas": alphas,
+                "alphas_prev": alphas_prev,
+                "sqrt_one_minus_alphas": np.sqrt(1. - alphas),
+                "coefficients": make_ddim_step_coefficients(alphas, alphas_prev, sigmas),
+                "sigmas_original_steps": sigmas_original,
+                "coefficients_original_steps": make_ddim_step_coefficients(ac, ac_prev, sigmas_original),
+            }
+        return self._get(("ddim", ddim_num_steps, float(ddim_eta), ddim_discretize), make)
+
+
+def get_schedules(model):
+    """The Schedules of `model`, created from model.alphas_cumprod the first time."""
+    schedules = getattr(model, "_sampling_schedules", None)
+    if schedules is None:
+        schedules = Schedules(model.alphas_cumprod)
+        model._sampling_schedules = schedules
+    return schedules
+
+
+def ddim_update(x, e_t, coefficients, eta=0., quantize=None, repeat_noise=False, temperature=1.,
+                noise_dropout=0.):
+    """x_prev and pred_x0 of a DDIM step from the noise prediction e_t, for one row of step coefficients."""
+    sqrt_a_t, sqrt_one_minus_at, sqrt_a_prev, dir_xt_coef, sigma_t = coefficients
+
+    # current prediction for x_0
+    pred_x0 = (x - sqrt_one_minus_at * e_t) / sqrt_a_t
+    if quantize is not None:
+        pred_x0, _, *_ = quantize(pred_x0)
+    # direction pointing to x_t
+    x_prev = sqrt_a_prev * pred_x0 + dir_xt_coef * e_t
+    if eta > 0:
+        noise = sigma_t * noise_like(x.shape, x.device, repeat_noise) * temperature
+        if noise_dropout > 0.:
+            noise = torch.nn.functional.dropout(noise, p=noise_dropout)
+        x_prev = x_prev + noise
+    return x_prev, pred_x0
+
+
+def ddim_step(model, x, t, coefficients, index, eta=0., **kwargs):
+    """One DDIM step of the GuidedModel `model` at timestep t, returns (x_prev, pred_x0)."""
+    return ddim_update(x, model.eps(x, t), coefficients[index], eta, **kwargs)
+
+
+def plms_step(model, x, t, t_next, coefficients, index, old_eps, quantize=None):
+    """
+    One PLMS step of the GuidedModel `model`, returns (x_prev, pred_x0, e_t). old_eps are the
+    e_t of the previous (up to 3) steps, the first step is a pseudo improved Euler step.
+    """
+    e_t = model.eps(x, t)
+    if len(old_eps) == 0:
+        # Pseudo Improved Euler (2nd order)
+        x_prev, pred_x0 = ddim_update(x, e_t, coefficients[index], quantize=quantize)
+        e_t_next = model.eps(x_prev, t_next)
+        e_t_prime = (e_t + e_t_next) / 2
+    elif len(old_eps) == 1:
+        # 2nd order Pseudo Linear Multistep (Adams-Bashforth)
+        e_t_prime = (3 * e_t - old_eps[-1]) / 2
+    elif len(old_eps) == 2:
+        # 3nd order Pseudo Linear Multistep (Adams-Bashforth)
+        e_t_prime = (23 * e_t - 16 * old_eps[-1] + 5 * old_eps[-2]) / 12
+    else:
+        # 4nd order Pseudo Linear Multistep (Adams-Bashforth)
+        e_t_prime = (55 * e_t - 59 * old_eps[-1] + 37 * old_eps[-2] - 9 * old_eps[-3]) / 24
+
+    x_prev, pred_x0 = ddim_update(x, e_t_prime, coefficients[index], quantize=quantize)
+    return x_prev, pred_x0, e_t
+
+
+@torch.no_grad()
+def sample_euler(model, x, sigmas, steps=trange, callback=None, s_churn=0., s_tmin=0., s_tmax=float('inf'),
+                 s_noise=1.):
+    """Implements Algorithm 2 (Euler steps) from Karras et al. (2022)."""
+    s_in = x.new_ones([x.shape[0]])
+    for i in steps(len(sigmas) - 1):
+        gamma = min(s_churn / (len(sigmas) - 1), 2 ** 0.5 - 1) if s_tmin <= sigmas[i] <= s_tmax else 0.
+        sigma_hat = sigmas[i] * (gamma + 1)
+        if gamma > 0:
+            eps = torch.randn_like(x) * s_noise
+            x = x + eps * (sigma_hat ** 2 - sigmas[i] ** 2) ** 0.5
+        denoised = model(x, sigma_hat * s_in)
+        d = to_d(x, sigma_hat, denoised)
+        if callback is not None:
+            callback({'x': x, 'i': i, 'sigma': sigmas[i], 'sigma_hat': sigma_hat, 'denoised': denoised})
+        dt = sigmas[i + 1] - sigma_hat
+        # Euler method
+        x = x + d * dt
+    return x
+
+
+@torch.no_grad()
+def sample_euler_ancestral(model, x, sigmas, steps=trange, callback=None):
+    """Ancestral sampling with Euler method steps."""
+    s_in = x.new_ones([x.shape[0]])
+    for i in steps(len(sigmas) - 1):
+        denoised = model(x, sigmas[i] * s_in)
+        sigma_down, sigma_up = get_ancestral_step(sigmas[i], sigmas[i + 1])
+        if callback is not None:
+            callback({'x': x, 'i': i, 'sigma': sigmas[i], 'sigma_hat': sigmas[i], 'denoised': denoised})
+        d = to_d(x, sigmas[i], denoised)
+        # Euler method
+        dt = sigma_down - sigmas[i]
+        x = x + d * dt
+        x = x + torch.randn_like(x) * sigma_up
+    return x
+
+
+@torch.no_grad()
+def sample_heun(model, x, sigmas, steps=trange, callback=None, s_churn=0., s_tmin=0., s_tmax=float('inf'),
+                s_noise=1.):
+    """Implements Algorithm 2 (Heun steps) from Karras et al. (2022)."""
+    s_in = x.new_ones([x.shape[0]])
+    for i in steps(len(sigmas) - 1):
+        gamma = min(s_churn / (len(sigmas) - 1), 2 ** 0.5 - 1) if s_tmin <= sigmas[i] <= s_tmax else 0.
+        sigma_hat = sigmas[i] * (gamma + 1)
+        if gamma > 0:
+            eps = torch.randn_like(x) * s_noise
+            x = x + eps * (sigma_hat ** 2 - sigmas[i] ** 2) ** 0.5
+        denoised = model(x, sigma_hat * s_in)
+        d = to_d(x, sigma_hat, denoised)
+        if callback is not None:
+            callback({'x': x, 'i': i, 'sigma': sigmas[i], 'sigma_hat': sigma_hat, 'denoised': denoised})
+        dt = sigmas[i + 1] - sigma_hat
+        if sigmas[i + 1] == 0:
+            # Euler method
+            x = x + d * dt
+        else:
+            # Heun's method
+            x_2 = x + d * dt
+            denoised_2 = model(x_2, sigmas[i + 1] * s_in)
+            d_2 = to_d(x_2, sigmas[i + 1], denoised_2)
+            d_prime = (d + d_2) / 2
+            x = x + d_prime * dt
+    return x
+
+
+@torch.no_grad()
+def sample_dpm_2(model, x, sigmas, steps=trange, callback=None, s_churn=0., s_tmin=0., s_tmax=float('inf'),
+                 s_noise=1.):
+    """A sampler inspired by DPM-Solver-2 and Algorithm 2 from Karras et al. (2022)."""
+    s_in = x.new_ones([x.shape[0]])
+    for i in steps(len(sigmas) - 1):
+        gamma = min(s_churn / (len(sigmas) - 1), 2 ** 0.5 - 1) if s_tmin <= sigmas[i] <= s_tmax else 0.
+        sigma_hat = sigmas[i] * (gamma + 1)
+        if gamma > 0:
+            eps = torch.randn_like(x) * s_noise
+            x = x + eps * (sigma_hat ** 2 - sigmas[i] ** 2) ** 0.5
+        denoised = model(x, sigma_hat * s_in)
+        d = to_d(x, sigma_hat, denoised)
+        if callback is not None:
+            callback({'x': x, 'i': i, 'sigma': sigmas[i], 'sigma_hat': sigma_hat, 'denoised': denoised})
+        # Midpoint method, where the midpoint is chosen according to a rho=3 Karras schedule
+        sigma_mid = ((sigma_hat ** (1 / 3) + sigmas[i + 1] ** (1 / 3)) / 2) ** 3
+        dt_1 = sigma_mid - sigma_hat
+        dt_2 = sigmas[i + 1] - sigma_hat
+        x_2 = x + d * dt_1
+        denoised_2 = model(x_2, sigma_mid * s_in)
+        d_2 = to_d(x_2, sigma_mid, denoised_2)
+        x = x + d_2 * dt_2
+    return x
+
+
+@torch.no_grad()
+def sample_dpm_2_ancestral(model, x, sigmas, steps=trange, callback=None):
+    """Ancestral sampling with DPM-Solver inspired second-order steps."""
+    s_in = x.new_ones([x.shape[0]])
+    for i in steps(len(sigmas) - 1):
+        denoised = model(x, sigmas[i] * s_in)
+        sigma_down, sigma_up = get_ancestral_step(sigmas[i], sigmas[i + 1])
+        if callback is not None:
+            callback({'x': x, 'i': i, 'sigma': sigmas[i], 'sigma_hat': sigmas[i], 'denoised': denoised})
+        d = to_d(x, sigmas[i], denoised)
+        # Midpoint method, where the midpoint is chosen according to a rho=3 Karras schedule
+        sigma_mid = ((sigmas[i] ** (1 / 3) + sigma_down ** (1 / 3)) / 2) ** 3
+        dt_1 = sigma_mid - sigmas[i]
+        dt_2 = sigma_down - sigmas[i]
+        x_2 = x + d * dt_1
+        denoised_2 = model(x_2, sigma_mid * s_in)
+        d_2 = to_d(x_2, sigma_mid, denoised_2)
+        x = x + d_2 * dt_2
+        x = x + torch.randn_like(x) * sigma_up
+    return x
+
+
+@torch.no_grad()
+def sample_lms(model, x, sigmas, steps=trange, callback=None, order=4):
+    s_in = x.new_ones([x.shape[0]])
+    # the coefficients are integrated on the host, copy the schedule there once
+    sigmas_cpu = sigmas.detach().cpu().numpy()
+    ds = []
+    for i in steps(len(sigmas) - 1):
+        denoised = model(x, sigmas[i] * s_in)
+        d = to_d(x, sigmas[i], denoised)
+        ds.append(d)
+        if len(ds) > order:
+            ds.pop(0)
+        if callback is not None:
+            callback({'x': x, 'i': i, 'sigma': sigmas[i], 'sigma_hat': sigmas[i], 'denoised': denoised})
+        cur_order = min(i + 1, order)
+        coeffs = [linear_multistep_coeff(cur_order, sigmas_cpu, i, j) for j in range(cur_order)]
+        x = x + sum(coeff * d for coeff, d in zip(coeffs, reversed(ds)))
+    return x
+
+
+K_SAMPLERS = {
+    "euler": sample_euler,
+    "euler_a": sample_euler_ancestral,
+    "heun": sample_heun,
+    "dpm2": sample_dpm_2,
+    "dpm2_a": sample_dpm_2_ancestral,
+    "lms": sample_lms,
+}
+
+
+def sample_k(sampler, model, x, n_steps, cond, uncond=None, scale=1., steps=trange, callback=None,
+             skip_last=0, skip_delta=0., cfg_schedule=None, **kwargs):
+    """
+    Runs the k-diffusion sampler `sampler` (a key of K_SAMPLERS) with n_steps noise levels,
+    starting from the unit variance noise x.
+
+    :param model: the diffusion model, anything with apply_model and alphas_cumprod.
+    :param steps: steps(n) -> iterable over the step indices, e.g. to show or trace progress.
+    :param skip_last, skip_delta, cfg_schedule: when and how strongly to guide, see GuidedModel.
+    """
+    schedule = get_schedules(model).karras(x.device)
+    sigmas = schedule.get_sigmas(n_steps)
+    guided = GuidedModel(model, cond, uncond, scale, skip_last=skip_last, skip_delta=skip_delta,
+                         cfg_schedule=cfg_schedule)
+    step_sigmas = sigmas.tolist()
+
+    def denoise(x, sigma):
+        return guided.denoise(x, sigma, schedule)
+
+    def guided_steps(n):
+        for i in steps(n):
+            guided.start_step(i, n, step_sigmas[i])
+            yield i
+        guided.report(n)
+
+    return K_SAMPLERS[sampler](denoise, x * sigmas[0], sigmas, steps=guided_steps, callback=callback, **kwargs)
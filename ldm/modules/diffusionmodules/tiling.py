@@ -0,0 +1,139 @@
+"""
+Overlapping-window tiling for running a model on inputs larger than it should see at once.
+
+A TileGrid describes how an input of one shape is cut into windows of size `ks` placed every
+`stride` pixels (the last row/column of windows is moved flush with the border, so every
+pixel is covered) and how the outputs of the windows are blended back together, optionally
+at a different resolution (`uf` times larger or `df` times smaller, e.g. for the first stage
+decoder/encoder). Windows are weighted by their distance to the window border, so seams fade
+out, and normalized by the sum of the weights.
+
+Grids only depend on the shapes, so they are built once and cached:
+
+    grid = get_tile_grid(h, w, ks=(64, 64), stride=(48, 48), device=x.device, dtype=x.dtype)
+    out = apply_tiled(lambda crops, start, end: model(crops), x, grid, group=4)
+
+apply_tiled stacks `group` windows into the batch dimension per call, so memory is bounded by
+the window size and the group size instead of the input size.
+"""
+
+from functools import lru_cache
+
+import torch
+
+
+def border_distance(h, w):
+    """Normalized distance to the closest border, 0 at the border and 0.5 in the center."""
+    y = torch.arange(h, dtype=torch.float32).view(h, 1) / max(h - 1, 1)
+    x = torch.arange(w, dtype=torch.float32).view(1, w) / max(w - 1, 1)
+    return torch.min(torch.min(y, 1 - y), torch.min(x, 1 - x))
+
+
+def window_starts(size, k, stride):
+    starts = list(range(0, size - k + 1, stride))
+    if starts[-1] != size - k:
+        starts.append(size - k)
+    return starts
+
+
+class TileGrid(object):
+    """
+    Windows of one input shape with their blending weights.
+
+    :param h, w: input size.
+    :param ks: window size, reduced to the input size if larger.
+    :param stride: distance between windows.
+    :param uf, df: the output of a window is uf times larger / df times smaller than the window.
+    :param clip_weight: (min, max) the border distance weighting is clipped to.
+    :param tie_weight: optional (min, max) clip of an additional weighting by the distance of
+        the window to the grid border (the "tie_braker" of LatentDiffusion).
+    """
+    def __init__(self, h, w, ks, stride, uf=1, df=1, clip_weight=(0.01, 0.5), tie_weight=None,
+                 device=None, dtype=torch.float32):
+        self.in_shape = (h, w)
+        self.ks = (min(ks[0], h), min(ks[1], w))
+        self.stride = (max(1, min(stride[0], self.ks[0])), max(1, min(stride[1], self.ks[1])))
+        self.uf, self.df = uf, df
+        ys = window_starts(h, self.ks[0], self.stride[0])
+        xs = window_starts(w, self.ks[1], self.stride[1])
+        self.grid_shape = (len(ys), len(xs))
+        self.positions = [(y, x) for y in ys for x in xs]
+
+        self.out_shape = (self._scale(h), self._scale(w))
+        self.out_ks = (self._scale(self.ks[0]), self._scale(self.ks[1]))
+        weight = border_distance(*self.out_ks).clamp(*clip_weight)
+        weight = weight.expand(len(self.positions), *self.out_ks)
+        if tie_weight is not None:
+            tie = border_distance(*self.grid_shape).clamp(*tie_weight).view(-1, 1, 1)
+            weight = weight * tie
+        self.weight = weight.unsqueeze(1).to(device, dtype).contiguous()  # (L, 1, kh, kw)
+
+        normalization = torch.zeros((1, 1) + self.out_shape, device=device, dtype=dtype)
+        for l in range(len(self)):
+            y, x = self._out_window(l)
+            normalization[:, :, y, x] += self.weight[l]
+        self.normalization = normalization
+
+    def _scale(self, v):
+        return v * self.uf // self.df
+
+    def _out_window(self, l):
+        y, x = self.positions[l]
+        y, x = self._scale(y), self._scale(x)
+        return slice(y, y + self.out_ks[0]), slice(x, x + self.out_ks[1])
+
+    def __len__(self):
+        return len(self.positions)
+
+    def crop(self, x, start=0, end=None):
+        """Windows start..end of x (b, c, h, w), stacked window-major into (n * b, c, kh, kw)."""
+        kh, kw = self.ks
+        crops = [x[:, :, y:y + kh, x_:x_ + kw] for y, x_ in self.positions[start:end]]
+        return torch.cat(crops)
+
+    def paste(self, out, tiles, start=0, end=None):
+        """Adds the weighted outputs `tiles` (n * b, c, kh', kw') of windows start..end to out."""
+        end = len(self) if end is None else end
+        b = out.shape[0]
+        tiles = tiles.reshape(end - start, b, *tiles.shape[1:])
+        for i, l in enumerate(range(start, end)):
+            y, x = self._out_window(l)
+            out[:, :, y, x] += tiles[i] * self.weight[l]
+        return out
+
+    def __repr__(self):
+        return (f"TileGrid({self.in_shape} -> {self.out_shape}, {len(self)} windows of {self.ks}, "
+                f"stride {self.stride})")
+
+
+@lru_cache(maxsize=32)
+def _cached_grid(h, w, ks, stride, uf, df, clip_weight, tie_weight, device, dtype):
+    return TileGrid(h, w, ks, stride, uf, df, clip_weight, tie_weight, device, dtype)
+
+
+def get_tile_grid(h, w, ks, stride, uf=1, df=1, clip_weight=(0.01, 0.5), tie_weight=None,
+                  device=None, dtype=torch.float32):
+    """TileGrid for these arguments, only built the first time it is asked for."""
+    device = torch.device(device) if device is not None else None
+    return _cached_grid(h, w, tuple(ks), tuple(stride), uf, df, tuple(clip_weight),
+                        tuple(tie_weight) if tie_weight is not None else None, device, dtype)
+
+
+def apply_tiled(fn, x, grid, group=None):
+    """
+    Runs fn over the windows of x and blends the results.
+
+    fn(crops, start, end) gets windows start..end of x stacked into the batch dimension
+    (window-major, so anything per sample of x is expanded with .repeat(end - start, ...)) and
+    returns one output per crop. `group` windows are processed per call, all at once if None.
+    """
+    b = x.shape[0]
+    group = group or len(grid)
+    out = None
+    for start in range(0, len(grid), group):
+        end = min(start + group, len(grid))
+        tiles = fn(grid.crop(x, start, end), start, end)
+        if out is None:
+            out = tiles.new_zeros((b, tiles.shape[1]) + grid.out_shape)
+        grid.paste(out, tiles, start, end)
+    return out / grid.normalization.to(out.dtype)
@@ -74,6 +74,29 @@ def make_ddim_sampling_parameters(alphacums, ddim_timesteps, eta, verbose=True):
     return sigmas, alphas, alphas_prev
 
 
+def make_ddim_step_coefficients(alphas, alphas_prev, sigmas):
+    """
+    Coefficients of the DDIM update for every step as one float32 tensor of shape
+    (steps, 5, 1, 1, 1): sqrt(a_t), sqrt(1 - a_t), sqrt(a_prev), sqrt(1 - a_prev - sigma_t^2) and
+    sigma_t. Move it to the device once per schedule, a sampling step then only indexes it
+    instead of building tensors from host values.
+    """
+    def to_torch(v):
+        if isinstance(v, torch.Tensor):
+            v = v.detach().cpu()
+        return torch.as_tensor(np.asarray(v), dtype=torch.float64)
+
+    a, a_prev, sigma = to_torch(alphas), to_torch(alphas_prev), to_torch(sigmas)
+    coef = torch.stack([a.sqrt(), (1. - a).sqrt(), a_prev.sqrt(), (1. - a_prev - sigma ** 2).sqrt(), sigma], dim=1)
+    return coef.to(torch.float32).view(-1, 5, 1, 1, 1)
+
+
+def make_timestep_table(time_range, batch_size, device):
+    """(steps, batch_size) tensor with the timestep of every sampling step, created once per run."""
+    steps = torch.tensor([int(s) for s in time_range], dtype=torch.long, device=device)
+    return steps.view(-1, 1).repeat(1, batch_size)
+
+
 def betas_for_alpha_bar(num_diffusion_timesteps, alpha_bar, max_beta=0.999):
     """
     Create a beta schedule that discretizes the given alpha_t_bar function,
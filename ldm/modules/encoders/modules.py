@@ -1,3 +1,4 @@
+import numpy as np
 import torch
 import torch.nn as nn
 from functools import partial
@@ -227,6 +228,30 @@ class FrozenClipImageEmbedder(nn.Module):
         # x is assumed to be in range [-1,1]
         return self.model.encode_image(self.preprocess(x))
 
+    @torch.no_grad()
+    def embed(self, images, batch_size=32):
+        """
+        Unit norm embeddings (n, d) float32 on the cpu of a list of uint8 (h, w, 3) arrays, in
+        input order. Images of the same shape (see retrieval.images.bucket_shape) are batched
+        together, so a list of mixed sizes costs one pass per shape instead of one per image.
+        """
+        device = self.mean.device
+        buckets = {}
+        for i, image in enumerate(images):
+            buckets.setdefault(image.shape, []).append(i)
+        out = None
+        for ids in buckets.values():
+            for start in range(0, len(ids), batch_size):
+                batch = ids[start:start + batch_size]
+                x = torch.from_numpy(np.stack([images[i] for i in batch])).to(device)
+                x = x.permute(0, 3, 1, 2).float() / 127.5 - 1.
+                z = self(x).float()
+                z = z / torch.linalg.norm(z, dim=1, keepdim=True)
+                if out is None:
+                    out = torch.empty(len(images), z.shape[1])
+                out[batch] = z.cpu()
+        return out
+
 
 if __name__ == "__main__":
     from ldm.util import count_params
@@ -0,0 +1,192 @@
+"""
+Streaming index builds for pools that do not fit into memory.
+
+StreamingIndexBuilder reads the embeddings of a (memory-mapped) retrieval database block by
+block, normalizes and encodes every block and writes the codes to disk as segments of at most
+`segment_rows` rows, so memory is bounded by the training sample and one segment regardless of
+the pool size. index.json is rewritten after every segment, a partial build is a valid index
+of the rows ingested so far. At the end the segments are merged into a single one, partition
+by partition.
+
+    index = IVFPQIndex.train(db["embedding"], num_leaves, reorder_k=40)
+    builder = StreamingIndexBuilder("data/rdm/searchers/openimages", index)
+    builder.ingest(db["embedding"])
+    builder.finish()
+
+The same builder appends the rows a database gained since the index was built, see
+maintenance.append_rows.
+"""
+
+import json
+import os
+import time
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from ldm.modules.retrieval.index import ExactIndex, INDEX_FILE, SEGMENT_KEYS, _write_config, iter_chunks, \
+    load_segment, make_segment, normalize, save_segment
+
+
+class Throughput(object):
+    """Rows per second of a build, printed every `every` seconds."""
+    def __init__(self, total, every=10.):
+        self.total = total
+        self.every = every
+        self.rows = 0
+        self.start = self.last = time.time()
+
+    def update(self, rows):
+        self.rows += rows
+        now = time.time()
+        if now - self.last >= self.every or self.rows == self.total:
+            self.last = now
+            print(f"{self.rows}/{self.total} rows, {self.rows / max(now - self.start, 1e-6):.0f} rows/s")
+
+    def summary(self):
+        elapsed = time.time() - self.start
+        return f"{self.rows} rows in {elapsed:.1f} s, {self.rows / max(elapsed, 1e-6):.0f} rows/s"
+
+
+class StreamingIndexBuilder(object):
+    """
+    Writes the trained (still empty) IVFPQIndex `index` to path and fills it segment by segment.
+    With append set, index is the loaded index at path and new segments are added to it.
+
+    :param segment_rows: rows encoded in memory before they are sorted by partition and written.
+    """
+    def __init__(self, path, index, segment_rows=1 << 22, append=False):
+        self.path = path
+        self.index = index
+        self.segment_rows = segment_rows
+        self.pending = []
+        self.pending_rows = 0
+        if append:
+            with open(os.path.join(path, INDEX_FILE), "r") as f:
+                self.names = json.load(f)["segments"]
+            return
+        assert len(index) == 0, "the builder starts from an empty, trained index"
+        self.names = []
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "centroids.npy"), index.centroids)
+        np.save(os.path.join(path, "codebooks.npy"), index.codebooks)
+        _write_config(path, index.config(self.names))
+
+    def ingest(self, embeddings, chunk_rows=1 << 16):
+        """Encodes the rows of embeddings (an array or a database ShardedArray) not in the index yet."""
+        throughput = Throughput(len(embeddings) - self.index.next_id)
+        for start, block in iter_chunks(embeddings, chunk_rows, self.index.next_id):
+            leaves, codes = self.index.encode(block)
+            ids = np.arange(start, start + len(block))
+            self.pending.append((leaves, codes, ids))
+            self.pending_rows += len(block)
+            if self.pending_rows >= self.segment_rows:
+                self.flush()
+            throughput.update(len(block))
+        print(f"Ingested {throughput.summary()}")
+
+    def flush(self):
+        if not self.pending:
+            return
+        leaves, codes, ids = (np.concatenate(parts) for parts in zip(*self.pending))
+        self.pending, self.pending_rows = [], 0
+        name = next_segment_name(self.names)
+        save_segment(self.path, name, make_segment(leaves, codes, ids, self.index.num_leaves))
+        self.names.append(name)
+        # the config only covers the rows of the written segments
+        self.index.next_id = int(ids[-1]) + 1
+        _write_config(self.path, self.index.config(self.names))
+
+    def finish(self, merge=True):
+        """Writes the last segment, merges all of them if merge is set and returns the index."""
+        self.flush()
+        if merge and len(self.names) > 1:
+            merged = merge_segments(self.path, self.names, self.index.num_leaves)
+            old, self.names = self.names, [merged]
+            _write_config(self.path, self.index.config(self.names))
+            remove_segments(self.path, old)
+        self.index.segments = [load_segment(self.path, name) for name in self.names]
+        return self.index
+
+
+def next_segment_name(names):
+    return f"segment-{max([int(name.split('-')[1]) for name in names], default=-1) + 1:05}"
+
+
+def merge_segments(path, names, num_leaves, target=None, keep=None):
+    """
+    Merges the segments `names` of the index at path into one new segment, the old files are
+    left for remove_segments once the config points to the new one. Rows are copied partition
+    by partition straight into memory-mapped output files. keep is an optional function
+    ids -> boolean mask of the rows to keep, or a list of such functions (or None) per segment.
+    Segments may have fewer than num_leaves partitions, e.g. from before a compaction split
+    partitions. Returns the new name.
+    """
+    segments = [load_segment(path, name) for name in names]
+    keeps = keep if isinstance(keep, (list, tuple)) else [keep] * len(segments)
+    masks = [None if k is None else k(np.asarray(s["ids"])) for s, k in zip(segments, keeps)]
+    counts = np.zeros(num_leaves, dtype=np.int64)
+    for segment, mask in zip(segments, masks):
+        sizes = np.diff(segment["leaf_offsets"])
+        if mask is None:
+            counts[:len(sizes)] += sizes
+        else:
+            leaves = np.repeat(np.arange(len(sizes)), sizes)
+            counts += np.bincount(leaves[mask], minlength=num_leaves)
+    leaf_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    target = target or next_segment_name(names)
+    n, m = int(leaf_offsets[-1]), segments[0]["codes"].shape[1]
+    codes = open_memmap(os.path.join(path, f"{target}-codes.npy"), "w+", np.uint8, (n, m))
+    ids = open_memmap(os.path.join(path, f"{target}-ids.npy"), "w+", np.int64, (n,))
+    cursor = leaf_offsets[:-1].copy()
+    for segment, mask in zip(segments, masks):
+        offsets = segment["leaf_offsets"]
+        for l in np.nonzero(np.diff(offsets))[0]:
+            lo, hi = offsets[l], offsets[l + 1]
+            seg_codes, seg_ids = segment["codes"][lo:hi], segment["ids"][lo:hi]
+            if mask is not None:
+                seg_codes, seg_ids = seg_codes[mask[lo:hi]], seg_ids[mask[lo:hi]]
+            codes[cursor[l]:cursor[l] + len(seg_ids)] = seg_codes
+            ids[cursor[l]:cursor[l] + len(seg_ids)] = seg_ids
+            cursor[l] += len(seg_ids)
+    codes.flush()
+    ids.flush()
+    del codes, ids, segments
+    np.save(os.path.join(path, f"{target}-leaf_offsets.npy"), leaf_offsets)
+    return target
+
+
+def remove_segments(path, names):
+    for name in names:
+        for key in SEGMENT_KEYS:
+            f = os.path.join(path, f"{name}-{key}.npy")
+            if os.path.exists(f):
+                os.remove(f)
+
+
+def build_exact_streaming(path, embeddings, chunk_rows=1 << 16, existing=None):
+    """
+    Writes an ExactIndex of embeddings to path, normalizing them block by block. existing: the
+    already normalized first rows (the embeddings of the index being extended), copied as is.
+    The file is written next to the old one and swapped in, so searchers that have the old one
+    memory-mapped keep reading it.
+    """
+    os.makedirs(path, exist_ok=True)
+    tmp = os.path.join(path, "embeddings.tmp.npy")
+    out = open_memmap(tmp, "w+", np.float32, tuple(embeddings.shape))
+    start = 0
+    if existing is not None:
+        for start, block in iter_chunks(existing, chunk_rows):
+            out[start:start + len(block)] = block
+        start = len(existing)
+    throughput = Throughput(len(embeddings) - start)
+    for start, block in iter_chunks(embeddings, chunk_rows, start):
+        out[start:start + len(block)] = normalize(block)
+        throughput.update(len(block))
+    out.flush()
+    del out
+    os.replace(tmp, os.path.join(path, "embeddings.npy"))
+    _write_config(path, {"kind": ExactIndex.kind, "block_rows": chunk_rows})
+    print(f"Wrote exact index of {throughput.summary()}")
+    return ExactIndex.load(path, {"block_rows": chunk_rows})
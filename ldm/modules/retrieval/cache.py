@@ -0,0 +1,77 @@
+"""
+Prompt level cache of retrieval results.
+
+Batch jobs often repeat prompts (--n_iter, prompt files with duplicates), and every repeat
+used to run the CLIP text encoder and the nearest neighbor search again. CachedRetriever
+keeps the query embedding and the neighbor ids of the last `max_entries` (prompt, k) pairs,
+so a repeated prompt only costs the gather of its neighbor embeddings.
+
+    retrieve = CachedRetriever(clip_text_encoder.encode, searcher, opt.knn)
+    c, neighbors = retrieve(prompts)    # (b, 1, d) tensor, (b, k, d) float32 array
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+class RetrievalCache(object):
+    """LRU of (prompt, k) -> (query embedding on the cpu, neighbor ids)."""
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, prompt, k):
+        entry = self.entries.get((prompt, k))
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end((prompt, k))
+        self.hits += 1
+        return entry
+
+    def put(self, prompt, k, embedding, nns):
+        if self.max_entries <= 0:
+            return
+        self.entries[(prompt, k)] = (embedding, nns)
+        self.entries.move_to_end((prompt, k))
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        return f"{self.hits} hits, {self.misses} misses, {len(self.entries)} cached prompts"
+
+
+class CachedRetriever(object):
+    """
+    :param encode: prompts -> (b, 1, d) query embeddings, e.g. FrozenCLIPTextEmbedder.encode.
+    :param searcher: knn2img.Searcher, or anything with neighbor_ids(queries, k) -> (nns, seconds)
+        and a retrieval database as `database`.
+    """
+    def __init__(self, encode, searcher, knn, max_entries=1024):
+        self.encode = encode
+        self.searcher = searcher
+        self.knn = knn
+        self.cache = RetrievalCache(max_entries)
+        self.search_time = 0.
+
+    def __call__(self, prompts):
+        entries = [self.cache.get(p, self.knn) for p in prompts]
+        # every missing prompt is encoded and searched once, even if it repeats within the batch
+        missing = list(OrderedDict.fromkeys(p for p, e in zip(prompts, entries) if e is None))
+        if missing:
+            with torch.no_grad():
+                c = self.encode(missing)
+            nns, seconds = self.searcher.neighbor_ids(c, self.knn)
+            self.search_time += seconds
+            found = {}
+            for i, p in enumerate(missing):
+                found[p] = (c[i:i + 1].cpu(), nns[i])
+                self.cache.put(p, self.knn, *found[p])
+            entries = [found[p] if e is None else e for p, e in zip(prompts, entries)]
+        c = torch.cat([e[0] for e in entries])
+        nns = np.stack([e[1] for e in entries])
+        return c, self.searcher.database.neighbor_embeddings(nns)
@@ -0,0 +1,303 @@
+"""
+Memory-mapped retrieval databases.
+
+A database is a directory of raw .npy shards, one file per key and shard, plus a manifest:
+
+    openimages/
+        manifest.json
+        embedding-00000.npy     (n_0, d) float32 CLIP embeddings
+        img_id-00000.npy        (n_0,)
+        patch_coords-00000.npy  (n_0, 4)
+        embedding-00001.npy
+        ...
+
+    manifest.json = {"version": 1,
+                     "normalized": true,
+                     "keys": {"embedding": {"dtype": "float32", "shape": [768]}, ...},
+                     "shards": [{"rows": n_0, "files": {"embedding": "embedding-00000.npy", ...}}, ...]}
+
+With "normalized" set the embeddings are stored with unit norm, so neighbor embeddings can be
+used as read instead of being renormalized on every lookup.
+
+The shards are opened with np.load(mmap_mode="r"), so opening a database is instant and a
+neighbor lookup only reads the rows it returns. Directories with the old .npz files are still
+readable, but are loaded into memory (by parallel workers); convert them once with
+
+    python scripts/convert_retrieval_database.py data/rdm/retrieval_databases/openimages --normalize
+"""
+
+import glob
+import json
+import os
+import zipfile
+from functools import partial
+
+import numpy as np
+from tqdm import tqdm
+
+MANIFEST = "manifest.json"
+VERSION = 1
+
+
+class ShardedArray(object):
+    """One key of a database, indexed like a single array by global row numbers."""
+    def __init__(self, shards, offsets):
+        self.shards = shards
+        self.offsets = offsets
+        self.shape = (int(offsets[-1]),) + tuple(shards[0].shape[1:])
+        self.dtype = shards[0].dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __getitem__(self, rows):
+        """Rows of any integer index array (e.g. (b, k) neighbor ids), a slice or a single row."""
+        if isinstance(rows, slice):
+            if rows.step in (None, 1):
+                return self.read(*rows.indices(len(self))[:2])
+            rows = np.arange(len(self))[rows]
+        rows = np.asarray(rows)
+        if rows.ndim == 0:
+            shard = int(np.searchsorted(self.offsets, rows, "right")) - 1
+            return np.asarray(self.shards[shard][rows - self.offsets[shard]])
+        flat = rows.reshape(-1)
+        out = np.empty((len(flat),) + self.shape[1:], dtype=self.dtype)
+        shard_of = np.searchsorted(self.offsets, flat, "right") - 1
+        for shard in np.unique(shard_of):
+            sel = np.nonzero(shard_of == shard)[0]
+            local = flat[sel] - self.offsets[shard]
+            # read the rows in file order, then put them back in query order
+            order = np.argsort(local, kind="stable")
+            out[sel[order]] = self.shards[shard][local[order]]
+        return out.reshape(rows.shape + self.shape[1:])
+
+    def read(self, start, end):
+        """Rows start..end as one in-memory array."""
+        parts = []
+        for shard, (lo, hi) in enumerate(zip(self.offsets[:-1], self.offsets[1:])):
+            if hi > start and lo < end:
+                parts.append(np.asarray(self.shards[shard][max(start, lo) - lo:min(end, hi) - lo]))
+        if not parts:
+            return np.empty((0,) + self.shape[1:], dtype=self.dtype)
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def chunks(self, chunk_rows=1 << 16, start=0):
+        """Yields (start, rows) for consecutive blocks of at most chunk_rows rows from row start on."""
+        for start in range(start, len(self), chunk_rows):
+            yield start, self.read(start, min(start + chunk_rows, len(self)))
+
+
+class RetrievalDatabase(object):
+    """
+    A retrieval database of equally long arrays per key ("embedding", "img_id",
+    "patch_coords"), backed by memory-mapped shards. db["embedding"][nns] returns the rows
+    of the neighbor ids nns.
+    """
+    def __init__(self, shards, path=None, normalized=False):
+        assert len(shards) > 0, "a retrieval database needs at least one shard"
+        self.path = path
+        self.normalized = normalized
+        self.keys = list(shards[0].keys())
+        offsets = np.cumsum([0] + [len(shard[self.keys[0]]) for shard in shards])
+        self.arrays = {key: ShardedArray([shard[key] for shard in shards], offsets) for key in self.keys}
+
+    def __getitem__(self, key):
+        return self.arrays[key]
+
+    def __contains__(self, key):
+        return key in self.arrays
+
+    def __len__(self):
+        return len(self.arrays[self.keys[0]])
+
+    @property
+    def dim(self):
+        return self.arrays["embedding"].shape[1]
+
+    def normalized_embeddings(self, chunk_rows=1 << 16):
+        """All embeddings with unit norm as one float32 array, filled block by block."""
+        embeddings = self.arrays["embedding"]
+        out = np.empty(embeddings.shape, dtype=np.float32)
+        for start, block in embeddings.chunks(chunk_rows):
+            out[start:start + len(block)] = block if self.normalized else normalize_rows(block)
+        return out
+
+    def gather(self, key, nns):
+        """Rows of key for the neighbor ids nns, zeros for the missing neighbors (id -1)."""
+        nns = np.asarray(nns)
+        array = self.arrays[key]
+        valid = nns >= 0
+        if valid.all():
+            return array[nns]
+        out = np.zeros(nns.shape + array.shape[1:], dtype=array.dtype)
+        out[valid] = array[nns[valid]]
+        return out
+
+    def neighbor_embeddings(self, nns):
+        """
+        Unit norm float32 embeddings of the neighbor ids nns, e.g. (b, k) -> (b, k, d). Missing
+        neighbors are zero, like the unconditional conditioning.
+        """
+        out = self.gather("embedding", nns).astype(np.float32)
+        if self.normalized:
+            return out
+        norm = np.linalg.norm(out, axis=-1, keepdims=True)
+        return out / np.where(norm > 0, norm, 1.)
+
+    @classmethod
+    def open(cls, path):
+        with open(os.path.join(path, MANIFEST), "r") as f:
+            manifest = json.load(f)
+        assert manifest.get("version") == VERSION, f"unsupported retrieval database version in {path}"
+        shards = [{key: np.load(os.path.join(path, name), mmap_mode="r") for key, name in shard["files"].items()}
+                  for shard in manifest["shards"]]
+        return cls(shards, path, manifest.get("normalized", False))
+
+
+def normalize_rows(x):
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.linalg.norm(x, axis=-1, keepdims=True)
+
+
+def npz_files(path):
+    # glob order, the order the npz loaders always concatenated the files in and the one the
+    # row ids of already trained searchers refer to
+    return glob.glob(os.path.join(path, "*.npz"))
+
+
+def npz_headers(f):
+    """{key: (shape, dtype)} of the arrays in the .npz file f, read without loading them."""
+    headers = {}
+    with zipfile.ZipFile(f) as z:
+        for name in z.namelist():
+            with z.open(name) as member:
+                version = np.lib.format.read_magic(member)
+                read = np.lib.format.read_array_header_1_0 if version == (1, 0) else \
+                    np.lib.format.read_array_header_2_0
+                shape, _, dtype = read(member)
+            headers[name[:-len(".npy")] if name.endswith(".npy") else name] = (shape, dtype)
+    return headers
+
+
+def _load_npz_key(f, key):
+    with np.load(f) as compressed:
+        return compressed[key]
+
+
+def load_npz(files, n_proc=None):
+    """
+    The arrays of the .npz files concatenated per key. Worker processes decompress the files
+    and write them straight into one shared output array per key, in file order.
+    """
+    from ldm.util import parallel_fill
+    n_proc = n_proc or min(8, os.cpu_count() or 1)
+    headers = [npz_headers(f) for f in files]
+    keys = list(headers[0])
+    rows = [h[keys[0]][0][0] for h in headers]
+    arrays = {}
+    for key in keys:
+        shape, dtype = headers[0][key]
+        arrays[key] = parallel_fill(partial(_load_npz_key, key=key), files, rows, shape[1:], dtype, n_proc,
+                                    desc=f"Loading {key}")
+    return arrays
+
+
+def open_database(path, n_proc=None):
+    """Opens the database at path, memory-mapped if converted, else by loading its .npz files."""
+    if os.path.exists(os.path.join(path, MANIFEST)):
+        db = RetrievalDatabase.open(path)
+    else:
+        files = npz_files(path)
+        if not files:
+            raise ValueError(f'No retrieval database or npz-files in "{path}", is this directory existing?')
+        print(f"Loading {len(files)} npz files into memory, "
+              f"convert them with scripts/convert_retrieval_database.py to memory-map them instead")
+        db = RetrievalDatabase([load_npz(files, n_proc)], path)
+    print(f"Opened retrieval database of length {len(db)} from {path}")
+    return db
+
+
+class DatabaseWriter(object):
+    """
+    Writes a database shard by shard. The manifest is rewritten after every shard, so a
+    database is readable (and can be appended to) at any point. With normalize set the
+    embeddings are stored with unit norm, appending to a normalized database keeps it so.
+    """
+    def __init__(self, path, append=False, normalize=False):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.manifest = {"version": VERSION, "normalized": normalize, "keys": {}, "shards": []}
+        manifest_path = os.path.join(path, MANIFEST)
+        if append and os.path.exists(manifest_path):
+            with open(manifest_path, "r") as f:
+                self.manifest = json.load(f)
+            self.manifest.setdefault("normalized", False)
+
+    def __len__(self):
+        return sum(shard["rows"] for shard in self.manifest["shards"])
+
+    def write_shard(self, arrays, **info):
+        """Adds a shard from a dict of equally long arrays, one per key. info is kept in its manifest entry."""
+        rows = {len(v) for v in arrays.values()}
+        assert len(rows) == 1, "all arrays of a shard need the same number of rows"
+        keys = {key: {"dtype": np.dtype(v.dtype).str, "shape": list(v.shape[1:])} for key, v in arrays.items()}
+        if self.manifest["keys"]:
+            assert keys == self.manifest["keys"], f"shard does not match the keys of {self.path}"
+        if self.manifest["normalized"] and "embedding" in arrays:
+            embedding = arrays["embedding"]
+            arrays = dict(arrays, embedding=normalize_rows(embedding).astype(embedding.dtype))
+        index = len(self.manifest["shards"])
+        files = {}
+        for key, value in arrays.items():
+            files[key] = f"{key}-{index:05}.npy"
+            np.save(os.path.join(self.path, files[key]), np.ascontiguousarray(value))
+        self.manifest["keys"] = keys
+        shard = {"rows": rows.pop(), "files": files}
+        if info:
+            shard["info"] = info
+        self.manifest["shards"].append(shard)
+        self._save_manifest()
+
+    def _save_manifest(self):
+        tmp = os.path.join(self.path, MANIFEST + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(tmp, os.path.join(self.path, MANIFEST))
+
+
+def convert_npz(src, dst=None, normalize=False):
+    """
+    Converts the .npz files of a retrieval database directory into .npy shards plus manifest,
+    one shard per file, in the directory dst (default: src itself). Only one file is held in
+    memory at a time.
+    """
+    dst = dst or src
+    files = npz_files(src)
+    if not files:
+        raise ValueError(f'No npz-files in "{src}"')
+    writer = DatabaseWriter(dst, normalize=normalize)
+    for f in tqdm(files, desc="Converting"):
+        with np.load(f) as compressed:
+            writer.write_shard({key: compressed[key] for key in compressed.files})
+    print(f"Wrote {len(writer)} rows in {len(files)} shards to {dst}")
+    return dst
+
+
+def normalize_database(path, chunk_rows=1 << 16):
+    """Rescales the embeddings of a converted database to unit norm in place, shard by shard."""
+    writer = DatabaseWriter(path, append=True)
+    if writer.manifest["normalized"]:
+        print(f"{path} is already normalized")
+        return
+    for shard in tqdm(writer.manifest["shards"], desc="Normalizing"):
+        embedding = np.load(os.path.join(path, shard["files"]["embedding"]), mmap_mode="r+")
+        for start in range(0, len(embedding), chunk_rows):
+            embedding[start:start + chunk_rows] = normalize_rows(embedding[start:start + chunk_rows])
+        embedding.flush()
+        del embedding
+    writer.manifest["normalized"] = True
+    writer._save_manifest()
@@ -0,0 +1,140 @@
+"""
+Image loading for CLIP image queries and for building retrieval databases from image folders
+and tar shards.
+
+Decoding is the slow part of embedding many images, so ImageLoader decodes them in worker
+processes, in order. Every image is resized on the cpu to a shape bucket (short side `side`,
+both sides multiples of `step`), so images of similar aspect ratio end up with the same
+shape and FrozenClipImageEmbedder.embed can batch them.
+
+Images inside (uncompressed) tar files are listed once with their data offsets, the workers
+then read every image with a single seek instead of scanning the tar.
+"""
+
+import io
+import multiprocessing as mp
+import os
+import tarfile
+from collections import deque, namedtuple
+from functools import partial
+
+import numpy as np
+from PIL import Image
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+
+
+# an image inside a tar file, offset and size of its data
+TarMember = namedtuple("TarMember", "tar name offset size")
+
+
+def is_image(path):
+    return path.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def list_tar(path):
+    with tarfile.open(path, "r:") as tar:
+        return [TarMember(path, m.name, m.offset_data, m.size) for m in tar if m.isfile() and is_image(m.name)]
+
+
+def list_images(path):
+    """
+    Images of a single image or tar file, a text file with one path per line or a folder
+    (recursively, sorted, including the images in its .tar files). Items are paths or TarMembers.
+    """
+    if os.path.isfile(path):
+        if is_image(path):
+            return [path]
+        if path.endswith(".tar"):
+            return list_tar(path)
+        with open(path, "r") as f:
+            return [line.strip() for line in f if line.strip()]
+    items = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for f in sorted(files):
+            if is_image(f):
+                items.append(os.path.join(root, f))
+            elif f.endswith(".tar"):
+                items.extend(list_tar(os.path.join(root, f)))
+    return items
+
+
+def item_id(item, root=""):
+    """Path of an image relative to root, tar members as <tar path>/<member name>."""
+    path = os.path.join(item.tar, item.name) if isinstance(item, TarMember) else item
+    return os.path.relpath(path, root) if root else path
+
+
+# open tar files of a decoding process
+_tars = {}
+
+
+def read_member(member):
+    f = _tars.get(member.tar)
+    if f is None:
+        f = _tars[member.tar] = open(member.tar, "rb")
+    f.seek(member.offset)
+    return f.read(member.size)
+
+
+def bucket_shape(h, w, side=256, step=32):
+    s = side / min(h, w)
+    return max(step, int(round(h * s / step)) * step), max(step, int(round(w * s / step)) * step)
+
+
+def prepare_image(image, side=256, step=32):
+    """A PIL image as a uint8 (h, w, 3) array resized to its shape bucket."""
+    image = image.convert("RGB")
+    h, w = bucket_shape(image.height, image.width, side, step)
+    return np.asarray(image.resize((w, h), resample=Image.BICUBIC))
+
+
+def load_image(item, side=256, step=32):
+    """prepare_image of the image file or TarMember item, None if it can not be read."""
+    try:
+        source = io.BytesIO(read_member(item)) if isinstance(item, TarMember) else item
+        with Image.open(source) as image:
+            return prepare_image(image, side, step)
+    except Exception as e:
+        print(f"Skipping {item_id(item)}: {e}")
+        return None
+
+
+def load_images(items, load):
+    return [load(item) for item in items]
+
+
+class ImageLoader(object):
+    """
+    Yields (item, array or None) for every item, decoded by `workers` processes (0: in process).
+    At most `lookahead` images (default 4 chunks per worker) are decoded ahead of the consumer,
+    so a slow consumer does not pile up decoded images in memory.
+    """
+    def __init__(self, items, workers=4, side=256, step=32, chunksize=16, lookahead=None):
+        self.items = items
+        self.workers = workers
+        self.load = partial(load_image, side=side, step=step)
+        self.chunksize = chunksize
+        self.lookahead = lookahead or 4 * max(workers, 1) * chunksize
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        if self.workers <= 0:
+            for item in self.items:
+                yield item, self.load(item)
+            return
+        max_pending = max(self.lookahead // self.chunksize, 1)
+        with mp.Pool(self.workers) as pool:
+            pending = deque()
+            for start in range(0, len(self.items), self.chunksize):
+                chunk = self.items[start:start + self.chunksize]
+                pending.append((chunk, pool.apply_async(load_images, (chunk, self.load))))
+                if len(pending) >= max_pending:
+                    chunk, result = pending.popleft()
+                    yield from zip(chunk, result.get())
+            while pending:
+                chunk, result = pending.popleft()
+                yield from zip(chunk, result.get())
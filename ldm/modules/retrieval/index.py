@@ -0,0 +1,459 @@
+"""
+Built-in nearest neighbor indices for the retrieval searcher, in plain NumPy.
+
+Both indices search unit norm embeddings by dot product and have the search_batched
+interface of the scaNN searchers, so they can be used wherever a scaNN searcher is:
+
+    nns, distances = index.search_batched(queries, final_num_neighbors=k)
+
+    ExactIndex      blocked matrix multiply top-k over all rows, for small pools
+    IVFPQIndex      k-means partitions (inverted file) with product quantized residuals,
+                    only the `num_leaves_to_search` closest partitions are scored from their
+                    8 bit codes and the best `reorder_k` candidates are rescored exactly
+
+build_index picks one by pool size like train_searcher.py does for scaNN, save/load_index
+store an index as a directory with an index.json next to its arrays. Indices of pools too
+large for memory are built with builder.StreamingIndexBuilder.
+
+Removed rows are tombstoned: their ids are listed in tombstones.npy and skipped by the
+searches until the index is compacted (see maintenance.py).
+
+If an index has fewer than k live rows, the missing neighbors have id -1 and score -inf,
+RetrievalDatabase.gather fills them with zeros.
+"""
+
+import json
+import os
+
+import numpy as np
+
+INDEX_FILE = "index.json"
+TOMBSTONE_FILE = "tombstones.npy"
+# written by benchmarks/searchers.py, see load_recommended
+RECOMMENDED_FILE = "recommended.json"
+
+
+def normalize(x):
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.maximum(np.linalg.norm(x, axis=-1, keepdims=True), 1e-12)
+
+
+def merge_topk(scores, ids, k):
+    """The k highest scores per row of (b, n) scores and their ids (b, n), sorted descending."""
+    if scores.shape[1] > k:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, part, 1)
+        ids = np.take_along_axis(ids, part, 1)
+    order = np.argsort(-scores, axis=1, kind="stable")
+    return np.take_along_axis(scores, order, 1), np.take_along_axis(ids, order, 1)
+
+
+def blocked_topk(queries, data, k, block_rows=1 << 16, normalize_rows=False, exclude=None):
+    """
+    Exact top-k of queries (b, d) against the rows of data by dot product, block_rows rows at
+    a time so only a (b, block_rows) score matrix exists at once. data can be an array or
+    anything with a chunks(block_rows) method like a database ShardedArray. Rows in the sorted
+    id array exclude are skipped.
+    """
+    b = queries.shape[0]
+    best = np.full((b, 0), -np.inf, dtype=np.float32)
+    best_ids = np.zeros((b, 0), dtype=np.int64)
+    for start, block in iter_chunks(data, block_rows):
+        block = normalize(block) if normalize_rows else np.asarray(block, dtype=np.float32)
+        scores = queries @ block.T
+        if exclude is not None and len(exclude):
+            scores[:, np.isin(np.arange(start, start + len(block)), exclude)] = -np.inf
+        ids = np.broadcast_to(np.arange(start, start + len(block)), scores.shape)
+        best, best_ids = merge_topk(np.concatenate([best, scores], 1), np.concatenate([best_ids, ids], 1), k)
+    return best_ids, best
+
+
+def kmeans(x, k, iters=10, spherical=False, seed=0, block_rows=1 << 16):
+    """Lloyd's k-means of the rows of x, spherical k-means (unit norm centroids, dot product) if set."""
+    rng = np.random.default_rng(seed)
+    x = np.asarray(x, dtype=np.float32)
+    centroids = x[rng.choice(len(x), k, replace=len(x) < k)].copy()
+    for _ in range(iters):
+        assign = assign_clusters(x, centroids, spherical, block_rows)
+        counts = np.bincount(assign, minlength=k)
+        # per cluster sums from the rows sorted by cluster
+        order = np.argsort(assign, kind="stable")
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        sums = np.zeros_like(centroids)
+        filled = counts > 0
+        sums[filled] = np.add.reduceat(x[order], starts[filled], axis=0)
+        empty = counts == 0
+        # restart empty clusters from random points
+        sums[empty] = x[rng.choice(len(x), int(empty.sum()))]
+        counts[empty] = 1
+        centroids = sums / counts[:, None]
+        if spherical:
+            centroids = normalize(centroids)
+    return centroids
+
+
+def assign_clusters(x, centroids, spherical=False, block_rows=1 << 16):
+    out = np.empty(len(x), dtype=np.int64)
+    c_sq = (centroids ** 2).sum(1)
+    for start in range(0, len(x), block_rows):
+        block = np.asarray(x[start:start + block_rows], dtype=np.float32)
+        scores = block @ centroids.T
+        if not spherical:
+            # argmin |x - c|^2 = argmax x.c - |c|^2 / 2
+            scores -= c_sq / 2
+        out[start:start + len(block)] = scores.argmax(1)
+    return out
+
+
+class ExactIndex(object):
+    """Brute force dot product search over unit norm embeddings (n, d)."""
+    kind = "exact"
+
+    def __init__(self, embeddings, block_rows=1 << 16, deleted=None):
+        self.embeddings = embeddings
+        self.block_rows = block_rows
+        self.deleted = deleted
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def search_batched(self, queries, final_num_neighbors=10):
+        k = final_num_neighbors
+        ids, scores = blocked_topk(normalize(queries), self.embeddings, k, self.block_rows, exclude=self.deleted)
+        nns = np.full((len(queries), k), -1, dtype=np.int64)
+        distances = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        n = min(k, ids.shape[1])
+        # excluded rows only reach the top k with a score of -inf
+        nns[:, :n] = np.where(np.isneginf(scores[:, :n]), -1, ids[:, :n])
+        distances[:, :n] = scores[:, :n]
+        return nns, distances
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "embeddings.npy"), np.asarray(self.embeddings, dtype=np.float32))
+        save_tombstones(path, self.deleted)
+        _write_config(path, {"kind": self.kind, "block_rows": self.block_rows})
+
+    @classmethod
+    def load(cls, path, config):
+        return cls(np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r"), config["block_rows"],
+                   load_tombstones(path))
+
+
+def iter_chunks(embeddings, chunk_rows=1 << 16, start=0):
+    """(start, rows) blocks of an array or a database ShardedArray, from row start on."""
+    if hasattr(embeddings, "chunks"):
+        return embeddings.chunks(chunk_rows, start)
+    return ((s, embeddings[s:s + chunk_rows]) for s in range(start, len(embeddings), chunk_rows))
+
+
+def load_tombstones(path):
+    """Sorted ids of the removed rows of the index at path, None if there are none."""
+    f = os.path.join(path, TOMBSTONE_FILE)
+    return np.load(f) if os.path.exists(f) else None
+
+
+def save_tombstones(path, ids):
+    f = os.path.join(path, TOMBSTONE_FILE)
+    if ids is None or len(ids) == 0:
+        if os.path.exists(f):
+            os.remove(f)
+        return
+    np.save(f + ".tmp.npy", np.unique(ids).astype(np.int64))
+    os.replace(f + ".tmp.npy", f)
+
+
+def make_segment(leaves, codes, ids, num_leaves):
+    """A segment of an IVFPQIndex from the partition, codes and row id of every row."""
+    order = np.argsort(leaves, kind="stable")
+    leaf_offsets = np.concatenate([[0], np.cumsum(np.bincount(leaves, minlength=num_leaves))]).astype(np.int64)
+    return {"codes": codes[order], "ids": ids[order].astype(np.int64), "leaf_offsets": leaf_offsets}
+
+
+SEGMENT_KEYS = ("codes", "ids", "leaf_offsets")
+
+
+def save_segment(path, name, segment):
+    for key in SEGMENT_KEYS:
+        np.save(os.path.join(path, f"{name}-{key}.npy"), segment[key])
+
+
+def load_segment(path, name):
+    return {key: np.load(os.path.join(path, f"{name}-{key}.npy"), mmap_mode="r") for key in SEGMENT_KEYS}
+
+
+class IVFPQIndex(object):
+    """
+    Inverted file index with product quantization.
+
+    The pool is split into num_leaves k-means partitions. The residual of every embedding to
+    its partition centroid is cut into pieces of dims_per_block dimensions, each stored as the
+    8 bit id of the closest of 256 subspace centroids. For a query q the score of a row x in
+    partition c is approximated by q.c + sum_j q_j.codebook_j[code_j], a table lookup per
+    subspace.
+
+    The codes live in one or more segments, each sorted by partition with its own
+    leaf_offsets, so an index can be built and stored piece by piece (see builder.py).
+
+    :param reorder: optional (n, d) array-like the candidates are rescored from exactly, e.g.
+        the embeddings of a retrieval database (normalized on the fly).
+    """
+    kind = "ivfpq"
+
+    def __init__(self, centroids, codebooks, segments=(), num_leaves_to_search=None, reorder_k=None,
+                 reorder=None, next_id=0, deleted=None):
+        self.centroids = centroids            # (L, d)
+        self.codebooks = codebooks            # (m, 256, d / m)
+        # dicts of codes (n, m) uint8 sorted by partition, ids (n,) and leaf_offsets (L + 1,)
+        self.segments = list(segments)
+        self.num_leaves_to_search = num_leaves_to_search or max(len(centroids) // 20, 1)
+        self.reorder_k = reorder_k
+        self.reorder = reorder
+        # first database row not in the index yet, and the sorted ids of removed rows
+        self.next_id = next_id
+        self.deleted = deleted
+
+    def __len__(self):
+        return sum(len(segment["ids"]) for segment in self.segments)
+
+    @property
+    def num_leaves(self):
+        return len(self.centroids)
+
+    @classmethod
+    def train(cls, embeddings, num_leaves=None, dims_per_block=2, training_sample_size=None,
+              num_leaves_to_search=None, reorder_k=None, iters=10, seed=0):
+        """
+        Trains the partition centroids and the codebooks on a random sample of the embeddings
+        (n, d), an array or a database ShardedArray. The returned index is still empty, see add.
+        """
+        n, d = embeddings.shape
+        num_leaves = num_leaves or int(np.sqrt(n))
+        assert d % dims_per_block == 0, f"{d} dims can not be split into blocks of {dims_per_block}"
+        num_subspaces = d // dims_per_block
+        rng = np.random.default_rng(seed)
+        # at most 512k samples by default, so training memory does not grow with the pool
+        sample_size = min(n, training_sample_size or min(max(n // 10, 256 * 39), 1 << 19))
+        sample = normalize(embeddings[np.sort(rng.choice(n, sample_size, replace=False))])
+
+        print(f"Training {num_leaves} partitions on {sample_size} samples")
+        centroids = kmeans(sample, num_leaves, iters, spherical=True, seed=seed)
+        residuals = sample - centroids[assign_clusters(sample, centroids, spherical=True)]
+        print(f"Training product quantization with {num_subspaces} subspaces")
+        sub = residuals.reshape(sample_size, num_subspaces, -1)
+        codebooks = np.stack([kmeans(sub[:, j], 256, iters, seed=seed + j) for j in range(num_subspaces)])
+        return cls(centroids, codebooks, (), num_leaves_to_search, reorder_k)
+
+    def encode(self, block):
+        """Partition and codes of every row of block."""
+        block = normalize(block)
+        leaves = assign_clusters(block, self.centroids, spherical=True)
+        return leaves, encode_pq(block - self.centroids[leaves], self.codebooks)
+
+    def add(self, embeddings, chunk_rows=1 << 16):
+        """Encodes the rows of embeddings as one new in-memory segment with the next row ids."""
+        leaves, codes = [], []
+        for _, block in iter_chunks(embeddings, chunk_rows):
+            l, c = self.encode(block)
+            leaves.append(l)
+            codes.append(c)
+        leaves, codes = np.concatenate(leaves), np.concatenate(codes)
+        ids = np.arange(self.next_id, self.next_id + len(leaves))
+        self.next_id += len(leaves)
+        self.segments.append(make_segment(leaves, codes, ids, self.num_leaves))
+        return self
+
+    def _candidates(self, probe):
+        """Codes, ids and partition of all rows in the partitions `probe` of every segment."""
+        codes, ids, leaves = [], [], []
+        for segment in self.segments:
+            offsets = segment["leaf_offsets"]
+            for l in probe:
+                # segments written before a compaction split partitions have fewer of them
+                if l + 1 >= len(offsets):
+                    continue
+                lo, hi = offsets[l], offsets[l + 1]
+                if hi > lo:
+                    codes.append(segment["codes"][lo:hi])
+                    ids.append(segment["ids"][lo:hi])
+                    leaves.append(np.full(hi - lo, l))
+        if not ids:
+            return None
+        codes, ids, leaves = np.concatenate(codes), np.concatenate(ids), np.concatenate(leaves)
+        if self.deleted is not None and len(self.deleted):
+            alive = ~np.isin(ids, self.deleted)
+            codes, ids, leaves = codes[alive], ids[alive], leaves[alive]
+        return codes, ids, leaves
+
+    def _score(self, coarse, luts, probes, n_keep):
+        """
+        Top n_keep approximate scores and ids (b, <= n_keep) of every query over the rows of its
+        partitions probes (b, p), plus the number of rows each query saw. The rows of all
+        partitions any query probes are gathered once for the whole batch, then every (query,
+        row) pair of a probed partition is scored in one vectorized pass.
+        """
+        b, m = len(probes), self.codebooks.shape[0]
+        candidates = self._candidates(np.unique(probes))
+        if candidates is None:
+            return np.full((b, 0), -np.inf, dtype=np.float32), np.zeros((b, 0), dtype=np.int64), np.zeros(b, np.int64)
+        codes, ids, leaves = candidates
+        order = np.argsort(leaves, kind="stable")
+        # (m, n) codes, so the codes of one subspace are contiguous
+        codes, ids, leaves = np.ascontiguousarray(codes[order].T), ids[order], leaves[order]
+        bounds = np.searchsorted(leaves, np.arange(self.num_leaves + 1))
+        starts, sizes = bounds[probes], bounds[probes + 1] - bounds[probes]
+        counts = sizes.sum(1)
+        # pair p: query q[p] and candidate row r[p], grouped by query
+        total = int(counts.sum())
+        q = np.repeat(np.arange(b), counts)
+        run_starts = np.cumsum(sizes.ravel()) - sizes.ravel()
+        r = np.arange(total) - np.repeat(run_starts - starts.ravel(), sizes.ravel())
+        scores = coarse[q, leaves[r]]
+        # one flat float32 table per subspace, so every lookup is a 1d take
+        tables = np.ascontiguousarray(luts.transpose(1, 0, 2), dtype=np.float32).reshape(m, -1)
+        base = q * luts.shape[2]
+        for j in range(m):
+            scores += tables[j].take(base + codes[j].take(r))
+        # (b, most rows of a query) matrix of the pairs, padded with -inf
+        col = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        padded = np.full((b, max(int(counts.max()), 1)), -np.inf, dtype=np.float32)
+        padded_ids = np.full(padded.shape, -1, dtype=np.int64)
+        padded[q, col], padded_ids[q, col] = scores, ids[r]
+        best, best_ids = merge_topk(padded, padded_ids, n_keep)
+        return best, best_ids, counts
+
+    def search_batched(self, queries, final_num_neighbors=10):
+        k = final_num_neighbors
+        queries = normalize(queries)
+        coarse = queries @ self.centroids.T
+        n_probe = min(self.num_leaves_to_search, self.num_leaves)
+        probes = np.argpartition(-coarse, n_probe - 1, axis=1)[:, :n_probe]
+        m = self.codebooks.shape[0]
+        # (b, m, 256) dot products of the query pieces with the subspace centroids
+        luts = np.einsum("bmd,mcd->bmc", queries.reshape(len(queries), m, -1), self.codebooks)
+        n_keep = k if self.reorder is None else max(k, self.reorder_k or 2 * k)
+
+        scores = np.full((len(queries), n_keep), -np.inf, dtype=np.float32)
+        ids = np.full((len(queries), n_keep), -1, dtype=np.int64)
+        best, best_ids, counts = self._score(coarse, luts, probes, n_keep)
+        scores[:, :best.shape[1]], ids[:, :best.shape[1]] = best, best_ids
+        for i in np.nonzero(counts < k)[0] if n_probe < self.num_leaves else ():
+            # too few live rows in the closest partitions, widen the search of this query until there are k
+            order = np.argsort(-coarse[i])
+            n = n_probe
+            while counts[i] < k and n < self.num_leaves:
+                n = min(2 * n, self.num_leaves)
+                best, best_ids, count = self._score(coarse[i:i + 1], luts[i:i + 1], order[None, :n], n_keep)
+                counts[i] = count[0]
+            scores[i], ids[i] = -np.inf, -1
+            scores[i, :best.shape[1]], ids[i, :best.shape[1]] = best[0], best_ids[0]
+
+        if self.reorder is not None:
+            valid = ~np.isneginf(scores)
+            exact = np.full(scores.shape, -np.inf, dtype=np.float32)
+            if valid.any():
+                # every candidate row is read once for the whole batch, in id order
+                unique, inverse = np.unique(ids[valid], return_inverse=True)
+                rows = normalize(self.reorder[unique])
+                exact[valid] = np.einsum("nd,nd->n", rows[inverse], queries[np.nonzero(valid)[0]])
+            scores, ids = merge_topk(exact, ids, k)
+
+        nns = np.where(np.isneginf(scores[:, :k]), -1, ids[:, :k])
+        return nns, scores[:, :k]
+
+    def config(self, segments):
+        return {"kind": self.kind, "num_leaves_to_search": self.num_leaves_to_search,
+                "reorder_k": self.reorder_k, "next_id": int(self.next_id), "segments": segments}
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "centroids.npy"), self.centroids)
+        np.save(os.path.join(path, "codebooks.npy"), self.codebooks)
+        names = [f"segment-{i:05}" for i in range(len(self.segments))]
+        for name, segment in zip(names, self.segments):
+            save_segment(path, name, segment)
+        save_tombstones(path, self.deleted)
+        _write_config(path, self.config(names))
+
+    @classmethod
+    def load(cls, path, config):
+        segments = [load_segment(path, name) for name in config["segments"]]
+        next_id = config.get("next_id", sum(len(s["ids"]) for s in segments))
+        return cls(np.load(os.path.join(path, "centroids.npy")), np.load(os.path.join(path, "codebooks.npy")),
+                   segments, config["num_leaves_to_search"], config["reorder_k"], next_id=next_id,
+                   deleted=load_tombstones(path))
+
+
+def encode_pq(residuals, codebooks):
+    """8 bit codes (n, m) of residuals (n, d) for codebooks (m, 256, d / m)."""
+    m = codebooks.shape[0]
+    sub = residuals.reshape(len(residuals), m, -1)
+    codes = np.empty((len(residuals), m), dtype=np.uint8)
+    for j in range(m):
+        codes[:, j] = assign_clusters(sub[:, j], codebooks[j])
+    return codes
+
+
+INDICES = {cls.kind: cls for cls in (ExactIndex, IVFPQIndex)}
+
+
+def _write_config(path, config):
+    tmp = os.path.join(path, INDEX_FILE + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(config, f, indent=1)
+    os.replace(tmp, os.path.join(path, INDEX_FILE))
+
+
+def is_index(path):
+    return os.path.exists(os.path.join(path, INDEX_FILE))
+
+
+def load_index(path, reorder=None):
+    """Loads an index saved with save(path). reorder: rows to rescore IVFPQ candidates from."""
+    with open(os.path.join(path, INDEX_FILE), "r") as f:
+        config = json.load(f)
+    index = INDICES[config["kind"]].load(path, config)
+    if reorder is not None and isinstance(index, IVFPQIndex):
+        index.reorder = reorder
+    recommended = load_recommended(path)
+    if recommended is not None and recommended["algorithm"] == index.kind == IVFPQIndex.kind:
+        # search time parameters can be tuned without rebuilding the index
+        params = recommended["params"]
+        index.num_leaves_to_search = max(int(round(params["leaves_to_search_fraction"] * index.num_leaves)), 1)
+        index.reorder_k = params["reorder_k"]
+    return index
+
+
+def load_recommended(path):
+    """
+    The configuration recommended for the searcher at path by the searcher benchmark, or None:
+    {"backend": "builtin" | "scann", "algorithm": ..., "params": {...}, "measured": {...}}.
+    """
+    f = os.path.join(path, RECOMMENDED_FILE)
+    if not os.path.exists(f):
+        return None
+    with open(f, "r") as f:
+        return json.load(f)
+
+
+def choose_algorithm(n):
+    """exact below 1e5 rows, ivfpq above."""
+    return "exact" if n < 1e5 else "ivfpq"
+
+
+def build_index(embeddings, k=20, reorder_k=None, num_leaves=None, num_leaves_to_search=None,
+                training_sample_size=None, dims_per_block=2, algorithm="auto"):
+    """
+    Index of the embeddings in memory, exact search or IVF-PQ with sqrt(n) partitions of
+    which 1/20 are searched by default. algorithm "auto" picks by pool size.
+    """
+    algorithm = choose_algorithm(len(embeddings)) if algorithm == "auto" else algorithm
+    if algorithm == "exact":
+        print("Using exact search.")
+        return ExactIndex(normalize(embeddings[:]))
+    print("Using partitioning, product quantization and reordering.")
+    index = IVFPQIndex.train(embeddings, num_leaves, dims_per_block, training_sample_size,
+                             num_leaves_to_search, reorder_k or 2 * k)
+    index.add(embeddings)
+    index.reorder = embeddings
+    return index
@@ -0,0 +1,229 @@
+"""
+Incremental updates of built-in retrieval indices, without retraining or a full rebuild.
+
+    append_rows(path, db)              encodes the database rows added since the index was built
+                                       (e.g. new shards written with DatabaseWriter(append=True))
+                                       into new segments
+    remove_img_ids(path, db, img_ids)  tombstones every row of the given img_ids, searches skip
+                                       them right away
+    compact(path, db)                  merges all segments into one, drops the tombstoned rows
+                                       and, given the database, splits partitions that grew far
+                                       beyond the average size
+
+Row ids stay database row numbers throughout, so removed images have to stay in the database
+(they are never returned again). BackgroundCompactor compacts an index periodically from a
+daemon thread of a long running process (see scripts/update_searcher.py --watch).
+
+Updates hold index.lock in the index directory, so processes updating the same index wait
+for each other. A lock left behind by a killed process has to be removed by hand.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+from ldm.modules.retrieval.builder import StreamingIndexBuilder, build_exact_streaming, merge_segments, \
+    next_segment_name, remove_segments
+from ldm.modules.retrieval.index import INDEX_FILE, ExactIndex, IVFPQIndex, _write_config, assign_clusters, \
+    encode_pq, iter_chunks, kmeans, load_index, make_segment, normalize, save_segment, save_tombstones
+
+LOCK_FILE = "index.lock"
+
+
+@contextmanager
+def index_lock(path, timeout=3600.):
+    """One update of the index at path at a time, across threads and processes."""
+    lock = os.path.join(path, LOCK_FILE)
+    start = time.time()
+    while True:
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            if time.time() - start > timeout:
+                raise TimeoutError(f"{lock} is held for more than {timeout:.0f} s, remove it if its process is gone")
+            time.sleep(0.1)
+    try:
+        os.write(fd, str(os.getpid()).encode())
+        os.close(fd)
+        yield
+    finally:
+        os.remove(lock)
+
+
+def append_rows(path, db, segment_rows=1 << 22):
+    """Adds the rows db has beyond the ones in the index at path. Returns the number of new rows."""
+    with index_lock(path):
+        index = load_index(path)
+        embeddings = db["embedding"]
+        if isinstance(index, ExactIndex):
+            n = len(embeddings) - len(index)
+            if n > 0:
+                # the old rows are copied, only the new ones are normalized
+                build_exact_streaming(path, embeddings, index.block_rows, existing=index.embeddings)
+            return max(n, 0)
+        n = len(embeddings) - index.next_id
+        if n <= 0:
+            print(f"Index at {path} is up to date with {len(embeddings)} rows")
+            return 0
+        builder = StreamingIndexBuilder(path, index, segment_rows, append=True)
+        builder.ingest(embeddings)
+        builder.finish(merge=False)
+        print(f"Appended {n} rows to {path}, {len(builder.names)} segments")
+        return n
+
+
+def find_rows(db, img_ids, chunk_rows=1 << 20):
+    """Row ids of all database rows whose img_id is in img_ids (one image may have several patches)."""
+    img_ids = np.unique(np.asarray(img_ids))
+    rows = [start + np.nonzero(np.isin(block, img_ids))[0] for start, block in iter_chunks(db["img_id"], chunk_rows)]
+    return np.concatenate(rows).astype(np.int64) if rows else np.empty(0, dtype=np.int64)
+
+
+def remove_rows(path, rows):
+    """Tombstones the row ids rows in the index at path. Returns the number of tombstones."""
+    with index_lock(path):
+        index = load_index(path)
+        deleted = np.asarray(rows, dtype=np.int64) if index.deleted is None \
+            else np.concatenate([index.deleted, rows]).astype(np.int64)
+        deleted = np.unique(deleted)
+        save_tombstones(path, deleted)
+        return len(deleted)
+
+
+def remove_img_ids(path, db, img_ids):
+    rows = find_rows(db, img_ids)
+    n = remove_rows(path, rows)
+    print(f"Removed {len(rows)} rows of {len(np.unique(img_ids))} images from {path}, {n} tombstones")
+    return rows
+
+
+def tombstone_ratio(index):
+    return 0. if index.deleted is None or len(index) == 0 else len(index.deleted) / len(index)
+
+
+def split_partitions(index, db, imbalance=4., iters=10):
+    """
+    Splits every partition with more than imbalance times the mean number of rows in two with
+    2-means on the exact database embeddings of its rows. The first half keeps the partition id,
+    the second gets a new one appended to index.centroids. Returns (ids of the split rows, their
+    new segment) or None when all partitions are small enough.
+    """
+    counts = np.zeros(index.num_leaves, dtype=np.int64)
+    for segment in index.segments:
+        sizes = np.diff(segment["leaf_offsets"])
+        counts[:len(sizes)] += sizes
+    limit = imbalance * max(counts.sum() / index.num_leaves, 1.)
+    large = np.nonzero(counts > limit)[0]
+    if len(large) == 0:
+        return None
+
+    centroids = [index.centroids]
+    split_ids, split_x, leaves = [], [], []
+    for l in large:
+        ids = np.sort(np.concatenate([s["ids"][s["leaf_offsets"][l]:s["leaf_offsets"][l + 1]]
+                                      for s in index.segments if l + 1 < len(s["leaf_offsets"])]))
+        if index.deleted is not None:
+            ids = ids[~np.isin(ids, index.deleted)]
+        x = normalize(db["embedding"][ids])
+        pair = kmeans(x, 2, iters, spherical=True)
+        new = index.num_leaves + len(centroids) - 1
+        print(f"Splitting partition {l} of {counts[l]} rows (limit {limit:.0f}) into {l} and {new}")
+        index.centroids[l] = pair[0]
+        centroids.append(pair[1:])
+        split_ids.append(ids)
+        split_x.append(x)
+        leaves.append(np.where(assign_clusters(x, pair, spherical=True) == 0, l, new))
+    index.centroids = np.concatenate(centroids).astype(np.float32)
+
+    ids, x, leaves = np.concatenate(split_ids), np.concatenate(split_x), np.concatenate(leaves)
+    codes = encode_pq(x - index.centroids[leaves], index.codebooks)
+    return ids, make_segment(leaves, codes, ids, index.num_leaves)
+
+
+def compact(path, db=None, imbalance=4.):
+    """
+    Merges the segments of the IVFPQIndex at path into one, without the tombstoned rows. With
+    the database given, oversized partitions are split first (see split_partitions). The new
+    files are complete before the config is switched to them, the old ones are deleted after.
+    """
+    with index_lock(path):
+        index = load_index(path)
+        if isinstance(index, ExactIndex):
+            # row ids are positions in embeddings.npy, removed rows can only be skipped
+            n = 0 if index.deleted is None else len(index.deleted)
+            print(f"Exact index at {path} keeps its {n} tombstones, nothing to compact")
+            return index
+        with open(os.path.join(path, INDEX_FILE), "r") as f:
+            old = json.load(f)["segments"]
+        deleted = index.deleted if index.deleted is not None else np.empty(0, dtype=np.int64)
+        start = time.time()
+
+        split = None if db is None else split_partitions(index, db, imbalance)
+        if split is None and len(old) <= 1 and len(deleted) == 0:
+            return index
+        drop = deleted
+        if split is not None:
+            # the split rows move from the old segments to the re-encoded extra one
+            split_ids, segment = split
+            drop = np.union1d(deleted, split_ids)
+            extra = next_segment_name(old)
+            save_segment(path, extra, segment)
+        keep = (lambda ids: ~np.isin(ids, drop)) if len(drop) else None
+        names, keeps = old, [keep] * len(old)
+        if split is not None:
+            # the extra segment has no tombstoned rows, it must not be masked
+            names, keeps = old + [extra], keeps + [None]
+        merged = merge_segments(path, names, index.num_leaves, target=next_segment_name(names), keep=keeps)
+
+        if split is not None:
+            tmp = os.path.join(path, "centroids.tmp.npy")
+            np.save(tmp, index.centroids)
+            os.replace(tmp, os.path.join(path, "centroids.npy"))
+        _write_config(path, index.config([merged]))
+        save_tombstones(path, None)
+        remove_segments(path, [name for name in names if name != merged])
+        index = load_index(path)
+        print(f"Compacted {len(old)} segments of {path} into one of {len(index)} rows, dropped "
+              f"{len(deleted)} tombstones, {index.num_leaves} partitions, {time.time() - start:.1f} s")
+        return index
+
+
+class BackgroundCompactor(threading.Thread):
+    """
+    Checks the index at path every `interval` seconds and compacts it once it has at least
+    min_segments segments or more than max_tombstone_ratio of its rows are tombstoned.
+    on_compacted(index) is called with the compacted index, e.g. to swap it into a searcher.
+    """
+    def __init__(self, path, db=None, interval=600., min_segments=4, max_tombstone_ratio=0.1, imbalance=4.,
+                 on_compacted=None):
+        super().__init__(daemon=True)
+        self.path = path
+        self.db = db
+        self.interval = interval
+        self.min_segments = min_segments
+        self.max_tombstone_ratio = max_tombstone_ratio
+        self.imbalance = imbalance
+        self.on_compacted = on_compacted
+        self.stopped = threading.Event()
+
+    def due(self, index):
+        return isinstance(index, IVFPQIndex) and (len(index.segments) >= self.min_segments
+                                                  or tombstone_ratio(index) > self.max_tombstone_ratio)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                if self.due(load_index(self.path)):
+                    index = compact(self.path, self.db, self.imbalance)
+                    if self.on_compacted is not None:
+                        self.on_compacted(index)
+            except Exception as e:
+                print(f"Compacting {self.path} failed: {e}")
+
+    def stop(self):
+        self.stopped.set()
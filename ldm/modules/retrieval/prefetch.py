@@ -0,0 +1,138 @@
+"""
+Neighbor prefetching for retrieval augmented sampling.
+
+Without it every batch of knn2img.py encodes its prompts, waits for the searcher and the
+neighbor gather, and only then starts sampling, so retrieval and the GPU never overlap.
+RetrievalPrefetcher runs a retriever (encoder, search and gather of the neighbor
+embeddings, see cache.CachedRetriever) in a worker thread, up to `depth` batches ahead of
+the sampling loop. `group` upcoming batches are retrieved with one call. The neighbors are
+copied into a ring of pinned host buffers, so the host to device copy of a batch is
+asynchronous.
+
+    prefetcher = RetrievalPrefetcher(CachedRetriever(clip_text_encoder.encode, searcher, opt.knn))
+    for prompts, c, nn_embeddings in prefetcher.run(batches):
+        c = torch.cat([c, nn_embeddings], dim=1)
+"""
+
+import queue
+import threading
+
+import numpy as np
+import torch
+
+_STOP = object()
+
+
+class _Failure(object):
+    def __init__(self, exc):
+        self.exc = exc
+
+
+class RetrievalPrefetcher(object):
+    """
+    :param retrieve: prompts -> ((b, 1, d) query embeddings, (b, k, d) float32 neighbor embeddings).
+    :param depth: batches retrieved ahead of the consumer, bounds the pinned buffers to depth + 2.
+    :param group: batches retrieved together.
+    """
+    def __init__(self, retrieve, device=None, depth=2, group=1):
+        self.retrieve = retrieve
+        self.device = torch.device(device) if device is not None else \
+            torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.pin = self.device.type == "cuda"
+        self.depth = depth
+        self.group = group
+        self._abort = threading.Event()
+
+    def _put(self, q, item):
+        while not self._abort.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        while not self._abort.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _STOP
+
+    def _groups(self, batches):
+        group = []
+        for prompts in batches:
+            group.append(list(prompts))
+            if len(group) == self.group:
+                yield group
+                group = []
+        if group:
+            yield group
+
+    def _fill(self, buffers, slot, neighbors):
+        """Copies neighbors into the pinned buffer of slot, growing it if needed."""
+        buffer = buffers[slot]
+        if buffer is None or buffer.shape[0] < len(neighbors) or buffer.shape[1:] != neighbors.shape[1:]:
+            buffer = torch.empty(neighbors.shape, dtype=torch.float32, pin_memory=self.pin)
+            buffers[slot] = buffer
+        buffer = buffer[:len(neighbors)]
+        buffer.copy_(torch.from_numpy(neighbors))
+        return buffer
+
+    def _work(self, batches, out, free, buffers):
+        try:
+            for group in self._groups(batches):
+                # no_grad is thread local, the caller's context does not reach the worker
+                with torch.no_grad():
+                    c, neighbors = self.retrieve([p for prompts in group for p in prompts])
+                neighbors = np.ascontiguousarray(neighbors, dtype=np.float32)
+                start = 0
+                for prompts in group:
+                    end = start + len(prompts)
+                    item = self._get(free)
+                    if item is _STOP:
+                        return
+                    slot, event = item
+                    if event is not None:
+                        # the last copy out of this buffer has to be done before it is overwritten
+                        event.synchronize()
+                    buffer = self._fill(buffers, slot, neighbors[start:end])
+                    if not self._put(out, (prompts, c[start:end], slot, buffer)):
+                        return
+                    start = end
+        except Exception as e:
+            self._put(out, _Failure(e))
+            return
+        self._put(out, _STOP)
+
+    def run(self, batches):
+        """Yields (prompts, query embeddings, neighbor embeddings on device) for every batch of prompts."""
+        self._abort.clear()
+        out = queue.Queue(maxsize=self.depth)
+        # depth batches queued, one being filled and one in use by the consumer
+        free = queue.Queue()
+        for slot in range(self.depth + 2):
+            free.put((slot, None))
+        buffers = [None] * (self.depth + 2)
+        worker = threading.Thread(target=self._work, args=(batches, out, free, buffers),
+                                  name="retrieval-prefetch", daemon=True)
+        worker.start()
+        try:
+            while True:
+                item = self._get(out)
+                if item is _STOP:
+                    break
+                if isinstance(item, _Failure):
+                    raise item.exc
+                prompts, c, slot, buffer = item
+                neighbors = buffer.to(self.device, non_blocking=self.pin)
+                event = None
+                if self.pin:
+                    event = torch.cuda.Event()
+                    event.record()
+                free.put((slot, event))
+                yield prompts, c.to(self.device), neighbors
+        finally:
+            self._abort.set()
+            worker.join()
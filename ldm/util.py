@@ -7,10 +7,16 @@ from einops import rearrange
 from functools import partial
 
 import multiprocessing as mp
-from threading import Thread
+import os
+import queue
+import time
+import traceback
+from multiprocessing import shared_memory
+from threading import Event, Thread
 from queue import Queue
 
 from inspect import isfunction
+from tqdm import tqdm
 from PIL import Image, ImageDraw, ImageFont
 
 
@@ -97,10 +103,14 @@ def _do_parallel_data_prefetch(func, Q, data, idx, idx_to_fn=False):
     # create dummy dataset instance
 
     # run prefetching
-    if idx_to_fn:
-        res = func(data, worker_id=idx)
-    else:
-        res = func(data)
+    try:
+        if idx_to_fn:
+            res = func(data, worker_id=idx)
+        else:
+            res = func(data)
+    except Exception:
+        Q.put(["Error", idx, traceback.format_exc()])
+        return
     Q.put([idx, res])
     Q.put("Done")
 
@@ -160,7 +170,6 @@ def parallel_data_prefetch(
 
     # start processes
     print(f"Start prefetching...")
-    import time
 
     start = time.time()
     gather_res = [[] for _ in range(n_proc)]
@@ -172,8 +181,11 @@ def parallel_data_prefetch(
         while k < n_proc:
             # get result
             res = Q.get()
-            if res == "Done":
+            if isinstance(res, str) and res == "Done":
                 k += 1
+            elif res[0] == "Error":
+                # every part is needed to keep the output in order, a failed worker fails the prefetch
+                raise RuntimeError(f"worker {res[1]} failed:\n{res[2]}")
             else:
                 gather_res[res[0]] = res[1]
 
@@ -201,3 +213,141 @@ def parallel_data_prefetch(
         return out
     else:
         return gather_res
+
+
+def _open_output(spec):
+    """The output array of parallel_fill in a worker, plus the shared memory handle to close."""
+    if spec[0] == "array":
+        return spec[1], None
+    if spec[0] == "memmap":
+        return np.load(spec[1], mmap_mode="r+"), None
+    _, name, shape, dtype = spec
+    # workers share the parent's resource tracker (fork, spawn and forkserver alike), so attaching
+    # here only repeats the parent's registration and the parent's unlink clears it
+    shm = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf), shm
+
+
+def _detach_shm(shm, shape, dtype):
+    """
+    An array on the block of shm without a copy. The name is unlinked right away, the mapping
+    stays valid until the array is freed.
+    """
+    shm.unlink()
+    buf = shm.buf
+    # the array keeps buf and with it the mapping alive, close() then only closes the file descriptor
+    shm._buf = shm._mmap = None
+    shm.close()
+    return np.ndarray(shape, dtype=dtype, buffer=buf)
+
+
+def _do_parallel_fill(func, items, offsets, spec, worker_id, progress, stop, use_worker_id):
+    shm = None
+    try:
+        out, shm = _open_output(spec)
+        for i, item in items:
+            if stop.is_set():
+                break
+            res = np.asarray(func(item, worker_id=worker_id) if use_worker_id else func(item))
+            lo, hi = offsets[i], offsets[i + 1]
+            if len(res) != hi - lo:
+                raise ValueError(f"item {i} gave {len(res)} rows, expected {hi - lo}")
+            out[lo:hi] = res
+            progress.put(("done", i, hi - lo))
+        if isinstance(out, np.memmap):
+            out.flush()
+        del out
+        progress.put(("exit", worker_id, None))
+    except Exception:
+        progress.put(("error", worker_id, traceback.format_exc()))
+    finally:
+        if shm is not None:
+            shm.close()
+
+
+def parallel_fill(func, data, rows, shape, dtype, n_proc, out_path=None, cpu_intensive=True,
+                  use_worker_id=False, desc="Loading"):
+    """
+    Parallel loading into one preallocated output array, without sending the results back
+    through a queue. func(item) returns the rows[i] rows of item i of data; they are written
+    by the workers straight into rows offsets[i]:offsets[i + 1] of the output, so the output
+    is ordered like data regardless of which worker finishes first. Only progress messages
+    go through the queue.
+
+    The output (sum(rows),) + shape is returned as an array on the shared memory block the
+    workers wrote, without a copy, or with out_path as a .npy file memory-mapped, for outputs
+    larger than memory. An exception in any worker stops the others and is re-raised with the worker's
+    traceback, a partial out_path is removed.
+    """
+    offsets = np.concatenate([[0], np.cumsum(rows)]).astype(np.int64)
+    full_shape = (int(offsets[-1]),) + tuple(shape)
+    dtype = np.dtype(dtype)
+    n_proc = max(1, min(n_proc, len(data)))
+    shm = None
+    if out_path is not None:
+        np.lib.format.open_memmap(out_path, "w+", dtype, full_shape).flush()
+        spec = ("memmap", out_path)
+    elif cpu_intensive:
+        shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(full_shape)) * dtype.itemsize, 1))
+        spec = ("shm", shm.name, full_shape, dtype)
+    else:
+        spec = ("array", np.empty(full_shape, dtype=dtype))
+
+    if cpu_intensive:
+        progress, stop, proc = mp.Queue(), mp.Event(), mp.Process
+    else:
+        progress, stop, proc = Queue(), Event(), Thread
+    # interleaved, so workers get a similar mix of large and small items
+    parts = [[(i, data[i]) for i in range(w, len(data), n_proc)] for w in range(n_proc)]
+    workers = [proc(target=_do_parallel_fill,
+                    args=(func, part, offsets, spec, w, progress, stop, use_worker_id), daemon=True)
+               for w, part in enumerate(parts)]
+
+    start = time.time()
+    error = None
+    running = set(range(n_proc))
+    try:
+        try:
+            for w in workers:
+                w.start()
+            with tqdm(total=full_shape[0], desc=desc, unit="rows") as pbar:
+                while running and error is None:
+                    try:
+                        kind, i, payload = progress.get(timeout=1.)
+                    except queue.Empty:
+                        for w in list(running):
+                            if cpu_intensive and workers[w].exitcode not in (None, 0):
+                                error = f"worker {w} died with exit code {workers[w].exitcode}"
+                        continue
+                    if kind == "done":
+                        pbar.update(payload)
+                    elif kind == "exit":
+                        running.discard(i)
+                    else:
+                        error = f"worker {i} failed:\n{payload}"
+        finally:
+            stop.set()
+            for w in workers:
+                w.join(timeout=10)
+                if cpu_intensive and w.is_alive():
+                    w.terminate()
+                    w.join()
+
+        if error is not None:
+            raise RuntimeError(f"parallel_fill: {error}")
+        print(f"Loaded {full_shape[0]} rows in {time.time() - start:.1f} sec.")
+        if out_path is not None:
+            return np.load(out_path, mmap_mode="r")
+        if shm is not None:
+            out, shm = _detach_shm(shm, full_shape, dtype), None
+            return out
+        return spec[1]
+    except BaseException:
+        # also on KeyboardInterrupt, a partial output can be gigabytes of disk or /dev/shm
+        if out_path is not None and os.path.exists(out_path):
+            os.remove(out_path)
+        raise
+    finally:
+        if shm is not None:
+            shm.close()
+            shm.unlink()
@@ -0,0 +1,249 @@
+"""
+Bulk img2img over a directory or manifest of init images.
+
+Images are decoded and resized by a pool of CPU worker processes that runs ahead of the
+GPU, grouped into batches of equal resolution, encoded in batched VAE passes and then
+denoised with one seed per image. All models stay resident on --device; with --pipeline
+the VAE encode, denoising and decode of consecutive batches also overlap.
+
+--input can be
+    a directory          every image below it, with --prompt
+    a .txt file          one image path per line, with --prompt
+    a .jsonl file        one object per line, {"image": "a.jpg", "prompt": "...", "seed": 5}
+
+Image i uses seed --seed + i unless the manifest gives one. Results and a line per image
+are written to outdir/images and outdir/manifest.jsonl, re-running the same command skips
+images that are already done.
+
+    python optimizedSD/batch_img2img.py --input photos/ --prompt "oil painting" --strength 0.6 --batch_size 4
+"""
+
+import argparse
+import json
+import os
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from PIL import Image
+from einops import rearrange
+from pytorch_lightning import seed_everything
+from transformers import logging
+
+from batch_txt2img import read_manifest
+from bucketing import fit_image, parse_buckets
+from pipeline import Stage, StagePipeline, get_conditioning, load_models, place_stages
+
+logging.set_verbosity_error()
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".bmp")
+
+
+def read_inputs(path, prompt):
+    """Yields (index, image path, prompt, seed or None) for every input image."""
+    if os.path.isdir(path):
+        files = []
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            files += [os.path.join(root, n) for n in sorted(names) if n.lower().endswith(IMAGE_EXTENSIONS)]
+        for index, f in enumerate(files):
+            yield index, f, prompt, None
+        return
+
+    base = os.path.dirname(path)
+    with open(path, "r") as f:
+        lines = (line.strip() for line in f)
+        for index, line in enumerate(line for line in lines if line):
+            if path.endswith(".jsonl"):
+                record = json.loads(line)
+                yield index, os.path.join(base, record["image"]), record.get("prompt", prompt), record.get("seed")
+            else:
+                yield index, os.path.join(base, line), prompt, None
+
+
+def load_image(path, H, W, max_side, buckets=None):
+    """Runs in the worker processes: decode, resize to a multiple of 64 and return uint8 HWC."""
+    image = Image.open(path).convert("RGB")
+    w, h = image.size
+    if H and W:
+        h, w = H, W
+    elif buckets is not None:
+        h, w = buckets.assign(h, w)
+        return np.array(fit_image(image, h, w))
+    elif max_side and max(w, h) > max_side:
+        s = max_side / max(w, h)
+        w, h = int(w * s), int(h * s)
+    w, h = map(lambda x: max(64, x - x % 64), (w, h))
+    image = image.resize((w, h), resample=Image.LANCZOS)
+    return np.array(image)
+
+
+def prefetch_images(records, opt, pool):
+    """Yields (record, image) in input order while keeping --prefetch images loading in the pool."""
+    pending = deque()
+    for record in records:
+        pending.append((record, pool.submit(load_image, record[1], opt.H, opt.W, opt.max_side, opt.buckets)))
+        if len(pending) >= opt.prefetch:
+            yield _result(*pending.popleft())
+    while pending:
+        yield _result(*pending.popleft())
+
+
+def _result(record, future):
+    try:
+        return record, future.result()
+    except Exception as e:
+        print(f"Skipping {record[1]}: {e}")
+        return record, None
+
+
+def bucket_batches(images, batch_size, max_open=8):
+    """
+    Groups loaded images by resolution into batches of at most batch_size. When more than
+    `max_open` resolutions are waiting, the oldest partial batch is emitted.
+    """
+    buckets = OrderedDict()
+    for record, image in images:
+        if image is None:
+            continue
+        items = buckets.setdefault(image.shape[:2], [])
+        items.append((record, image))
+        if len(items) == batch_size:
+            del buckets[image.shape[:2]]
+            yield items
+        elif len(buckets) > max_open:
+            yield buckets.popitem(last=False)[1]
+    for items in buckets.values():
+        yield items
+
+
+def run(opt):
+    manifest_path = os.path.join(opt.outdir, "manifest.jsonl")
+    done = {r["index"] for r in read_manifest(manifest_path)}
+    image_dir = os.path.join(opt.outdir, "images")
+    os.makedirs(image_dir, exist_ok=True)
+    print(f"{len(done)} images already done")
+
+    # start the workers before cuda is initialized
+    pool = ProcessPoolExecutor(opt.workers, mp_context=mp.get_context("spawn"))
+
+    model, modelCS, modelFS = load_models(opt.ckpt, opt.config)
+    model.unet_bs = opt.unet_bs
+    place_stages(model, modelCS, modelFS, opt.device, opt.device, opt.device, opt.precision)
+
+    assert 0.0 <= opt.strength < 1.0, "can only work with strength in [0.0, 1.0)"
+    t_enc = int(opt.strength * opt.ddim_steps)
+
+    def make_jobs():
+        records = (r for r in read_inputs(opt.input, opt.prompt) if r[0] not in done)
+        for items in bucket_batches(prefetch_images(records, opt, pool), opt.batch_size):
+            batch = [r for r, _ in items]
+            yield {
+                "records": batch,
+                "images": np.stack([image for _, image in items]),
+                "prompts": [r[2] for r in batch],
+                "seeds": [opt.seed + r[0] if r[3] is None else int(r[3]) for r in batch],
+            }
+
+    def encode(job):
+        x = torch.from_numpy(job.pop("images")).to(opt.device)
+        x = rearrange(x, "b h w c -> b c h w").float() / 127.5 - 1.0
+        posterior = modelFS.encode_first_stage(x)
+        # sample every init latent from its own posterior with the image's seed
+        noise = torch.cat([torch.randn((1,) + tuple(posterior.mean.shape[1:]),
+                                       generator=torch.Generator().manual_seed(seed)) for seed in job["seeds"]])
+        z = posterior.mean + posterior.std * noise.to(posterior.mean)
+        job["init_latent"] = modelFS.scale_factor * z
+        job["c"], job["uc"] = get_conditioning(modelCS, job["prompts"], opt.scale, opt.negative_prompt)
+        return job
+
+    def sample(job):
+        init_latent = job.pop("init_latent")
+        c, uc = job.pop("c").to(opt.device), job.pop("uc")
+        if uc is not None:
+            uc = uc.to(opt.device)
+        b = init_latent.shape[0]
+        z_enc = model.stochastic_encode(init_latent, torch.tensor([t_enc] * b).to(opt.device),
+                                        job["seeds"], opt.ddim_eta, opt.ddim_steps)
+        job["samples"] = model.sample(t_enc, c, z_enc, unconditional_guidance_scale=opt.scale,
+                                      unconditional_conditioning=uc, sampler="ddim",
+                                      cfg_skip_last=opt.cfg_skip_last, cfg_skip_delta=opt.cfg_skip_delta)
+        return job
+
+    def decode(job):
+        samples = job.pop("samples")
+        files = []
+        for i, record in enumerate(job["records"]):
+            x_sample = modelFS.decode_first_stage(samples[i].unsqueeze(0))
+            x_sample = torch.clamp((x_sample + 1.0) / 2.0, min=0.0, max=1.0)
+            x_sample = 255.0 * rearrange(x_sample[0].cpu().numpy(), "c h w -> h w c")
+            stem = os.path.splitext(os.path.basename(record[1]))[0]
+            fname = f"{record[0]:07}_{stem}.{opt.format}"
+            Image.fromarray(x_sample.astype(np.uint8)).save(os.path.join(image_dir, fname))
+            files.append(os.path.join("images", fname))
+        job["files"] = files
+        return job
+
+    runner = StagePipeline(
+        [
+            Stage("encode", encode, opt.device, opt.precision),
+            Stage("sample", sample, opt.device, opt.precision),
+            Stage("decode", decode, opt.device, opt.precision),
+        ],
+        threaded=opt.pipeline,
+    )
+
+    n_done, tic = 0, time.time()
+    try:
+        with open(manifest_path, "a") as manifest:
+            for job in runner.run(make_jobs()):
+                for record, seed, fname in zip(job["records"], job["seeds"], job["files"]):
+                    index, path, prompt, _ = record
+                    manifest.write(json.dumps(
+                        {"index": index, "image": path, "prompt": prompt, "seed": seed, "file": fname}) + "\n")
+                manifest.flush()
+                os.fsync(manifest.fileno())
+                n_done += len(job["files"])
+                print(f"{n_done} images, {(time.time() - tic) / n_done:.2f} s/image")
+    finally:
+        pool.shutdown(wait=False)
+    print(f"Finished {n_done} images in {(time.time() - tic) / 60:.2f} minutes")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="img2img over a directory or manifest of images")
+    parser.add_argument("--input", type=str, required=True, help="image directory, .txt list of paths or .jsonl manifest")
+    parser.add_argument("--prompt", type=str, default="a painting", help="prompt for images without their own")
+    parser.add_argument("--outdir", type=str, default="outputs/batch-img2img", help="dir to write results to")
+    parser.add_argument("--device", type=str, default="cuda", help="device to run all models on")
+    parser.add_argument("--workers", type=int, default=4, help="cpu processes decoding and resizing images")
+    parser.add_argument("--prefetch", type=int, default=32, help="images loaded ahead of the GPU")
+    parser.add_argument("--batch_size", type=int, default=4, help="images per batch, batches hold one resolution")
+    parser.add_argument("--seed", type=int, default=42, help="base seed, image i uses seed + i")
+    parser.add_argument("--strength", type=float, default=0.75, help="1.0 corresponds to full destruction of the init image")
+    parser.add_argument("--ddim_steps", type=int, default=50, help="number of ddim sampling steps")
+    parser.add_argument("--ddim_eta", type=float, default=0.0, help="ddim eta")
+    parser.add_argument("--scale", type=float, default=7.5, help="unconditional guidance scale")
+    parser.add_argument("--negative_prompt", type=str, default="", help="negative prompt for every image")
+    parser.add_argument("--cfg_skip_last", type=int, default=0, help="run the last steps without guidance")
+    parser.add_argument("--cfg_skip_delta", type=float, default=0.,
+                        help="drop the guidance once the relative guidance delta is below this")
+    parser.add_argument("--H", type=int, default=None, help="resize every image to this height")
+    parser.add_argument("--W", type=int, default=None, help="resize every image to this width")
+    parser.add_argument("--max_side", type=int, default=768, help="downscale larger images to this longest side")
+    parser.add_argument("--buckets", type=parse_buckets, default=None,
+                        help="crop every image to the nearest aspect-ratio bucket of these sizes, e.g. 512,768, "
+                             "so images of similar shape share batches")
+    parser.add_argument("--unet_bs", type=int, default=1, help="batch size of the unet halves")
+    parser.add_argument("--pipeline", action="store_true", help="overlap encode/sample/decode of consecutive batches")
+    parser.add_argument("--precision", type=str, choices=["full", "autocast"], default="autocast")
+    parser.add_argument("--format", type=str, choices=["jpg", "png"], default="png")
+    parser.add_argument("--config", type=str, default="optimizedSD/v1-inference.yaml")
+    parser.add_argument("--ckpt", type=str, default="models/ldm/stable-diffusion-v1/model.ckpt")
+    opt = parser.parse_args()
+
+    seed_everything(opt.seed)
+    run(opt)
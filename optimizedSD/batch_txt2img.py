@@ -0,0 +1,233 @@
+"""
+Sharded txt2img for large prompt files.
+
+The prompt file is split across --workers processes (prompt i goes to shard i % workers),
+each worker owns one device from --devices. Every prompt gets deterministic seeds derived
+from its line index, so the output does not depend on the number of workers or on restarts:
+image j of prompt i always uses seed + i * n_samples + j.
+
+Each shard appends a line to outdir/shards/shard_XXX.jsonl once all images of a prompt are
+written. A crashed or interrupted run picks up where it stopped when the command is
+re-run, also with a different --workers: every shard skips the prompts found in any shard
+manifest. The shard manifests are merged into outdir/manifest.jsonl at the end.
+
+    python optimizedSD/batch_txt2img.py --from-file prompts.txt --devices cuda:0,cuda:1 --workers 2
+"""
+
+import argparse
+import glob
+import json
+import os
+import time
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from PIL import Image
+from einops import rearrange
+from pytorch_lightning import seed_everything
+from transformers import logging
+
+from pipeline import Stage, StagePipeline, get_conditioning, load_models, place_stages
+
+logging.set_verbosity_error()
+
+
+def shard_manifest_path(outdir, shard):
+    return os.path.join(outdir, "shards", f"shard_{shard:03}.jsonl")
+
+
+def read_manifest(path):
+    records = []
+    if not os.path.exists(path):
+        return records
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # last line of a shard that died while writing
+                print(f"Skipping truncated record in {path}")
+    return records
+
+
+def read_records(outdir):
+    """Records of all shard manifests by prompt index, whichever --workers wrote them."""
+    records = {}
+    for path in sorted(glob.glob(os.path.join(outdir, "shards", "shard_*.jsonl"))):
+        for r in read_manifest(path):
+            records[r["index"]] = r
+    return records
+
+
+def iter_shard(path, shard, n_shards):
+    with open(path, "r") as f:
+        for index, line in enumerate(f):
+            if index % n_shards != shard:
+                continue
+            prompt = line.strip()
+            if prompt:
+                yield index, prompt
+
+
+def run_shard(shard, opt):
+    device = opt.devices[shard % len(opt.devices)]
+    manifest_path = shard_manifest_path(opt.outdir, shard)
+    # all shards, a previous run may have split the prompts over a different number of workers
+    done = set(read_records(opt.outdir))
+    print(f"[shard {shard}] running on {device}, {len(done)} prompts already done")
+
+    model, modelCS, modelFS = load_models(opt.ckpt, opt.config)
+    model.unet_bs = opt.unet_bs
+    place_stages(model, modelCS, modelFS, device, device, device, opt.precision)
+
+    image_dir = os.path.join(opt.outdir, "images")
+    os.makedirs(image_dir, exist_ok=True)
+
+    def make_jobs():
+        for index, prompt in iter_shard(opt.from_file, shard, opt.workers):
+            if index in done:
+                continue
+            seed = opt.seed + index * opt.n_samples
+            yield {"index": index, "prompts": opt.n_samples * [prompt], "seed": seed}
+
+    def encode(job):
+        job["c"], job["uc"] = get_conditioning(modelCS, job["prompts"], opt.scale, opt.negative_prompt)
+        return job
+
+    def sample(job):
+        shape = [opt.n_samples, opt.C, opt.H // opt.f, opt.W // opt.f]
+        job["samples"] = model.sample(
+            S=opt.ddim_steps,
+            conditioning=job.pop("c"),
+            seed=job["seed"],
+            shape=shape,
+            verbose=False,
+            unconditional_guidance_scale=opt.scale,
+            unconditional_conditioning=job.pop("uc"),
+            eta=opt.ddim_eta,
+            sampler=opt.sampler,
+            cfg_skip_last=opt.cfg_skip_last,
+            cfg_skip_delta=opt.cfg_skip_delta,
+        )
+        return job
+
+    def decode(job):
+        samples = job.pop("samples")
+        files = []
+        for i in range(samples.shape[0]):
+            x_sample = modelFS.decode_first_stage(samples[i].unsqueeze(0))
+            x_sample = torch.clamp((x_sample + 1.0) / 2.0, min=0.0, max=1.0)
+            x_sample = 255.0 * rearrange(x_sample[0].cpu().numpy(), "c h w -> h w c")
+            fname = f"{job['index']:07}_{i:02}.{opt.format}"
+            Image.fromarray(x_sample.astype(np.uint8)).save(os.path.join(image_dir, fname))
+            files.append(os.path.join("images", fname))
+        job["files"] = files
+        return job
+
+    runner = StagePipeline(
+        [
+            Stage("encode", encode, device, opt.precision),
+            Stage("sample", sample, device, opt.precision),
+            Stage("decode", decode, device, opt.precision),
+        ],
+        threaded=opt.pipeline,
+    )
+
+    n_done, tic = 0, time.time()
+    with open(manifest_path, "a") as manifest:
+        for job in runner.run(make_jobs()):
+            record = {
+                "index": job["index"],
+                "prompt": job["prompts"][0],
+                "seeds": [job["seed"] + i for i in range(len(job["files"]))],
+                "files": job["files"],
+            }
+            manifest.write(json.dumps(record) + "\n")
+            manifest.flush()
+            os.fsync(manifest.fileno())
+            n_done += 1
+            if n_done % 10 == 0:
+                print(f"[shard {shard}] {n_done} prompts, {(time.time() - tic) / n_done:.2f} s/prompt")
+    print(f"[shard {shard}] finished {n_done} prompts in {(time.time() - tic) / 60:.2f} minutes")
+
+
+def _shard_main(shard, opt):
+    seed_everything(opt.seed)
+    run_shard(shard, opt)
+
+
+def merge_manifests(opt):
+    records = read_records(opt.outdir)
+
+    with open(os.path.join(opt.outdir, "manifest.jsonl"), "w") as f:
+        for index in sorted(records):
+            f.write(json.dumps(records[index]) + "\n")
+
+    with open(opt.from_file, "r") as f:
+        expected = sum(1 for line in f if line.strip())
+    missing = expected - len(records)
+    print(f"Merged {len(records)} prompts into {os.path.join(opt.outdir, 'manifest.jsonl')}"
+          + (f", {missing} prompts missing, re-run to resume" if missing > 0 else ""))
+    return missing
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="sharded txt2img over a prompt file")
+    parser.add_argument("--from-file", type=str, required=True, help="prompt file, one prompt per line")
+    parser.add_argument("--outdir", type=str, default="outputs/batch-txt2img", help="dir to write results to")
+    parser.add_argument("--devices", type=str, default="cuda", help="comma separated devices, e.g. cuda:0,cuda:1")
+    parser.add_argument("--workers", type=int, default=None, help="number of shards (default: one per device)")
+    parser.add_argument("--retries", type=int, default=1, help="how often a crashed shard is restarted")
+    parser.add_argument("--seed", type=int, default=42, help="base seed, image j of prompt i uses seed + i * n_samples + j")
+    parser.add_argument("--n_samples", type=int, default=1, help="images per prompt")
+    parser.add_argument("--ddim_steps", type=int, default=50, help="number of sampling steps")
+    parser.add_argument("--ddim_eta", type=float, default=0.0, help="ddim eta")
+    parser.add_argument("--scale", type=float, default=7.5, help="unconditional guidance scale")
+    parser.add_argument("--negative_prompt", type=str, default="", help="negative prompt for every image")
+    parser.add_argument("--cfg_skip_last", type=int, default=0, help="run the last steps without guidance")
+    parser.add_argument("--cfg_skip_delta", type=float, default=0.,
+                        help="drop the guidance once the relative guidance delta is below this")
+    parser.add_argument("--H", type=int, default=512, help="image height, in pixel space")
+    parser.add_argument("--W", type=int, default=512, help="image width, in pixel space")
+    parser.add_argument("--C", type=int, default=4, help="latent channels")
+    parser.add_argument("--f", type=int, default=8, help="downsampling factor")
+    parser.add_argument("--unet_bs", type=int, default=1, help="batch size of the unet halves")
+    parser.add_argument("--pipeline", action="store_true", help="overlap encode/sample/decode inside every worker")
+    parser.add_argument("--precision", type=str, choices=["full", "autocast"], default="autocast")
+    parser.add_argument("--format", type=str, choices=["jpg", "png"], default="png")
+    parser.add_argument("--sampler", type=str, default="plms",
+                        choices=["ddim", "plms", "heun", "euler", "euler_a", "dpm2", "dpm2_a", "lms"])
+    parser.add_argument("--config", type=str, default="optimizedSD/v1-inference.yaml")
+    parser.add_argument("--ckpt", type=str, default="models/ldm/stable-diffusion-v1/model.ckpt")
+    opt = parser.parse_args()
+
+    opt.devices = [d.strip() for d in opt.devices.split(",") if d.strip()]
+    if opt.workers is None:
+        opt.workers = len(opt.devices)
+    os.makedirs(os.path.join(opt.outdir, "shards"), exist_ok=True)
+
+    tic = time.time()
+    pending = list(range(opt.workers))
+    for attempt in range(opt.retries + 1):
+        if opt.workers == 1:
+            _shard_main(0, opt)
+            pending = []
+        else:
+            ctx = mp.get_context("spawn")
+            procs = {shard: ctx.Process(target=_shard_main, args=(shard, opt)) for shard in pending}
+            for p in procs.values():
+                p.start()
+            for p in procs.values():
+                p.join()
+            pending = [shard for shard, p in procs.items() if p.exitcode != 0]
+        if not pending:
+            break
+        if attempt < opt.retries:
+            print(f"Shards {pending} failed, restarting ({attempt + 1}/{opt.retries})")
+
+    merge_manifests(opt)
+    print(f"Finished in {(time.time() - tic) / 60:.2f} minutes")
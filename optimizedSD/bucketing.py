@@ -0,0 +1,93 @@
+"""
+Resolution buckets for mixed-size jobs.
+
+Requested sizes (anything from 64 to 4096 px in the gradio sliders) are mapped to a small
+set of shapes, one per aspect ratio and size class, so jobs of similar size end up in the
+same batch and the model only ever sees a handful of shapes. Images are generated at the
+bucket size and resized/cropped to the requested size when they are saved.
+
+BucketResources holds what is worth precomputing once per shape: the attention chunk plans
+of splitAttention.CrossAttention and the tile grids (window positions and blend weights) of
+tiled denoising and decoding. Both are built the first time a bucket is sampled and kept for
+the whole run, unlike tiling.get_tile_grid's small lru_cache, which many buckets would evict.
+"""
+
+import math
+
+from PIL import Image
+
+from splitAttention import CrossAttention
+
+
+class Buckets(object):
+    """
+    The bucket shapes are every combination of a side length in `sizes` (the side of a square
+    with the same area) and an aspect ratio in `ratios` (both orientations), rounded to
+    multiples of `step` px.
+    """
+    def __init__(self, sizes=(512, 768), ratios=(1., 4 / 3, 3 / 2, 16 / 9), step=64):
+        self.step = step
+        shapes = set()
+        for size in sizes:
+            for ratio in ratios:
+                h = self._round(size / math.sqrt(ratio))
+                w = self._round(size * math.sqrt(ratio))
+                shapes.add((h, w))
+                shapes.add((w, h))
+        self.shapes = sorted(shapes)
+
+    def _round(self, x):
+        return max(self.step, int(round(x / self.step)) * self.step)
+
+    def assign(self, H, W):
+        """Bucket (H, W) for a requested size: closest aspect ratio first, then closest area."""
+        def distance(shape):
+            h, w = shape
+            return (round(abs(math.log((w / h) / (W / H))), 2), abs(math.log((w * h) / (W * H))))
+        return min(self.shapes, key=distance)
+
+    def __len__(self):
+        return len(self.shapes)
+
+
+def parse_buckets(s):
+    """--buckets "512,768" -> Buckets with those size classes."""
+    return Buckets(sizes=tuple(int(v) for v in s.split(",") if v.strip()))
+
+
+def fit_image(image, H, W):
+    """Resize a PIL image to cover H x W and center crop it, keeping the aspect ratio."""
+    w, h = image.size
+    if (w, h) == (W, H):
+        return image
+    s = max(W / w, H / h)
+    w, h = max(W, round(w * s)), max(H, round(h * s))
+    image = image.resize((w, h), resample=Image.LANCZOS)
+    left, top = (w - W) // 2, (h - H) // 2
+    return image.crop((left, top, left + W, top + H))
+
+
+class BucketResources(object):
+    """Per-bucket precomputed resources."""
+    def __init__(self):
+        self.attention_plans = {}
+        self.tile_grids = {}
+
+    def plan_attention(self, model, budget_mb):
+        """
+        Lets every CrossAttention of `model` pick its att_step per input shape so one chunk of
+        attention scores stays below budget_mb. The plans are shared between the modules and
+        only computed once per shape, i.e. once per bucket and resolution level.
+        """
+        n = 0
+        for module in model.modules():
+            if isinstance(module, CrossAttention):
+                module.att_budget = int(budget_mb * 1e6)
+                module.att_plans = self.attention_plans
+                n += 1
+        print(f"Planning attention chunks of up to {budget_mb} MB for {n} attention layers")
+
+    def plan_tiles(self, *models):
+        """Lets the tiled paths of `models` (UNet and FirstStage) keep their tile grids here, per bucket."""
+        for model in models:
+            model.tile_grids = self.tile_grids
@@ -14,6 +14,7 @@ from tqdm import tqdm
 from ldm.modules.distributions.distributions import DiagonalGaussianDistribution
 from ldm.models.autoencoder import VQModelInterface
 import torch.nn as nn
+import torch.nn.functional as F
 import numpy as np
 import pytorch_lightning as pl
 from functools import partial
@@ -21,8 +22,49 @@ from pytorch_lightning.utilities.distributed import rank_zero_only
 from ldm.util import exists, default, instantiate_from_config
 from ldm.modules.diffusionmodules.util import make_beta_schedule
 from ldm.modules.diffusionmodules.util import make_ddim_sampling_parameters, make_ddim_timesteps, noise_like
+from ldm.modules.diffusionmodules.util import make_timestep_table
 from ldm.modules.diffusionmodules.util import make_beta_schedule, extract_into_tensor, noise_like
-from samplers import CompVisDenoiser, get_ancestral_step, to_d, append_dims,linear_multistep_coeff
+from ldm.modules.diffusionmodules.tiling import apply_tiled, get_tile_grid
+from ldm.models.diffusion.sampling import GuidedModel, K_SAMPLERS, ddim_step, get_schedules, plms_step, sample_k
+from tracing import tracer
+
+def roi_from_mask(mask, margin=8, multiple=8):
+    """
+    Returns the latent box (y0, y1, x0, x1) around the area to repaint (mask < 1), grown by
+    `margin` latent pixels of context on every side and rounded up to a multiple of `multiple`
+    so the unet can still downsample it. Returns None if nothing is masked.
+    """
+    H, W = mask.shape[-2:]
+    region = (mask < 1).reshape(-1, H, W).any(0)
+    ys = torch.nonzero(region.any(1)).flatten()
+    xs = torch.nonzero(region.any(0)).flatten()
+    if len(ys) == 0:
+        return None
+
+    def grow(lo, hi, size):
+        lo, hi = max(lo - margin, 0), min(hi + 1 + margin, size)
+        length = min(-(-(hi - lo) // multiple) * multiple, size)
+        hi = lo + length
+        if hi > size:
+            lo, hi = size - length, size
+        return lo, hi
+
+    y0, y1 = grow(int(ys[0]), int(ys[-1]), H)
+    x0, x1 = grow(int(xs[0]), int(xs[-1]), W)
+    return y0, y1, x0, x1
+
+
+def feather_mask(mask, radius):
+    """
+    Blend weight of the repainted latent: 1 where mask < 1, fading to 0 over `radius` latent
+    pixels outside of it, so the repainted area has no hard seam.
+    """
+    w = 1. - mask
+    if radius <= 0:
+        return w
+    blurred = F.avg_pool2d(w, 2 * radius + 1, stride=1, padding=radius, count_include_pad=False)
+    return torch.maximum(w, torch.clamp(2 * blurred, max=1.))
+
 
 def disabled_train(self):
     """Overwrite model.train with this function to make sure train/eval mode
@@ -141,6 +183,12 @@ class FirstStage(DDPM):
         self.cond_stage_forward = cond_stage_forward
         self.clip_denoised = False
         self.bbox_tokenizer = None  
+        # tiled decoding: window size and overlap in latent pixels, windows per decoder call
+        self.tile = None
+        self.tile_overlap = 16
+        self.tile_batch = 1
+        # tile grids per latent shape, shared across models by bucketing.BucketResources.plan_tiles
+        self.tile_grids = {}
 
         self.restarted_from_ckpt = False
         if ckpt_path is not None:
@@ -175,17 +223,25 @@ class FirstStage(DDPM):
 
         z = 1. / self.scale_factor * z
 
-        if hasattr(self, "split_input_params"):
+        with tracer.span("vae.decode", z.device, batch=z.shape[0]):
+            if self.tile and max(z.shape[-2:]) > self.tile:
+                return self.decode_tiled(z)
             if isinstance(self.first_stage_model, VQModelInterface):
                 return self.first_stage_model.decode(z, force_not_quantize=predict_cids or force_not_quantize)
             else:
                 return self.first_stage_model.decode(z)
 
-        else:
-            if isinstance(self.first_stage_model, VQModelInterface):
-                return self.first_stage_model.decode(z, force_not_quantize=predict_cids or force_not_quantize)
-            else:
-                return self.first_stage_model.decode(z)
+    def decode_tiled(self, z):
+        """Decodes overlapping windows of the (unscaled) latent z and blends them in image space."""
+        h, w = z.shape[-2:]
+        stride = max(1, self.tile - self.tile_overlap)
+        key = ("decode", h, w, self.tile, stride, z.device, z.dtype)
+        grid = self.tile_grids.get(key)
+        if grid is None:
+            grid = self.tile_grids[key] = get_tile_grid(h, w, (self.tile, self.tile), (stride, stride),
+                                                        uf=2 ** self.num_downs, device=z.device, dtype=z.dtype)
+        return apply_tiled(lambda crops, start, end: self.first_stage_model.decode(crops), z, grid,
+                           self.tile_batch)
 
 
     @torch.no_grad()
@@ -196,32 +252,13 @@ class FirstStage(DDPM):
                 stride = self.split_input_params["stride"]  # eg. (64, 64)
                 df = self.split_input_params["vqf"]
                 self.split_input_params['original_image_size'] = x.shape[-2:]
-                bs, nc, h, w = x.shape
-                if ks[0] > h or ks[1] > w:
-                    ks = (min(ks[0], h), min(ks[1], w))
-                    print("reducing Kernel")
-
-                if stride[0] > h or stride[1] > w:
-                    stride = (min(stride[0], h), min(stride[1], w))
-                    print("reducing stride")
-
-                fold, unfold, normalization, weighting = self.get_fold_unfold(x, ks, stride, df=df)
-                z = unfold(x)  # (bn, nc * prod(**ks), L)
-                # Reshape to img shape
-                z = z.view((z.shape[0], -1, ks[0], ks[1], z.shape[-1]))  # (bn, nc, ks[0], ks[1], L )
-
-                output_list = [self.first_stage_model.encode(z[:, :, :, :, i])
-                               for i in range(z.shape[-1])]
-
-                o = torch.stack(output_list, axis=-1)
-                o = o * weighting
-
-                # Reverse reshape to img shape
-                o = o.view((o.shape[0], -1, o.shape[-1]))  # (bn, nc * ks[0] * ks[1], L)
-                # stitch crops together
-                decoded = fold(o)
-                decoded = decoded / normalization
-                return decoded
+                p = self.split_input_params
+                tie = (p["clip_min_tie_weight"], p["clip_max_tie_weight"]) if p["tie_braker"] else None
+                grid = get_tile_grid(x.shape[-2], x.shape[-1], ks, stride, df=df,
+                                     clip_weight=(p["clip_min_weight"], p["clip_max_weight"]), tie_weight=tie,
+                                     device=x.device, dtype=x.dtype)
+                return apply_tiled(lambda crops, start, end: self.first_stage_model.encode(crops), x, grid,
+                                   p.get("tile_batch", 4))
 
             else:
                 return self.first_stage_model.encode(x)
@@ -291,6 +328,10 @@ class CondStage(DDPM):
             self.cond_stage_model = model
 
     def get_learned_conditioning(self, c):
+        with tracer.span("text_encode", getattr(self.cond_stage_model, "device", None)):
+            return self._get_learned_conditioning(c)
+
+    def _get_learned_conditioning(self, c):
         if self.cond_stage_forward is None:
             if hasattr(self.cond_stage_model, 'encode') and callable(self.cond_stage_model.encode):
                 c = self.cond_stage_model.encode(c)
@@ -364,7 +405,13 @@ class UNet(DDPM):
         self.model1.eval()
         self.model2.eval()
         self.turbo = False
+        self.resident = False
         self.unet_bs = unet_bs
+        # tiled denoising: window size and overlap in latent pixels, windows per unet call
+        self.tile = None
+        self.tile_overlap = 16
+        self.tile_batch = 4
+        self.tile_grids = {}
         self.restarted_from_ckpt = False
         if ckpt_path is not None:
             self.init_from_ckpt(ckpt_path, ignore_keys)
@@ -394,46 +441,74 @@ class UNet(DDPM):
 
 
     def apply_model(self, x_noisy, t, cond, return_ids=False):
-          
+
+        if self.tile and max(x_noisy.shape[-2:]) > self.tile:
+            return self.apply_model_tiled(x_noisy, t, cond)
+
         if(not self.turbo):
-            self.model1.to(self.cdevice)
+            with tracer.span("offload", self.cdevice, module="model1"):
+                self.model1.to(self.cdevice)
 
         step = self.unet_bs
-        h,emb,hs = self.model1(x_noisy[0:step], t[:step], cond[:step])
-        bs = cond.shape[0]
-        
-        # assert bs%2 == 0
-        lenhs = len(hs)
-
-        for i in range(step,bs,step):
-            h_temp,emb_temp,hs_temp = self.model1(x_noisy[i:i+step], t[i:i+step], cond[i:i+step])
-            h = torch.cat((h,h_temp))
-            emb = torch.cat((emb,emb_temp))
-            for j in range(lenhs):
-                hs[j] = torch.cat((hs[j], hs_temp[j]))
+        with tracer.span("unet.encode", self.cdevice, batch=cond.shape[0]):
+            h,emb,hs = self.model1(x_noisy[0:step], t[:step], cond[:step])
+            bs = cond.shape[0]
+            
+            # assert bs%2 == 0
+            lenhs = len(hs)
+
+            for i in range(step,bs,step):
+                h_temp,emb_temp,hs_temp = self.model1(x_noisy[i:i+step], t[i:i+step], cond[i:i+step])
+                h = torch.cat((h,h_temp))
+                emb = torch.cat((emb,emb_temp))
+                for j in range(lenhs):
+                    hs[j] = torch.cat((hs[j], hs_temp[j]))
         
 
         if(not self.turbo):
-            self.model1.to("cpu")
-            self.model2.to(self.cdevice)
+            with tracer.span("offload", self.cdevice, module="model1+model2"):
+                self.model1.to("cpu")
+                self.model2.to(self.cdevice)
         
-        hs_temp = [hs[j][:step] for j in range(lenhs)]
-        x_recon = self.model2(h[:step],emb[:step],x_noisy.dtype,hs_temp,cond[:step])
+        with tracer.span("unet.decode", self.cdevice, batch=bs):
+            hs_temp = [hs[j][:step] for j in range(lenhs)]
+            x_recon = self.model2(h[:step],emb[:step],x_noisy.dtype,hs_temp,cond[:step])
 
-        for i in range(step,bs,step):
+            for i in range(step,bs,step):
 
-            hs_temp = [hs[j][i:i+step] for j in range(lenhs)]
-            x_recon1 = self.model2(h[i:i+step],emb[i:i+step],x_noisy.dtype,hs_temp,cond[i:i+step])
-            x_recon = torch.cat((x_recon, x_recon1))
+                hs_temp = [hs[j][i:i+step] for j in range(lenhs)]
+                x_recon1 = self.model2(h[i:i+step],emb[i:i+step],x_noisy.dtype,hs_temp,cond[i:i+step])
+                x_recon = torch.cat((x_recon, x_recon1))
 
         if(not self.turbo):
-            self.model2.to("cpu")
+            with tracer.span("offload", self.cdevice, module="model2"):
+                self.model2.to("cpu")
 
         if isinstance(x_recon, tuple) and not return_ids:
             return x_recon[0]
         else:
             return x_recon
 
+    def apply_model_tiled(self, x_noisy, t, cond):
+        """
+        Denoises overlapping tile x tile windows of the latent, tile_batch windows per unet
+        pass, and blends them, so memory depends on the tile size and not on the image size.
+        """
+        h, w = x_noisy.shape[-2:]
+        stride = max(1, self.tile - self.tile_overlap)
+        key = ("unet", h, w, self.tile, stride, x_noisy.device, x_noisy.dtype)
+        grid = self.tile_grids.get(key)
+        if grid is None:
+            grid = self.tile_grids[key] = get_tile_grid(h, w, (self.tile, self.tile), (stride, stride),
+                                                        device=x_noisy.device, dtype=x_noisy.dtype)
+
+        def denoise(crops, start, end):
+            n = end - start
+            return self.apply_model(crops, t.repeat(n), cond.repeat(n, 1, 1))
+
+        with tracer.span("unet.tiled", self.cdevice, windows=len(grid)):
+            return apply_tiled(denoise, x_noisy, grid, self.tile_batch)
+
     def register_buffer1(self, name, attr):
             if type(attr) == torch.Tensor:
                 if attr.device != torch.device(self.cdevice):
@@ -442,26 +517,23 @@ class UNet(DDPM):
 
     def make_schedule(self, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0., verbose=True):
 
-
-        self.ddim_timesteps = make_ddim_timesteps(ddim_discr_method=ddim_discretize, num_ddim_timesteps=ddim_num_steps,
-                                                  num_ddpm_timesteps=self.num_timesteps,verbose=verbose)
-
-        
         assert self.alphas_cumprod.shape[0] == self.num_timesteps, 'alphas have to be defined for each timestep'
-
+        # computed once per number of steps and eta, sample() and stochastic_encode() call this for every batch
+        schedule = get_schedules(self).ddim(ddim_num_steps, ddim_eta, ddim_discretize, verbose=verbose)
+        self.ddim_timesteps = schedule["timesteps"]
 
         to_torch = lambda x: x.to(self.cdevice)
         self.register_buffer1('betas', to_torch(self.betas))
         self.register_buffer1('alphas_cumprod', to_torch(self.alphas_cumprod))
         # ddim sampling parameters
-        ddim_sigmas, ddim_alphas, ddim_alphas_prev = make_ddim_sampling_parameters(alphacums=self.alphas_cumprod.cpu(),
-                                                                                   ddim_timesteps=self.ddim_timesteps,
-                                                                                   eta=ddim_eta,verbose=verbose)
-        self.register_buffer1('ddim_sigmas', ddim_sigmas)
-        self.register_buffer1('ddim_alphas', ddim_alphas)
-        self.register_buffer1('ddim_alphas_prev', ddim_alphas_prev)
-        self.register_buffer1('ddim_sqrt_one_minus_alphas', np.sqrt(1. - ddim_alphas))
-    
+        self.register_buffer1('ddim_sigmas', schedule["sigmas"])
+        self.register_buffer1('ddim_alphas', schedule["alphas"])
+        self.register_buffer1('ddim_alphas_prev', schedule["alphas_prev"])
+        self.register_buffer1('ddim_sqrt_one_minus_alphas', schedule["sqrt_one_minus_alphas"])
+        # update coefficients of every step, indexed on the device during sampling
+        self.ddim_eta = ddim_eta
+        self.register_buffer1('ddim_coefficients', schedule["coefficients"])
+
 
     @torch.no_grad()
     def sample(self,
@@ -485,26 +557,36 @@ class UNet(DDPM):
                log_every_t=100,
                unconditional_guidance_scale=1.,
                unconditional_conditioning=None,
+               roi=False,
+               roi_margin=8,
+               roi_feather=4,
+               cfg_skip_last=0,
+               cfg_skip_delta=0.,
+               cfg_schedule=None,
                ):
         
 
         if(self.turbo):
-            self.model1.to(self.cdevice)
-            self.model2.to(self.cdevice)
+            with tracer.span("offload", self.cdevice, module="unet"):
+                self.model1.to(self.cdevice)
+                self.model2.to(self.cdevice)
 
         if x0 is None:
             batch_size, b1, b2, b3 = shape
             img_shape = (1, b1, b2, b3)
             tens = []
-            print("seeds used = ", [seed+s for s in range(batch_size)])
-            for _ in range(batch_size):
-                torch.manual_seed(seed)
+            # either the seed of the first image or one seed per image
+            seeds = list(seed) if isinstance(seed, (list, tuple)) else [seed+s for s in range(batch_size)]
+            print("seeds used = ", seeds)
+            for s in seeds:
+                torch.manual_seed(s)
                 tens.append(torch.randn(img_shape, device=self.cdevice))
-                seed+=1
             noise = torch.cat(tens)
             del tens
 
         x_latent = noise if x0 is None else x0
+        # when and how strongly to guide, see GuidedModel
+        guidance = dict(skip_last=cfg_skip_last, skip_delta=cfg_skip_delta, cfg_schedule=cfg_schedule)
         # sampling
         
         if sampler == "plms":
@@ -523,41 +605,25 @@ class UNet(DDPM):
                                         log_every_t=log_every_t,
                                         unconditional_guidance_scale=unconditional_guidance_scale,
                                         unconditional_conditioning=unconditional_conditioning,
+                                        guidance=guidance,
                                         )
 
         elif sampler == "ddim":
             samples = self.ddim_sampling(x_latent, conditioning, S, unconditional_guidance_scale=unconditional_guidance_scale,
                                          unconditional_conditioning=unconditional_conditioning,
-                                         mask = mask,init_latent=x_T,use_original_steps=False)
-
-        elif sampler == "euler":
-            self.make_schedule(ddim_num_steps=S, ddim_eta=eta, verbose=False)
-            samples = self.euler_sampling(self.alphas_cumprod,x_latent, S, conditioning, unconditional_conditioning=unconditional_conditioning,
-                                        unconditional_guidance_scale=unconditional_guidance_scale)
-        elif sampler == "euler_a":
-            self.make_schedule(ddim_num_steps=S, ddim_eta=eta, verbose=False)
-            samples = self.euler_ancestral_sampling(self.alphas_cumprod,x_latent, S, conditioning, unconditional_conditioning=unconditional_conditioning,
-                                        unconditional_guidance_scale=unconditional_guidance_scale)
-
-        elif sampler == "dpm2":
-            samples = self.dpm_2_sampling(self.alphas_cumprod,x_latent, S, conditioning, unconditional_conditioning=unconditional_conditioning,
-                                        unconditional_guidance_scale=unconditional_guidance_scale)
-        elif sampler == "heun":
-            samples = self.heun_sampling(self.alphas_cumprod,x_latent, S, conditioning, unconditional_conditioning=unconditional_conditioning,
-                                        unconditional_guidance_scale=unconditional_guidance_scale)
-
-        elif sampler == "dpm2_a":
-            samples = self.dpm_2_ancestral_sampling(self.alphas_cumprod,x_latent, S, conditioning, unconditional_conditioning=unconditional_conditioning,
-                                        unconditional_guidance_scale=unconditional_guidance_scale)
+                                         mask = mask,init_latent=x_T,use_original_steps=False,
+                                         roi=roi, roi_margin=roi_margin, roi_feather=roi_feather,
+                                         guidance=guidance)
 
+        elif sampler in K_SAMPLERS:
+            samples = sample_k(sampler, self, x_latent, S, conditioning, unconditional_conditioning,
+                               unconditional_guidance_scale,
+                               steps=lambda n: tracer.steps(trange(n), self.cdevice), **guidance)
 
-        elif sampler == "lms":
-            samples = self.lms_sampling(self.alphas_cumprod,x_latent, S, conditioning, unconditional_conditioning=unconditional_conditioning,
-                                        unconditional_guidance_scale=unconditional_guidance_scale)
-
-        if(self.turbo):
-            self.model1.to("cpu")
-            self.model2.to("cpu")
+        if(self.turbo and not self.resident):
+            with tracer.span("offload", self.cdevice, module="unet"):
+                self.model1.to("cpu")
+                self.model2.to("cpu")
 
         return samples
 
@@ -567,7 +633,7 @@ class UNet(DDPM):
                       callback=None, quantize_denoised=False,
                       mask=None, x0=None, img_callback=None, log_every_t=100,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
-                      unconditional_guidance_scale=1., unconditional_conditioning=None,):
+                      unconditional_guidance_scale=1., unconditional_conditioning=None, guidance=None):
         
         device = self.betas.device
         timesteps = self.ddim_timesteps
@@ -577,100 +643,34 @@ class UNet(DDPM):
 
         iterator = tqdm(time_range, desc='PLMS Sampler', total=total_steps)
         old_eps = []
+        ts_table = make_timestep_table(time_range, b, device)
+        model = GuidedModel(self, cond, unconditional_conditioning, unconditional_guidance_scale,
+                            score_corrector, corrector_kwargs, **(guidance or {}))
+        quantize = self.first_stage_model.quantize if quantize_denoised else None
+        sigmas = get_schedules(self).sigmas
 
-        for i, step in enumerate(iterator):
+        for i, step in enumerate(tracer.steps(iterator, device)):
             index = total_steps - i - 1
-            ts = torch.full((b,), step, device=device, dtype=torch.long)
-            ts_next = torch.full((b,), time_range[min(i + 1, len(time_range) - 1)], device=device, dtype=torch.long)
+            ts = ts_table[i]
+            ts_next = ts_table[min(i + 1, len(time_range) - 1)]
 
             if mask is not None:
                 assert x0 is not None
                 img_orig = self.q_sample(x0, ts)  # TODO: deterministic forward pass?
                 img = img_orig * mask + (1. - mask) * img
 
-            outs = self.p_sample_plms(img, cond, ts, index=index, use_original_steps=ddim_use_original_steps,
-                                      quantize_denoised=quantize_denoised, temperature=temperature,
-                                      noise_dropout=noise_dropout, score_corrector=score_corrector,
-                                      corrector_kwargs=corrector_kwargs,
-                                      unconditional_guidance_scale=unconditional_guidance_scale,
-                                      unconditional_conditioning=unconditional_conditioning,
-                                      old_eps=old_eps, t_next=ts_next)
-            img, pred_x0, e_t = outs
+            model.start_step(i, total_steps, sigmas[step])
+            img, pred_x0, e_t = plms_step(model, img, ts, ts_next, self.ddim_coefficients, index, old_eps,
+                                          quantize=quantize)
             old_eps.append(e_t)
             if len(old_eps) >= 4:
                 old_eps.pop(0)
             if callback: callback(i)
             if img_callback: img_callback(pred_x0, i)
 
+        model.report(total_steps)
         return img
 
-    @torch.no_grad()
-    def p_sample_plms(self, x, c, t, index, repeat_noise=False, use_original_steps=False, quantize_denoised=False,
-                      temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
-                      unconditional_guidance_scale=1., unconditional_conditioning=None, old_eps=None, t_next=None):
-        b, *_, device = *x.shape, x.device
-
-        def get_model_output(x, t):
-            if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
-                e_t = self.apply_model(x, t, c)
-            else:
-                x_in = torch.cat([x] * 2)
-                t_in = torch.cat([t] * 2)
-                c_in = torch.cat([unconditional_conditioning, c])
-                e_t_uncond, e_t = self.apply_model(x_in, t_in, c_in).chunk(2)
-                e_t = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
-
-            if score_corrector is not None:
-                assert self.parameterization == "eps"
-                e_t = score_corrector.modify_score(self.model, e_t, x, t, c, **corrector_kwargs)
-
-            return e_t
-
-        alphas =  self.ddim_alphas
-        alphas_prev = self.ddim_alphas_prev
-        sqrt_one_minus_alphas = self.ddim_sqrt_one_minus_alphas
-        sigmas = self.ddim_sigmas
-
-        def get_x_prev_and_pred_x0(e_t, index):
-            # select parameters corresponding to the currently considered timestep
-            a_t = torch.full((b, 1, 1, 1), alphas[index], device=device)
-            a_prev = torch.full((b, 1, 1, 1), alphas_prev[index], device=device)
-            sigma_t = torch.full((b, 1, 1, 1), sigmas[index], device=device)
-            sqrt_one_minus_at = torch.full((b, 1, 1, 1), sqrt_one_minus_alphas[index],device=device)
-
-            # current prediction for x_0
-            pred_x0 = (x - sqrt_one_minus_at * e_t) / a_t.sqrt()
-            if quantize_denoised:
-                pred_x0, _, *_ = self.first_stage_model.quantize(pred_x0)
-            # direction pointing to x_t
-            dir_xt = (1. - a_prev - sigma_t**2).sqrt() * e_t
-            noise = sigma_t * noise_like(x.shape, device, repeat_noise) * temperature
-            if noise_dropout > 0.:
-                noise = torch.nn.functional.dropout(noise, p=noise_dropout)
-            x_prev = a_prev.sqrt() * pred_x0 + dir_xt + noise
-            return x_prev, pred_x0
-
-        e_t = get_model_output(x, t)
-        if len(old_eps) == 0:
-            # Pseudo Improved Euler (2nd order)
-            x_prev, pred_x0 = get_x_prev_and_pred_x0(e_t, index)
-            e_t_next = get_model_output(x_prev, t_next)
-            e_t_prime = (e_t + e_t_next) / 2
-        elif len(old_eps) == 1:
-            # 2nd order Pseudo Linear Multistep (Adams-Bashforth)
-            e_t_prime = (3 * e_t - old_eps[-1]) / 2
-        elif len(old_eps) == 2:
-            # 3nd order Pseudo Linear Multistep (Adams-Bashforth)
-            e_t_prime = (23 * e_t - 16 * old_eps[-1] + 5 * old_eps[-2]) / 12
-        elif len(old_eps) >= 3:
-            # 4nd order Pseudo Linear Multistep (Adams-Bashforth)
-            e_t_prime = (55 * e_t - 59 * old_eps[-1] + 37 * old_eps[-2] - 9 * old_eps[-3]) / 24
-
-        x_prev, pred_x0 = get_x_prev_and_pred_x0(e_t_prime, index)
-
-        return x_prev, pred_x0, e_t
-
-
     @torch.no_grad()
     def stochastic_encode(self, x0, t, seed, ddim_eta,ddim_steps,use_original_steps=False, noise=None):
         # fast, but does not allow for exact reconstruction
@@ -682,11 +682,12 @@ class UNet(DDPM):
             b0, b1, b2, b3 = x0.shape
             img_shape = (1, b1, b2, b3)
             tens = []
-            print("seeds used = ", [seed+s for s in range(b0)])
-            for _ in range(b0):
-                torch.manual_seed(seed)
+            # either the seed of the first image or one seed per image
+            seeds = list(seed) if isinstance(seed, (list, tuple)) else [seed+s for s in range(b0)]
+            print("seeds used = ", seeds)
+            for s in seeds:
+                torch.manual_seed(s)
                 tens.append(torch.randn(img_shape, device=x0.device))
-                seed+=1
             noise = torch.cat(tens)
             del tens
         return (extract_into_tensor(sqrt_alphas_cumprod, t, x0.shape) * x0 +
@@ -706,8 +707,26 @@ class UNet(DDPM):
 
     @torch.no_grad()
     def ddim_sampling(self, x_latent, cond, t_start, unconditional_guidance_scale=1.0, unconditional_conditioning=None,
-               mask = None,init_latent=None,use_original_steps=False):
+               mask = None,init_latent=None,use_original_steps=False, roi=False, roi_margin=8, roi_feather=4,
+               guidance=None):
+
+        if mask is not None and roi:
+            return self.roi_ddim_sampling(x_latent, cond, t_start, unconditional_guidance_scale,
+                                          unconditional_conditioning, mask, init_latent, use_original_steps,
+                                          roi_margin, roi_feather, guidance)
+
+        x0 = init_latent
+        x_dec = self.ddim_loop(x_latent, cond, t_start, unconditional_guidance_scale, unconditional_conditioning,
+                               mask, x0, use_original_steps, guidance)
+        
+        if mask is not None:
+            return x0 * mask + (1. - mask) * x_dec
 
+        return x_dec
+
+    @torch.no_grad()
+    def ddim_loop(self, x_latent, cond, t_start, unconditional_guidance_scale, unconditional_conditioning,
+                  mask, x0, use_original_steps, guidance=None):
         timesteps = self.ddim_timesteps
         timesteps = timesteps[:t_start]
         time_range = np.flip(timesteps)
@@ -716,315 +735,47 @@ class UNet(DDPM):
 
         iterator = tqdm(time_range, desc='Decoding image', total=total_steps)
         x_dec = x_latent
-        x0 = init_latent
-        for i, step in enumerate(iterator):
+        ts_table = make_timestep_table(time_range, x_latent.shape[0], x_latent.device)
+        model = GuidedModel(self, cond, unconditional_conditioning, unconditional_guidance_scale, **(guidance or {}))
+        sigmas = get_schedules(self).sigmas
+        for i, step in enumerate(tracer.steps(iterator, x_latent.device)):
             index = total_steps - i - 1
-            ts = torch.full((x_latent.shape[0],), step, device=x_latent.device, dtype=torch.long)            
+            ts = ts_table[i]
 
             if mask is not None:
                 # x0_noisy = self.add_noise(mask, torch.tensor([index] * x0.shape[0]).to(self.cdevice))
                 x0_noisy = x0
                 x_dec = x0_noisy* mask + (1. - mask) * x_dec
 
-            x_dec = self.p_sample_ddim(x_dec, cond, ts, index=index, use_original_steps=use_original_steps,
-                                          unconditional_guidance_scale=unconditional_guidance_scale,
-                                          unconditional_conditioning=unconditional_conditioning)
-        
-        if mask is not None:
-            return x0 * mask + (1. - mask) * x_dec
-
+            model.start_step(i, total_steps, sigmas[step])
+            x_dec, _ = ddim_step(model, x_dec, ts, self.ddim_coefficients, index, self.ddim_eta)
+        model.report(total_steps)
         return x_dec
 
-
-    @torch.no_grad()
-    def p_sample_ddim(self, x, c, t, index, repeat_noise=False, use_original_steps=False, quantize_denoised=False,
-                      temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
-                      unconditional_guidance_scale=1., unconditional_conditioning=None):
-        b, *_, device = *x.shape, x.device
-
-        if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
-            e_t = self.apply_model(x, t, c)
-        else:
-            x_in = torch.cat([x] * 2)
-            t_in = torch.cat([t] * 2)
-            c_in = torch.cat([unconditional_conditioning, c])
-            e_t_uncond, e_t = self.apply_model(x_in, t_in, c_in).chunk(2)
-            e_t = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
-
-        if score_corrector is not None:
-            assert self.model.parameterization == "eps"
-            e_t = score_corrector.modify_score(self.model, e_t, x, t, c, **corrector_kwargs)
-
-        alphas = self.ddim_alphas
-        alphas_prev = self.ddim_alphas_prev
-        sqrt_one_minus_alphas = self.ddim_sqrt_one_minus_alphas
-        sigmas = self.ddim_sigmas
-        # select parameters corresponding to the currently considered timestep
-        a_t = torch.full((b, 1, 1, 1), alphas[index], device=device)
-        a_prev = torch.full((b, 1, 1, 1), alphas_prev[index], device=device)
-        sigma_t = torch.full((b, 1, 1, 1), sigmas[index], device=device)
-        sqrt_one_minus_at = torch.full((b, 1, 1, 1), sqrt_one_minus_alphas[index],device=device)
-
-        # current prediction for x_0
-        pred_x0 = (x - sqrt_one_minus_at * e_t) / a_t.sqrt()
-        if quantize_denoised:
-            pred_x0, _, *_ = self.first_stage_model.quantize(pred_x0)
-        # direction pointing to x_t
-        dir_xt = (1. - a_prev - sigma_t**2).sqrt() * e_t
-        noise = sigma_t * noise_like(x.shape, device, repeat_noise) * temperature
-        if noise_dropout > 0.:
-            noise = torch.nn.functional.dropout(noise, p=noise_dropout)
-        x_prev = a_prev.sqrt() * pred_x0 + dir_xt + noise
-        return x_prev
-
-
-    @torch.no_grad()
-    def euler_sampling(self, ac, x, S, cond, unconditional_conditioning = None, unconditional_guidance_scale = 1,extra_args=None,callback=None, disable=None, s_churn=0., s_tmin=0., s_tmax=float('inf'), s_noise=1.):
-        """Implements Algorithm 2 (Euler steps) from Karras et al. (2022)."""
-        extra_args = {} if extra_args is None else extra_args
-        cvd = CompVisDenoiser(ac)
-        sigmas = cvd.get_sigmas(S)
-        x = x*sigmas[0]
-
-        s_in = x.new_ones([x.shape[0]]).half()
-        for i in trange(len(sigmas) - 1, disable=disable):
-            gamma = min(s_churn / (len(sigmas) - 1), 2 ** 0.5 - 1) if s_tmin <= sigmas[i] <= s_tmax else 0.
-            eps = torch.randn_like(x) * s_noise
-            sigma_hat = (sigmas[i] * (gamma + 1)).half()
-            if gamma > 0:
-                x = x + eps * (sigma_hat ** 2 - sigmas[i] ** 2) ** 0.5
-
-            s_i = sigma_hat * s_in
-            x_in = torch.cat([x] * 2)
-            t_in = torch.cat([s_i] * 2)
-            cond_in = torch.cat([unconditional_conditioning, cond])
-            c_out, c_in = [append_dims(tmp, x_in.ndim) for tmp in cvd.get_scalings(t_in)]
-            eps = self.apply_model(x_in * c_in, cvd.sigma_to_t(t_in), cond_in)
-            e_t_uncond, e_t = (x_in  + eps * c_out).chunk(2)
-            denoised = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
-
-
-            d = to_d(x, sigma_hat, denoised)
-            if callback is not None:
-                callback({'x': x, 'i': i, 'sigma': sigmas[i], 'sigma_hat': sigma_hat, 'denoised': denoised})
-            dt = sigmas[i + 1] - sigma_hat
-            # Euler method
-            x = x + d * dt
-        return x
-
-    @torch.no_grad()
-    def euler_ancestral_sampling(self,ac,x, S, cond, unconditional_conditioning = None, unconditional_guidance_scale = 1,extra_args=None, callback=None, disable=None):
-        """Ancestral sampling with Euler method steps."""
-        extra_args = {} if extra_args is None else extra_args
-
-
-        cvd = CompVisDenoiser(ac)
-        sigmas = cvd.get_sigmas(S)
-        x = x*sigmas[0]
-
-        s_in = x.new_ones([x.shape[0]]).half()
-        for i in trange(len(sigmas) - 1, disable=disable):
-
-            s_i = sigmas[i] * s_in
-            x_in = torch.cat([x] * 2)
-            t_in = torch.cat([s_i] * 2)
-            cond_in = torch.cat([unconditional_conditioning, cond])
-            c_out, c_in = [append_dims(tmp, x_in.ndim) for tmp in cvd.get_scalings(t_in)]
-            eps = self.apply_model(x_in * c_in, cvd.sigma_to_t(t_in), cond_in)
-            e_t_uncond, e_t = (x_in  + eps * c_out).chunk(2)
-            denoised = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
-
-            sigma_down, sigma_up = get_ancestral_step(sigmas[i], sigmas[i + 1])
-            if callback is not None:
-                callback({'x': x, 'i': i, 'sigma': sigmas[i], 'sigma_hat': sigmas[i], 'denoised': denoised})
-            d = to_d(x, sigmas[i], denoised)
-            # Euler method
-            dt = sigma_down - sigmas[i]
-            x = x + d * dt
-            x = x + torch.randn_like(x) * sigma_up
-        return x
-
-
-
     @torch.no_grad()
-    def heun_sampling(self, ac, x, S, cond, unconditional_conditioning = None, unconditional_guidance_scale = 1, extra_args=None, callback=None, disable=None, s_churn=0., s_tmin=0., s_tmax=float('inf'), s_noise=1.):
-        """Implements Algorithm 2 (Heun steps) from Karras et al. (2022)."""
-        extra_args = {} if extra_args is None else extra_args
-
-        cvd = CompVisDenoiser(alphas_cumprod=ac)
-        sigmas = cvd.get_sigmas(S)
-        x = x*sigmas[0]
-
-
-        s_in = x.new_ones([x.shape[0]]).half()
-        for i in trange(len(sigmas) - 1, disable=disable):
-            gamma = min(s_churn / (len(sigmas) - 1), 2 ** 0.5 - 1) if s_tmin <= sigmas[i] <= s_tmax else 0.
-            eps = torch.randn_like(x) * s_noise
-            sigma_hat = (sigmas[i] * (gamma + 1)).half()
-            if gamma > 0:
-                x = x + eps * (sigma_hat ** 2 - sigmas[i] ** 2) ** 0.5
-
-            s_i = sigma_hat * s_in
-            x_in = torch.cat([x] * 2)
-            t_in = torch.cat([s_i] * 2)
-            cond_in = torch.cat([unconditional_conditioning, cond])
-            c_out, c_in = [append_dims(tmp, x_in.ndim) for tmp in cvd.get_scalings(t_in)]
-            eps = self.apply_model(x_in * c_in, cvd.sigma_to_t(t_in), cond_in)
-            e_t_uncond, e_t = (x_in  + eps * c_out).chunk(2)
-            denoised = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
-
-            d = to_d(x, sigma_hat, denoised)
-            if callback is not None:
-                callback({'x': x, 'i': i, 'sigma': sigmas[i], 'sigma_hat': sigma_hat, 'denoised': denoised})
-            dt = sigmas[i + 1] - sigma_hat
-            if sigmas[i + 1] == 0:
-                # Euler method
-                x = x + d * dt
-            else:
-                # Heun's method
-                x_2 = x + d * dt
-                s_i = sigmas[i + 1] * s_in
-                x_in = torch.cat([x_2] * 2)
-                t_in = torch.cat([s_i] * 2)
-                cond_in = torch.cat([unconditional_conditioning, cond])
-                c_out, c_in = [append_dims(tmp, x_in.ndim) for tmp in cvd.get_scalings(t_in)]
-                eps = self.apply_model(x_in * c_in, cvd.sigma_to_t(t_in), cond_in)
-                e_t_uncond, e_t = (x_in  + eps * c_out).chunk(2)
-                denoised_2 = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
-
-                d_2 = to_d(x_2, sigmas[i + 1], denoised_2)
-                d_prime = (d + d_2) / 2
-                x = x + d_prime * dt
-        return x
-
-
-    @torch.no_grad()
-    def dpm_2_sampling(self,ac,x, S, cond, unconditional_conditioning = None, unconditional_guidance_scale = 1,extra_args=None, callback=None, disable=None, s_churn=0., s_tmin=0., s_tmax=float('inf'), s_noise=1.):
-        """A sampler inspired by DPM-Solver-2 and Algorithm 2 from Karras et al. (2022)."""
-        extra_args = {} if extra_args is None else extra_args
-
-        cvd = CompVisDenoiser(ac)
-        sigmas = cvd.get_sigmas(S)
-        x = x*sigmas[0]
-
-        s_in = x.new_ones([x.shape[0]]).half()
-        for i in trange(len(sigmas) - 1, disable=disable):
-            gamma = min(s_churn / (len(sigmas) - 1), 2 ** 0.5 - 1) if s_tmin <= sigmas[i] <= s_tmax else 0.
-            eps = torch.randn_like(x) * s_noise
-            sigma_hat = sigmas[i] * (gamma + 1)
-            if gamma > 0:
-                x = x + eps * (sigma_hat ** 2 - sigmas[i] ** 2) ** 0.5
-
-            s_i = sigma_hat * s_in
-            x_in = torch.cat([x] * 2)
-            t_in = torch.cat([s_i] * 2)
-            cond_in = torch.cat([unconditional_conditioning, cond])
-            c_out, c_in = [append_dims(tmp, x_in.ndim) for tmp in cvd.get_scalings(t_in)]
-            eps = self.apply_model(x_in * c_in, cvd.sigma_to_t(t_in), cond_in)
-            e_t_uncond, e_t = (x_in  + eps * c_out).chunk(2)
-            denoised = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
-
-
-            
-            d = to_d(x, sigma_hat, denoised)
-            # Midpoint method, where the midpoint is chosen according to a rho=3 Karras schedule
-            sigma_mid = ((sigma_hat ** (1 / 3) + sigmas[i + 1] ** (1 / 3)) / 2) ** 3
-            dt_1 = sigma_mid - sigma_hat
-            dt_2 = sigmas[i + 1] - sigma_hat
-            x_2 = x + d * dt_1
-
-            s_i = sigma_mid * s_in
-            x_in = torch.cat([x_2] * 2)
-            t_in = torch.cat([s_i] * 2)
-            cond_in = torch.cat([unconditional_conditioning, cond])
-            c_out, c_in = [append_dims(tmp, x_in.ndim) for tmp in cvd.get_scalings(t_in)]
-            eps = self.apply_model(x_in * c_in, cvd.sigma_to_t(t_in), cond_in)
-            e_t_uncond, e_t = (x_in  + eps * c_out).chunk(2)
-            denoised_2 = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
-
-
-            d_2 = to_d(x_2, sigma_mid, denoised_2)
-            x = x + d_2 * dt_2
-        return x
-
-
-    @torch.no_grad()
-    def dpm_2_ancestral_sampling(self,ac,x, S, cond, unconditional_conditioning = None, unconditional_guidance_scale = 1, extra_args=None, callback=None, disable=None):
-        """Ancestral sampling with DPM-Solver inspired second-order steps."""
-        extra_args = {} if extra_args is None else extra_args
-
-        cvd = CompVisDenoiser(ac)
-        sigmas = cvd.get_sigmas(S)
-        x = x*sigmas[0]
-
-        s_in = x.new_ones([x.shape[0]]).half()
-        for i in trange(len(sigmas) - 1, disable=disable):
-
-            s_i =  sigmas[i] * s_in
-            x_in = torch.cat([x] * 2)
-            t_in = torch.cat([s_i] * 2)
-            cond_in = torch.cat([unconditional_conditioning, cond])
-            c_out, c_in = [append_dims(tmp, x_in.ndim) for tmp in cvd.get_scalings(t_in)]
-            eps = self.apply_model(x_in * c_in, cvd.sigma_to_t(t_in), cond_in)
-            e_t_uncond, e_t = (x_in  + eps * c_out).chunk(2)
-            denoised = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
-
-
-            sigma_down, sigma_up = get_ancestral_step(sigmas[i], sigmas[i + 1])
-            if callback is not None:
-                callback({'x': x, 'i': i, 'sigma': sigmas[i], 'sigma_hat': sigmas[i], 'denoised': denoised})
-            d = to_d(x, sigmas[i], denoised)
-            # Midpoint method, where the midpoint is chosen according to a rho=3 Karras schedule
-            sigma_mid = ((sigmas[i] ** (1 / 3) + sigma_down ** (1 / 3)) / 2) ** 3
-            dt_1 = sigma_mid - sigmas[i]
-            dt_2 = sigma_down - sigmas[i]
-            x_2 = x + d * dt_1
-
-            s_i = sigma_mid * s_in
-            x_in = torch.cat([x_2] * 2)
-            t_in = torch.cat([s_i] * 2)
-            cond_in = torch.cat([unconditional_conditioning, cond])
-            c_out, c_in = [append_dims(tmp, x_in.ndim) for tmp in cvd.get_scalings(t_in)]
-            eps = self.apply_model(x_in * c_in, cvd.sigma_to_t(t_in), cond_in)
-            e_t_uncond, e_t = (x_in  + eps * c_out).chunk(2)
-            denoised_2 = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
-
-
-            d_2 = to_d(x_2, sigma_mid, denoised_2)
-            x = x + d_2 * dt_2
-            x = x + torch.randn_like(x) * sigma_up
-        return x
-
-
-    @torch.no_grad()
-    def lms_sampling(self,ac,x, S, cond, unconditional_conditioning = None, unconditional_guidance_scale = 1, extra_args=None, callback=None, disable=None, order=4):
-        extra_args = {} if extra_args is None else extra_args
-        s_in = x.new_ones([x.shape[0]])
-
-        cvd = CompVisDenoiser(ac)
-        sigmas = cvd.get_sigmas(S)
-        x = x*sigmas[0]
-
-        ds = []
-        for i in trange(len(sigmas) - 1, disable=disable):
-
-            s_i =  sigmas[i] * s_in
-            x_in = torch.cat([x] * 2)
-            t_in = torch.cat([s_i] * 2)
-            cond_in = torch.cat([unconditional_conditioning, cond])
-            c_out, c_in = [append_dims(tmp, x_in.ndim) for tmp in cvd.get_scalings(t_in)]
-            eps = self.apply_model(x_in * c_in, cvd.sigma_to_t(t_in), cond_in)
-            e_t_uncond, e_t = (x_in  + eps * c_out).chunk(2)
-            denoised = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
-
-
-            d = to_d(x, sigmas[i], denoised)
-            ds.append(d)
-            if len(ds) > order:
-                ds.pop(0)
-            if callback is not None:
-                callback({'x': x, 'i': i, 'sigma': sigmas[i], 'sigma_hat': sigmas[i], 'denoised': denoised})
-            cur_order = min(i + 1, order)
-            coeffs = [linear_multistep_coeff(cur_order, sigmas.cpu(), i, j) for j in range(cur_order)]
-            x = x + sum(coeff * d for coeff, d in zip(coeffs, reversed(ds)))
-        return x
+    def roi_ddim_sampling(self, x_latent, cond, t_start, unconditional_guidance_scale, unconditional_conditioning,
+                          mask, init_latent, use_original_steps, margin=8, feather=4, guidance=None):
+        """
+        Inpainting that only denoises the bounding box of the masked area plus `margin` latent
+        pixels of context. The result is pasted into init_latent with a mask feathered over
+        `feather` latent pixels. Everything outside the box stays untouched.
+        """
+        assert init_latent is not None, "roi inpainting needs the latent of the original image"
+        box = roi_from_mask(mask, max(margin, feather))
+        if box is None:
+            print("Nothing to inpaint, the mask is empty")
+            return init_latent
+        y0, y1, x0, x1 = box
+        H, W = mask.shape[-2:]
+        print(f"Inpainting latent region [{y0}:{y1}, {x0}:{x1}] of {H}x{W} "
+              f"({100 * (y1 - y0) * (x1 - x0) / (H * W):.0f}% of the image)")
+
+        crop = (Ellipsis, slice(y0, y1), slice(x0, x1))
+        x0_crop, mask_crop = init_latent[crop], mask[crop]
+        x_dec = self.ddim_loop(x_latent[crop], cond, t_start, unconditional_guidance_scale,
+                               unconditional_conditioning, mask_crop, x0_crop, use_original_steps, guidance)
+
+        w = feather_mask(mask_crop, feather).to(x_dec.dtype)
+        out = init_latent.clone()
+        out[crop] = x0_crop * (1. - w) + x_dec * w
+        return out
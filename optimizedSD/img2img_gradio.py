@@ -21,7 +21,9 @@ from contextlib import nullcontext
 from ldm.util import instantiate_from_config
 from transformers import logging
 import pandas as pd
-from optimUtils import split_weighted_subprompts, logger
+from optimUtils import logger
+from latent_cache import LatentCache
+from pipeline import get_conditioning
 logging.set_verbosity_error()
 import mimetypes
 mimetypes.init()
@@ -93,6 +95,7 @@ modelFS = instantiate_from_config(config.modelFirstStage)
 _, _ = modelFS.load_state_dict(sd, strict=False)
 modelFS.eval()
 del sd
+latent_cache = LatentCache()
 
 def generate(
     image,
@@ -112,6 +115,8 @@ def generate(
     img_format,
     turbo,
     full_precision,
+    negative_prompt,
+    cfg_skip_last,
 ):
 
     if seed == "":
@@ -123,7 +128,6 @@ def generate(
     sampler = "ddim"
     logger(locals(), log_csv = "logs/img2img_gradio_logs.csv")
 
-    init_image = load_img(image, Height, Width).to(device)
     model.unet_bs = unet_bs
     model.turbo = turbo
     model.cdevice = device
@@ -133,7 +137,6 @@ def generate(
         model.half()
         modelCS.half()
         modelFS.half()
-        init_image = init_image.half()
 
     tic = time.time()
     os.makedirs(outdir, exist_ok=True)
@@ -146,16 +149,9 @@ def generate(
     assert prompt is not None
     data = [batch_size * [prompt]]
 
-    modelFS.to(device)
-
-    init_image = repeat(init_image, "1 ... -> b ...", b=batch_size)
-    init_latent = modelFS.get_first_stage_encoding(modelFS.encode_first_stage(init_image))  # move to latent space
-
-    if device != "cpu":
-        mem = torch.cuda.memory_allocated() / 1e6
-        modelFS.to("cpu")
-        while torch.cuda.memory_allocated() / 1e6 >= mem:
-            time.sleep(1)
+    # move to latent space, repeated requests on the same image reuse its encoding
+    precision = "full" if full_precision else "autocast"
+    init_latent = latent_cache.init_latent(modelFS, image, Height, Width, device, precision, load_img, batch_size)
 
     assert 0.0 <= strength <= 1.0, "can only work with strength in [0.0, 1.0]"
     t_enc = int(strength * ddim_steps)
@@ -174,24 +170,9 @@ def generate(
             for prompts in tqdm(data, desc="data"):
                 with precision_scope("cuda"):
                     modelCS.to(device)
-                    uc = None
-                    if scale != 1.0:
-                        uc = modelCS.get_learned_conditioning(batch_size * [""])
                     if isinstance(prompts, tuple):
                         prompts = list(prompts)
-
-                    subprompts, weights = split_weighted_subprompts(prompts[0])
-                    if len(subprompts) > 1:
-                        c = torch.zeros_like(uc)
-                        totalWeight = sum(weights)
-                        # normalize each "sub prompt" and add it
-                        for i in range(len(subprompts)):
-                            weight = weights[i]
-                            # if not skip_normalize:
-                            weight = weight / totalWeight
-                            c = torch.add(c, modelCS.get_learned_conditioning(subprompts[i]), alpha=weight)
-                    else:
-                        c = modelCS.get_learned_conditioning(prompts)
+                    c, uc = get_conditioning(modelCS, prompts, scale, negative_prompt)
 
                     if device != "cpu":
                         mem = torch.cuda.memory_allocated() / 1e6
@@ -210,7 +191,8 @@ def generate(
                                     z_enc,
                                     unconditional_guidance_scale=scale,
                                     unconditional_conditioning=uc,
-                                    sampler = sampler
+                                    sampler = sampler,
+                                    cfg_skip_last=int(cfg_skip_last),
                     )
 
                     modelFS.to(device)
@@ -277,6 +259,8 @@ demo = gr.Interface(
         gr.Radio(["png", "jpg"], value='png'),
         "checkbox",
         "checkbox",
+        gr.Text(value="", label="negative prompt"),
+        gr.Slider(0, 50, value=0, step=1, label="cfg_skip_last (steps at the end without guidance)"),
     ],
     outputs=["image", "text"],
 )
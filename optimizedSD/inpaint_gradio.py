@@ -19,7 +19,9 @@ from tqdm import tqdm, trange
 from transformers import logging
 
 from ldm.util import instantiate_from_config
-from optimUtils import split_weighted_subprompts, logger
+from optimUtils import logger
+from latent_cache import LatentCache
+from pipeline import get_conditioning
 
 logging.set_verbosity_error()
 import mimetypes
@@ -102,6 +104,10 @@ def generate(
         img_format,
         turbo,
         full_precision,
+        roi,
+        roi_margin,
+        negative_prompt,
+        cfg_skip_last,
 ):
     if seed == "":
         seed = randint(0, 1000000)
@@ -112,8 +118,6 @@ def generate(
     # Logging
     logger(locals(), log_csv="logs/inpaint_gradio_logs.csv")
 
-    init_image = load_img(image['image'], Height, Width).to(device)
-
     model.unet_bs = unet_bs
     model.turbo = turbo
     model.cdevice = device
@@ -123,8 +127,6 @@ def generate(
         model.half()
         modelCS.half()
         modelFS.half()
-        init_image = init_image.half()
-        # mask.half()
 
     tic = time.time()
     os.makedirs(outdir, exist_ok=True)
@@ -137,9 +139,9 @@ def generate(
     assert prompt is not None
     data = [batch_size * [prompt]]
 
-    modelFS.to(device)
-
-    init_latent = modelFS.get_first_stage_encoding(modelFS.encode_first_stage(init_image))  # move to latent space
+    # move to latent space, repeated requests on the same image reuse its encoding
+    precision = "full" if full_precision else "autocast"
+    init_latent = latent_cache.init_latent(modelFS, image['image'], Height, Width, device, precision, load_img)
     init_latent = repeat(init_latent, "1 ... -> b ...", b=batch_size)
     if mask_image is None:
         mask = load_mask(image['mask'], Height, Width, init_latent.shape[2], init_latent.shape[3], True).to(device)
@@ -150,12 +152,6 @@ def generate(
     mask = mask[0][0].unsqueeze(0).repeat(4, 1, 1).unsqueeze(0)
     mask = repeat(mask, '1 ... -> b ...', b=batch_size)
 
-    if device != "cpu":
-        mem = torch.cuda.memory_allocated() / 1e6
-        modelFS.to("cpu")
-        while torch.cuda.memory_allocated() / 1e6 >= mem:
-            time.sleep(1)
-
     if strength == 1:
         print("strength should be less than 1, setting it to 0.999")
         strength = 0.999
@@ -176,24 +172,9 @@ def generate(
             for prompts in tqdm(data, desc="data"):
                 with precision_scope("cuda"):
                     modelCS.to(device)
-                    uc = None
-                    if scale != 1.0:
-                        uc = modelCS.get_learned_conditioning(batch_size * [""])
                     if isinstance(prompts, tuple):
                         prompts = list(prompts)
-
-                    subprompts, weights = split_weighted_subprompts(prompts[0])
-                    if len(subprompts) > 1:
-                        c = torch.zeros_like(uc)
-                        totalWeight = sum(weights)
-                        # normalize each "sub prompt" and add it
-                        for i in range(len(subprompts)):
-                            weight = weights[i]
-                            # if not skip_normalize:
-                            weight = weight / totalWeight
-                            c = torch.add(c, modelCS.get_learned_conditioning(subprompts[i]), alpha=weight)
-                    else:
-                        c = modelCS.get_learned_conditioning(prompts)
+                    c, uc = get_conditioning(modelCS, prompts, scale, negative_prompt)
 
                     if device != "cpu":
                         mem = torch.cuda.memory_allocated() / 1e6
@@ -216,6 +197,9 @@ def generate(
                         mask=mask,
                         x_T=init_latent,
                         sampler=sampler,
+                        cfg_skip_last=int(cfg_skip_last),
+                        roi=roi,
+                        roi_margin=int(roi_margin),
                     )
 
                     modelFS.to(device)
@@ -300,6 +284,7 @@ if __name__ == '__main__':
     _, _ = modelFS.load_state_dict(sd, strict=False)
     modelFS.eval()
     del sd
+    latent_cache = LatentCache()
 
     demo = gr.Interface(
         fn=generate,
@@ -322,6 +307,10 @@ if __name__ == '__main__':
             gr.Radio(["png", "jpg"], value='png'),
             "checkbox",
             "checkbox",
+            gr.Checkbox(value=True, label="roi (only denoise the masked region)"),
+            gr.Slider(0, 32, value=8, step=1, label="roi_margin (latent pixels of context)"),
+            gr.Text(value="", label="negative prompt"),
+            gr.Slider(0, 50, value=0, step=1, label="cfg_skip_last (steps at the end without guidance)"),
         ],
         outputs=["image", "image", "text"],
     )
@@ -0,0 +1,168 @@
+"""
+Streaming prompt-file reader for bulk jobs.
+
+Prompt files are read lazily line by line, nothing is materialized or sorted up front.
+Supported formats, picked by file extension:
+
+    .txt (or anything else)   one prompt per line
+    .csv                      header row, a `prompt` column plus optional parameter columns
+    .jsonl                    one object per line, {"prompt": ..., "H": 768, "seed": 5, ...}
+
+A `negative_prompt` column/key overrides the negative prompt of a line, lines with different
+negative prompts can share a batch.
+
+Every line becomes a job producing `n_samples` images. The images of consecutive jobs are
+packed into batches of jobs that share the same sampling shape (H, W, steps, ...), and
+finished lines are appended to a progress file so a restarted run can skip them.
+"""
+
+import csv
+import json
+import os
+from collections import OrderedDict
+
+
+# parameters that have to be identical for all images in one batch
+BATCH_KEYS = ("H", "W", "ddim_steps", "scale", "ddim_eta", "sampler")
+# seed offset between lines, independent of the line's n_samples so lines never share seeds
+LINE_SEED_STRIDE = 1000
+# seed offset between --n_iter iterations, files with fewer lines never reuse a seed
+ITER_SEED_STRIDE = 1000000 * LINE_SEED_STRIDE
+
+
+def _coerce(key, value, defaults):
+    if key == "seed":
+        return int(value)
+    default = defaults.get(key)
+    if value is None or value == "" or default is None or isinstance(value, type(default)):
+        return value
+    if isinstance(default, bool):
+        return str(value).lower() in ("1", "true", "yes")
+    return type(default)(value)
+
+
+def _parse_line(line, fmt):
+    if fmt == "jsonl":
+        record = json.loads(line)
+        if isinstance(record, str):
+            record = {"prompt": record}
+        return record
+    return {"prompt": line}
+
+
+def read_jobs(path, defaults, skip=()):
+    """
+    Lazily yields one job dict per non-empty line of `path`.
+
+    A job contains the line index, the prompt and all parameters of `defaults`, overridden
+    by the per-line values of csv/jsonl files. Lines in `skip` are not yielded.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    fmt = "csv" if ext == ".csv" else "jsonl" if ext in (".jsonl", ".json") else "txt"
+    with open(path, "r", newline="" if fmt == "csv" else None) as f:
+        if fmt == "csv":
+            records = enumerate(csv.DictReader(f))
+        else:
+            records = ((i, line.strip()) for i, line in enumerate(f))
+
+        for index, record in records:
+            if index in skip:
+                continue
+            if fmt != "csv":
+                if not record:
+                    continue
+                record = _parse_line(record, fmt)
+            prompt = (record.get("prompt") or "").strip()
+            if not prompt:
+                continue
+            job = dict(defaults)
+            for key, value in record.items():
+                if key != "prompt" and value not in (None, ""):
+                    job[key] = _coerce(key, value, defaults)
+            job["line"] = index
+            job["prompt"] = prompt
+            yield job
+
+
+def batch_jobs(jobs, batch_size, base_seed, iteration=0, max_groups=8):
+    """
+    Packs the images of a stream of jobs into batches of at most `batch_size`.
+
+    Images are grouped by BATCH_KEYS. A group is emitted as soon as it is full; when more than
+    `max_groups` groups are waiting for images, the oldest one is emitted partially so memory
+    stays bounded for arbitrarily long files. Image j of a job uses the job's `seed` parameter
+    + j if given, else base_seed + line * LINE_SEED_STRIDE + j. Later iterations shift every
+    seed by iteration * ITER_SEED_STRIDE.
+    """
+    groups = OrderedDict()
+
+    def make_batch(key, slots):
+        return {
+            "params": dict(zip(BATCH_KEYS, key)),
+            "prompts": [job["prompt"] for job, _ in slots],
+            "negative_prompts": [job.get("negative_prompt", "") for job, _ in slots],
+            "seeds": [seed for _, seed in slots],
+            "slots": [(job["line"], job["n_samples"]) for job, _ in slots],
+            # size to save each image at, differs from H/W when sizes are bucketed
+            "sizes": [(job.get("out_H", job["H"]), job.get("out_W", job["W"])) for job, _ in slots],
+        }
+
+    for job in jobs:
+        key = tuple(job.get(k) for k in BATCH_KEYS)
+        n = job["n_samples"]
+        if job.get("seed") is not None:
+            seed = job["seed"]
+        elif n > LINE_SEED_STRIDE:
+            raise ValueError(f"line {job['line']}: n_samples {n} > {LINE_SEED_STRIDE} would reuse the seeds of the next "
+                             f"line, give the line its own seed")
+        else:
+            seed = base_seed + job["line"] * LINE_SEED_STRIDE
+        seed += iteration * ITER_SEED_STRIDE
+        for j in range(n):
+            slots = groups.setdefault(key, [])
+            slots.append((job, seed + j))
+            if len(slots) == batch_size:
+                del groups[key]
+                yield make_batch(key, slots)
+        if len(groups) > max_groups:
+            key, slots = groups.popitem(last=False)
+            yield make_batch(key, slots)
+
+    for key, slots in groups.items():
+        yield make_batch(key, slots)
+
+
+class JobProgress(object):
+    """
+    Append-only record of finished lines. A line counts as finished once all of its images
+    have been written; `completed(iteration)` returns the lines to skip on restart.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.pending = {}
+        self.finished = set()
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        r = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.finished.add((r["iter"], r["line"]))
+
+    def completed(self, iteration=0):
+        return {line for it, line in self.finished if it == iteration}
+
+    def update(self, batch, iteration=0):
+        done = []
+        for line, count in batch["slots"]:
+            key = (iteration, line)
+            self.pending[key] = self.pending.get(key, 0) + 1
+            if self.pending[key] == count:
+                del self.pending[key]
+                self.finished.add(key)
+                done.append(key)
+        if done:
+            with open(self.path, "a") as f:
+                for it, line in done:
+                    f.write(json.dumps({"iter": it, "line": line}) + "\n")
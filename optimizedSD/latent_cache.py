@@ -0,0 +1,111 @@
+"""
+Cache for the VAE encodings of img2img / inpainting init images.
+
+Users usually iterate on the same source image with different prompts or strengths. The
+cache keeps the posterior (mean, std) of the first stage encoder per image, keyed on a
+hash of the image content, the target H/W and the precision, so repeated requests skip
+the image resize, the VAE forward pass and moving FirstStage to the GPU. A batch of init
+latents is drawn from the cached posterior, just like encoding the repeated image would.
+
+Entries live in an in-memory LRU and, if `cache_dir` is set, as .pt files on disk so they
+also survive between runs of the command line scripts.
+"""
+
+import hashlib
+import os
+from collections import OrderedDict
+
+import torch
+from PIL import Image
+
+from pipeline import is_cuda, offload
+from tracing import tracer
+
+
+def image_key(source, H, W, precision):
+    """Content hash of a file path or PIL image plus everything that changes the encoding."""
+    h = hashlib.sha1()
+    if isinstance(source, Image.Image):
+        h.update(f"{source.mode}{source.size}".encode())
+        h.update(source.tobytes())
+    else:
+        with open(source, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+    return f"{h.hexdigest()}_{H}x{W}_{precision}"
+
+
+class LatentCache(object):
+    def __init__(self, max_items=32, cache_dir=None):
+        self.max_items = max_items
+        self.cache_dir = cache_dir
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".pt")
+
+    def get(self, key):
+        if key in self.items:
+            self.items.move_to_end(key)
+            return self.items[key]
+        if self.cache_dir and os.path.exists(self._path(key)):
+            try:
+                entry = torch.load(self._path(key), map_location="cpu")
+            except Exception as e:
+                print(f"Ignoring unreadable latent cache entry {self._path(key)}: {e}")
+                return None
+            self._remember(key, (entry["mean"], entry["std"]))
+            return self.items[key]
+        return None
+
+    def put(self, key, mean, std):
+        mean, std = mean.detach().cpu(), std.detach().cpu()
+        self._remember(key, (mean, std))
+        if self.cache_dir:
+            tmp = self._path(key) + ".tmp"
+            torch.save({"mean": mean, "std": std}, tmp)
+            os.replace(tmp, self._path(key))
+
+    def _remember(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+
+    def posterior(self, modelFS, source, H, W, device, precision, load_fn):
+        """
+        Returns (mean, std) of the encoder posterior of `source` on `device`.
+
+        :param source: image path or PIL image.
+        :param load_fn: load_fn(source, H, W) -> image tensor in [-1, 1], only called on a miss.
+        """
+        half = precision == "autocast" and is_cuda(device)
+        key = image_key(source, H, W, precision)
+        entry = self.get(key)
+        if entry is not None:
+            self.hits += 1
+            print(f"Using cached init latent ({self.hits} hits, {self.misses} misses)")
+        else:
+            self.misses += 1
+            with tracer.span("vae.encode", device):
+                init_image = load_fn(source, H, W).to(device)
+                if half:
+                    init_image = init_image.half()
+                modelFS.to(device)
+                posterior = modelFS.encode_first_stage(init_image)
+                offload(modelFS, device)
+            entry = (posterior.mean, posterior.std)
+            self.put(key, *entry)
+        dtype = torch.float16 if half else torch.float32
+        return entry[0].to(device, dtype), entry[1].to(device, dtype)
+
+    def init_latent(self, modelFS, source, H, W, device, precision, load_fn, batch_size=1):
+        """A batch of scaled init latents sampled from the (cached) posterior of `source`."""
+        mean, std = self.posterior(modelFS, source, H, W, device, precision, load_fn)
+        shape = (batch_size,) + tuple(mean.shape[1:])
+        z = mean + std * torch.randn(shape, device=mean.device, dtype=mean.dtype)
+        return modelFS.scale_factor * z
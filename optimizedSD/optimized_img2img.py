@@ -14,7 +14,10 @@ from torch import autocast
 from contextlib import contextmanager, nullcontext
 from einops import rearrange, repeat
 from ldm.util import instantiate_from_config
-from optimUtils import split_weighted_subprompts, logger
+from optimUtils import logger
+from latent_cache import LatentCache
+from pipeline import get_conditioning
+from ldm.models.diffusion.sampling import GuidanceSchedule, make_guidance_schedule, parse_sigma_interval
 from transformers import logging
 import pandas as pd
 logging.set_verbosity_error()
@@ -61,6 +64,9 @@ parser = argparse.ArgumentParser()
 parser.add_argument(
     "--prompt", type=str, nargs="?", default="a painting of a virus monster playing guitar", help="the prompt to render"
 )
+parser.add_argument(
+    "--negative_prompt", type=str, default="", help="what the images should not show, used for the unconditional branch of the guidance"
+)
 parser.add_argument("--outdir", type=str, nargs="?", help="dir to write results to", default="outputs/img2img-samples")
 parser.add_argument("--init-img", type=str, nargs="?", help="path to the input image")
 
@@ -174,6 +180,43 @@ parser.add_argument(
     choices=["ddim"],
     default="ddim",
 )
+parser.add_argument(
+    "--latent_cache",
+    type=str,
+    default=None,
+    help="dir to cache the VAE encodings of init images in, repeated runs on the same image skip the encoder",
+)
+parser.add_argument(
+    "--cfg_skip_last",
+    type=int,
+    default=0,
+    help="run the last steps without guidance (only the conditional unet pass), saves half of the unet work on these steps",
+)
+parser.add_argument(
+    "--cfg_skip_delta",
+    type=float,
+    default=0.,
+    help="drop the guidance for the remaining steps once the relative difference of the conditional and unconditional noise prediction is below this, e.g. 0.05",
+)
+parser.add_argument(
+    "--cfg_interval",
+    type=parse_sigma_interval,
+    default=None,
+    help="only guide steps with a noise level sigma in this interval, e.g. 0.3,5 (stable diffusion goes from about 14.6 to 0.03), the other steps run the conditional pass only",
+)
+parser.add_argument(
+    "--cfg_curve",
+    type=str,
+    choices=GuidanceSchedule.CURVES,
+    default="constant",
+    help="how the guidance scale changes from --scale at the first to --cfg_end_scale at the last step",
+)
+parser.add_argument(
+    "--cfg_end_scale",
+    type=float,
+    default=None,
+    help="guidance scale at the last step with --cfg_curve linear or cosine",
+)
 opt = parser.parse_args()
 
 tic = time.time()
@@ -209,7 +252,6 @@ for key in lo:
 config = OmegaConf.load(f"{config}")
 
 assert os.path.isfile(opt.init_img)
-init_image = load_img(opt.init_img, opt.H, opt.W).to(opt.device)
 
 model = instantiate_from_config(config.modelUNet)
 _, _ = model.load_state_dict(sd, strict=False)
@@ -231,7 +273,6 @@ if opt.device != "cpu" and opt.precision == "autocast":
     model.half()
     modelCS.half()
     modelFS.half()
-    init_image = init_image.half()
 
 batch_size = opt.n_samples
 n_rows = opt.n_rows if opt.n_rows > 0 else batch_size
@@ -247,16 +288,10 @@ else:
         data = batch_size * list(data)
         data = list(chunk(sorted(data), batch_size))
 
-modelFS.to(opt.device)
-
-init_image = repeat(init_image, "1 ... -> b ...", b=batch_size)
-init_latent = modelFS.get_first_stage_encoding(modelFS.encode_first_stage(init_image))  # move to latent space
-
-if opt.device != "cpu":
-    mem = torch.cuda.memory_allocated(device=opt.device) / 1e6
-    modelFS.to("cpu")
-    while torch.cuda.memory_allocated(device=opt.device) / 1e6 >= mem:
-        time.sleep(1)
+# move to latent space, the image is only encoded once and every sample draws from its posterior
+latent_cache = LatentCache(cache_dir=opt.latent_cache)
+init_latent = latent_cache.init_latent(modelFS, opt.init_img, opt.H, opt.W, opt.device, opt.precision, load_img,
+                                       batch_size)
 
 
 assert 0.0 <= opt.strength <= 1.0, "can only work with strength in [0.0, 1.0]"
@@ -282,24 +317,9 @@ with torch.no_grad():
 
             with precision_scope("cuda"):
                 modelCS.to(opt.device)
-                uc = None
-                if opt.scale != 1.0:
-                    uc = modelCS.get_learned_conditioning(batch_size * [""])
                 if isinstance(prompts, tuple):
                     prompts = list(prompts)
-
-                subprompts, weights = split_weighted_subprompts(prompts[0])
-                if len(subprompts) > 1:
-                    c = torch.zeros_like(uc)
-                    totalWeight = sum(weights)
-                    # normalize each "sub prompt" and add it
-                    for i in range(len(subprompts)):
-                        weight = weights[i]
-                        # if not skip_normalize:
-                        weight = weight / totalWeight
-                        c = torch.add(c, modelCS.get_learned_conditioning(subprompts[i]), alpha=weight)
-                else:
-                    c = modelCS.get_learned_conditioning(prompts)
+                c, uc = get_conditioning(modelCS, prompts, opt.scale, opt.negative_prompt)
 
                 if opt.device != "cpu":
                     mem = torch.cuda.memory_allocated(device=opt.device) / 1e6
@@ -322,7 +342,10 @@ with torch.no_grad():
                     z_enc,
                     unconditional_guidance_scale=opt.scale,
                     unconditional_conditioning=uc,
-                    sampler = opt.sampler
+                    sampler = opt.sampler,
+                    cfg_skip_last=opt.cfg_skip_last,
+                    cfg_skip_delta=opt.cfg_skip_delta,
+                    cfg_schedule=make_guidance_schedule(opt.cfg_interval, opt.cfg_curve, opt.cfg_end_scale),
                 )
 
                 modelFS.to(opt.device)
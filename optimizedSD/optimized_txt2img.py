@@ -2,7 +2,6 @@ import argparse, os, re
 import torch
 import numpy as np
 from random import randint
-from omegaconf import OmegaConf
 from PIL import Image
 from tqdm import tqdm, trange
 from itertools import islice
@@ -12,8 +11,12 @@ import time
 from pytorch_lightning import seed_everything
 from torch import autocast
 from contextlib import contextmanager, nullcontext
-from ldm.util import instantiate_from_config
 from optimUtils import split_weighted_subprompts, logger
+from pipeline import Stage, StagePipeline, get_conditioning, load_models, place_stages, is_cuda
+from jobs import BATCH_KEYS, JobProgress, batch_jobs, read_jobs
+from tracing import tracer
+from bucketing import BucketResources, fit_image, parse_buckets
+from ldm.models.diffusion.sampling import GuidanceSchedule, make_guidance_schedule, parse_sigma_interval
 from transformers import logging
 # from samplers import CompVisDenoiser
 logging.set_verbosity_error()
@@ -24,15 +27,6 @@ def chunk(it, size):
     return iter(lambda: tuple(islice(it, size)), ())
 
 
-def load_model_from_config(ckpt, verbose=False):
-    print(f"Loading model from {ckpt}")
-    pl_sd = torch.load(ckpt, map_location="cpu")
-    if "global_step" in pl_sd:
-        print(f"Global Step: {pl_sd['global_step']}")
-    sd = pl_sd["state_dict"]
-    return sd
-
-
 config = "optimizedSD/v1-inference.yaml"
 DEFAULT_CKPT = "models/ldm/stable-diffusion-v1/model.ckpt"
 
@@ -41,6 +35,9 @@ parser = argparse.ArgumentParser()
 parser.add_argument(
     "--prompt", type=str, nargs="?", default="a painting of a virus monster playing guitar", help="the prompt to render"
 )
+parser.add_argument(
+    "--negative_prompt", type=str, default="", help="what the images should not show, used for the unconditional branch of the guidance"
+)
 parser.add_argument("--outdir", type=str, nargs="?", help="dir to write results to", default="outputs/txt2img-samples")
 parser.add_argument(
     "--skip_grid",
@@ -127,7 +124,12 @@ parser.add_argument(
 parser.add_argument(
     "--from-file",
     type=str,
-    help="if specified, load prompts from this file",
+    help="if specified, load prompts from this file (.txt, or .csv/.jsonl with per-line parameters)",
+)
+parser.add_argument(
+    "--resume",
+    action="store_true",
+    help="with --from-file, skip prompts that were finished by a previous run into the same outdir",
 )
 parser.add_argument(
     "--seed",
@@ -173,7 +175,93 @@ parser.add_argument(
     help="path to checkpoint of model",
     default=DEFAULT_CKPT,
 )
+parser.add_argument(
+    "--pipeline",
+    action="store_true",
+    help="keep CondStage, UNet and FirstStage resident on their own devices and run consecutive batches through them concurrently",
+)
+parser.add_argument(
+    "--cond_device",
+    type=str,
+    default=None,
+    help="device for the text encoder (default: --device), e.g. cpu to keep it off the GPU",
+)
+parser.add_argument(
+    "--first_stage_device",
+    type=str,
+    default=None,
+    help="device for the VAE decoder (default: --device), e.g. cuda:1",
+)
+parser.add_argument(
+    "--trace",
+    type=str,
+    default=None,
+    help="record per-stage timings and memory and write them to this Chrome trace (.json) file",
+)
+parser.add_argument(
+    "--buckets",
+    type=parse_buckets,
+    default=None,
+    help="generate at the nearest of a few aspect-ratio buckets of these sizes, e.g. 512,768, and resize to the requested size when saving. Lets lines of a prompt file with similar sizes share batches",
+)
+parser.add_argument(
+    "--attention_mb",
+    type=float,
+    default=None,
+    help="memory budget for one chunk of attention scores, picks the attention chunk size per image shape",
+)
+parser.add_argument(
+    "--tile",
+    type=int,
+    default=None,
+    help="denoise and decode images larger than this (in pixels, e.g. 512) in overlapping windows of this size, memory then depends on the tile size instead of the image size",
+)
+parser.add_argument(
+    "--tile_overlap",
+    type=int,
+    default=128,
+    help="overlap of neighbouring windows in pixels with --tile",
+)
+parser.add_argument(
+    "--tile_batch",
+    type=int,
+    default=4,
+    help="windows denoised per unet pass with --tile",
+)
+parser.add_argument(
+    "--cfg_skip_last",
+    type=int,
+    default=0,
+    help="run the last steps without guidance (only the conditional unet pass), saves half of the unet work on these steps",
+)
+parser.add_argument(
+    "--cfg_skip_delta",
+    type=float,
+    default=0.,
+    help="drop the guidance for the remaining steps once the relative difference of the conditional and unconditional noise prediction is below this, e.g. 0.05",
+)
+parser.add_argument(
+    "--cfg_interval",
+    type=parse_sigma_interval,
+    default=None,
+    help="only guide steps with a noise level sigma in this interval, e.g. 0.3,5 (stable diffusion goes from about 14.6 to 0.03), the other steps run the conditional pass only",
+)
+parser.add_argument(
+    "--cfg_curve",
+    type=str,
+    choices=GuidanceSchedule.CURVES,
+    default="constant",
+    help="how the guidance scale changes from --scale at the first to --cfg_end_scale at the last step",
+)
+parser.add_argument(
+    "--cfg_end_scale",
+    type=float,
+    default=None,
+    help="guidance scale at the last step with --cfg_curve linear or cosine",
+)
 opt = parser.parse_args()
+if opt.trace:
+    tracer.enable()
 
 tic = time.time()
 os.makedirs(opt.outdir, exist_ok=True)
@@ -187,47 +275,34 @@ seed_everything(opt.seed)
 # Logging
 logger(vars(opt), log_csv = "logs/txt2img_logs.csv")
 
-sd = load_model_from_config(f"{opt.ckpt}")
-li, lo = [], []
-for key, value in sd.items():
-    sp = key.split(".")
-    if (sp[0]) == "model":
-        if "input_blocks" in sp:
-            li.append(key)
-        elif "middle_block" in sp:
-            li.append(key)
-        elif "time_embed" in sp:
-            li.append(key)
-        else:
-            lo.append(key)
-for key in li:
-    sd["model1." + key[6:]] = sd.pop(key)
-for key in lo:
-    sd["model2." + key[6:]] = sd.pop(key)
-
-config = OmegaConf.load(f"{config}")
-
-model = instantiate_from_config(config.modelUNet)
-_, _ = model.load_state_dict(sd, strict=False)
-model.eval()
+model, modelCS, modelFS = load_models(opt.ckpt, config)
 model.unet_bs = opt.unet_bs
 model.cdevice = opt.device
 model.turbo = opt.turbo
-
-modelCS = instantiate_from_config(config.modelCondStage)
-_, _ = modelCS.load_state_dict(sd, strict=False)
-modelCS.eval()
 modelCS.cond_stage_model.device = opt.device
 
-modelFS = instantiate_from_config(config.modelFirstStage)
-_, _ = modelFS.load_state_dict(sd, strict=False)
-modelFS.eval()
-del sd
-
-if opt.device != "cpu" and opt.precision == "autocast":
+cond_device = opt.cond_device or opt.device
+first_stage_device = opt.first_stage_device or opt.device
+if opt.pipeline:
+    place_stages(model, modelCS, modelFS, cond_device, opt.device, first_stage_device, opt.precision)
+elif opt.device != "cpu" and opt.precision == "autocast":
     model.half()
     modelCS.half()
 
+if opt.tile:
+    for m in (model, modelFS):
+        m.tile = opt.tile // opt.f
+        m.tile_overlap = opt.tile_overlap // opt.f
+    model.tile_batch = opt.tile_batch
+
+cfg_schedule = make_guidance_schedule(opt.cfg_interval, opt.cfg_curve, opt.cfg_end_scale)
+
+resources = BucketResources()
+if opt.attention_mb:
+    resources.plan_attention(model, opt.attention_mb)
+if opt.tile:
+    resources.plan_tiles(model, modelFS)
+
 start_code = None
 if opt.fixed_code:
     start_code = torch.randn([opt.n_samples, opt.C, opt.H // opt.f, opt.W // opt.f], device=opt.device)
@@ -235,106 +310,136 @@ if opt.fixed_code:
 
 batch_size = opt.n_samples
 n_rows = opt.n_rows if opt.n_rows > 0 else batch_size
+defaults = {key: getattr(opt, key) for key in BATCH_KEYS}
+defaults.update(n_samples=batch_size, seed=None, negative_prompt=opt.negative_prompt)
+
 if not opt.from_file:
     assert opt.prompt is not None
     prompt = opt.prompt
     print(f"Using prompt: {prompt}")
-    data = [batch_size * [prompt]]
-
+    n_batches = opt.n_iter
 else:
     print(f"reading prompts from {opt.from_file}")
-    with open(opt.from_file, "r") as f:
-        text = f.read()
-        print(f"Using prompt: {text.strip()}")
-        data = text.splitlines()
-        data = batch_size * list(data)
-        data = list(chunk(sorted(data), batch_size))
-
-
-if opt.precision == "autocast" and opt.device != "cpu":
-    precision_scope = autocast
-else:
-    precision_scope = nullcontext
+    n_batches = None
+    progress = JobProgress(os.path.join(outpath, os.path.basename(opt.from_file) + ".progress"))
+    if not opt.resume:
+        open(progress.path, "w").close()
+        progress.finished.clear()
+
+
+def bucketed(job):
+    if opt.buckets is not None:
+        job["out_H"], job["out_W"] = job["H"], job["W"]
+        job["H"], job["W"] = opt.buckets.assign(job["H"], job["W"])
+    return job
+
+
+def make_jobs():
+    if not opt.from_file:
+        seed = opt.seed
+        params = bucketed(dict(defaults))
+        size = (params.get("out_H", opt.H), params.get("out_W", opt.W))
+        for n in range(opt.n_iter):
+            yield {"prompts": batch_size * [prompt], "negative_prompts": batch_size * [opt.negative_prompt],
+                   "seeds": list(range(seed, seed + batch_size)),
+                   "params": params, "sizes": batch_size * [size], "iter": n}
+            seed += batch_size
+        return
+
+    for n in range(opt.n_iter):
+        done = progress.completed(n)
+        if done:
+            print(f"skipping {len(done)} finished prompts of iteration {n}")
+        jobs = (bucketed(job) for job in read_jobs(opt.from_file, defaults, skip=done))
+        for batch in batch_jobs(jobs, batch_size, opt.seed, n):
+            batch["iter"] = n
+            yield batch
+
+
+def encode(job):
+    job["c"], job["uc"] = get_conditioning(modelCS, job["prompts"], job["params"]["scale"],
+                                           job["negative_prompts"])
+    return job
+
+
+def sample(job):
+    params = job["params"]
+    c, uc = job.pop("c").to(opt.device), job.pop("uc")
+    if uc is not None:
+        uc = uc.to(opt.device)
+    shape = [len(job["prompts"]), opt.C, params["H"] // opt.f, params["W"] // opt.f]
+    x_T = None
+    if start_code is not None and list(start_code.shape[1:]) == shape[1:]:
+        x_T = start_code[: shape[0]]
+    job["samples"] = model.sample(
+        S=params["ddim_steps"],
+        conditioning=c,
+        seed=job["seeds"],
+        shape=shape,
+        verbose=False,
+        unconditional_guidance_scale=params["scale"],
+        unconditional_conditioning=uc,
+        eta=params["ddim_eta"],
+        x_T=x_T,
+        sampler = params["sampler"],
+        cfg_skip_last=opt.cfg_skip_last,
+        cfg_skip_delta=opt.cfg_skip_delta,
+        cfg_schedule=cfg_schedule,
+    )
+    return job
+
+
+def decode(job):
+    samples_ddim = job.pop("samples").to(first_stage_device)
+    counts = {}
+
+    print(samples_ddim.shape)
+    print("saving images")
+    for i, (prompt, seed, size) in enumerate(zip(job["prompts"], job["seeds"], job["sizes"])):
+        sample_path = os.path.join(outpath, "_".join(re.split(":| ", prompt)))[:150]
+        if sample_path not in counts:
+            os.makedirs(sample_path, exist_ok=True)
+            counts[sample_path] = len(os.listdir(sample_path))
+
+        x_samples_ddim = modelFS.decode_first_stage(samples_ddim[i].unsqueeze(0))
+        x_sample = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
+        x_sample = 255.0 * rearrange(x_sample[0].cpu().numpy(), "c h w -> h w c")
+        with tracer.span("write"):
+            image = fit_image(Image.fromarray(x_sample.astype(np.uint8)), *size)
+            image.save(
+                os.path.join(sample_path, "seed_" + str(seed) + "_" + f"{counts[sample_path]:05}.{opt.format}")
+            )
+        counts[sample_path] += 1
+
+    job["sample_path"] = sample_path
+    return job
+
+
+runner = StagePipeline(
+    [
+        Stage("encode", encode, cond_device, opt.precision, module=modelCS, offload=not opt.pipeline),
+        Stage("sample", sample, opt.device, opt.precision),
+        Stage("decode", decode, first_stage_device, opt.precision, module=modelFS, offload=not opt.pipeline),
+    ],
+    threaded=opt.pipeline,
+)
 
 seeds = ""
-with torch.no_grad():
-
-    all_samples = list()
-    for n in trange(opt.n_iter, desc="Sampling"):
-        for prompts in tqdm(data, desc="data"):
-
-            sample_path = os.path.join(outpath, "_".join(re.split(":| ", prompts[0])))[:150]
-            os.makedirs(sample_path, exist_ok=True)
-            base_count = len(os.listdir(sample_path))
-
-            with precision_scope("cuda"):
-                modelCS.to(opt.device)
-                uc = None
-                if opt.scale != 1.0:
-                    uc = modelCS.get_learned_conditioning(batch_size * [""])
-                if isinstance(prompts, tuple):
-                    prompts = list(prompts)
-
-                subprompts, weights = split_weighted_subprompts(prompts[0])
-                if len(subprompts) > 1:
-                    c = torch.zeros_like(uc)
-                    totalWeight = sum(weights)
-                    # normalize each "sub prompt" and add it
-                    for i in range(len(subprompts)):
-                        weight = weights[i]
-                        # if not skip_normalize:
-                        weight = weight / totalWeight
-                        c = torch.add(c, modelCS.get_learned_conditioning(subprompts[i]), alpha=weight)
-                else:
-                    c = modelCS.get_learned_conditioning(prompts)
-
-                shape = [opt.n_samples, opt.C, opt.H // opt.f, opt.W // opt.f]
-
-                if opt.device != "cpu":
-                    mem = torch.cuda.memory_allocated() / 1e6
-                    modelCS.to("cpu")
-                    while torch.cuda.memory_allocated() / 1e6 >= mem:
-                        time.sleep(1)
-
-                samples_ddim = model.sample(
-                    S=opt.ddim_steps,
-                    conditioning=c,
-                    seed=opt.seed,
-                    shape=shape,
-                    verbose=False,
-                    unconditional_guidance_scale=opt.scale,
-                    unconditional_conditioning=uc,
-                    eta=opt.ddim_eta,
-                    x_T=start_code,
-                    sampler = opt.sampler,
-                )
-
-                modelFS.to(opt.device)
-
-                print(samples_ddim.shape)
-                print("saving images")
-                for i in range(batch_size):
-
-                    x_samples_ddim = modelFS.decode_first_stage(samples_ddim[i].unsqueeze(0))
-                    x_sample = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
-                    x_sample = 255.0 * rearrange(x_sample[0].cpu().numpy(), "c h w -> h w c")
-                    Image.fromarray(x_sample.astype(np.uint8)).save(
-                        os.path.join(sample_path, "seed_" + str(opt.seed) + "_" + f"{base_count:05}.{opt.format}")
-                    )
-                    seeds += str(opt.seed) + ","
-                    opt.seed += 1
-                    base_count += 1
-
-                if opt.device != "cpu":
-                    mem = torch.cuda.memory_allocated() / 1e6
-                    modelFS.to("cpu")
-                    while torch.cuda.memory_allocated() / 1e6 >= mem:
-                        time.sleep(1)
-                del samples_ddim
-                print("memory_final = ", torch.cuda.memory_allocated() / 1e6)
+sample_path = outpath
+for job in tqdm(runner.run(make_jobs()), desc="Sampling", total=n_batches):
+    sample_path = job["sample_path"]
+    seeds += "".join(str(s) + "," for s in job["seeds"])
+    if opt.from_file:
+        progress.update(job, job["iter"])
+    if is_cuda(opt.device):
+        print("memory_final = ", torch.cuda.memory_allocated(device=opt.device) / 1e6)
 
 toc = time.time()
 
+if opt.trace:
+    print(tracer.summary())
+    tracer.export_chrome_trace(opt.trace)
+
 time_taken = (toc - tic) / 60.0
 
 print(
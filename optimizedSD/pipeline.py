@@ -0,0 +1,322 @@
+"""
+Stage runner for the split model.
+
+The optimized scripts run CondStage, UNet (model1 + model2) and FirstStage one after the
+other on a single device and swap them in and out of VRAM. A StagePipeline runs the same
+stages either sequentially (the default, identical to the old behaviour) or in pipeline
+mode, where every stage lives permanently on its own device and runs in its own worker
+thread. Consecutive jobs then overlap: while job N is decoded, job N+1 is denoised and
+job N+2 has its prompt encoded.
+"""
+
+import queue
+import threading
+import time
+from collections import OrderedDict
+from contextlib import nullcontext
+
+import torch
+from omegaconf import OmegaConf
+from torch import autocast
+
+from ldm.util import instantiate_from_config
+from optimUtils import split_weighted_subprompts
+from tracing import tracer
+
+
+_STOP = object()
+
+
+class _Failure(object):
+    def __init__(self, exc):
+        self.exc = exc
+
+
+def load_models(ckpt, config="optimizedSD/v1-inference.yaml"):
+    """Loads a stable diffusion checkpoint and splits it into (UNet, CondStage, FirstStage)."""
+    print(f"Loading model from {ckpt}")
+    pl_sd = torch.load(ckpt, map_location="cpu")
+    if "global_step" in pl_sd:
+        print(f"Global Step: {pl_sd['global_step']}")
+    sd = pl_sd["state_dict"]
+
+    li, lo = [], []
+    for key in sd.keys():
+        sp = key.split(".")
+        if (sp[0]) == "model":
+            if "input_blocks" in sp or "middle_block" in sp or "time_embed" in sp:
+                li.append(key)
+            else:
+                lo.append(key)
+    for key in li:
+        sd["model1." + key[6:]] = sd.pop(key)
+    for key in lo:
+        sd["model2." + key[6:]] = sd.pop(key)
+
+    config = OmegaConf.load(f"{config}")
+
+    model = instantiate_from_config(config.modelUNet)
+    _, _ = model.load_state_dict(sd, strict=False)
+    model.eval()
+
+    modelCS = instantiate_from_config(config.modelCondStage)
+    _, _ = modelCS.load_state_dict(sd, strict=False)
+    modelCS.eval()
+
+    modelFS = instantiate_from_config(config.modelFirstStage)
+    _, _ = modelFS.load_state_dict(sd, strict=False)
+    modelFS.eval()
+    del sd
+    return model, modelCS, modelFS
+
+
+def is_cuda(device):
+    return torch.device(device).type == "cuda"
+
+
+def precision_scope(device, precision):
+    if precision == "autocast" and is_cuda(device):
+        return autocast("cuda")
+    return nullcontext()
+
+
+def offload(module, device):
+    """Move a module back to the cpu and wait until its VRAM has actually been released."""
+    if not is_cuda(device):
+        return
+    with tracer.span("offload", device, module=type(module).__name__):
+        mem = torch.cuda.memory_allocated(device=device) / 1e6
+        module.to("cpu")
+        while torch.cuda.memory_allocated(device=device) / 1e6 >= mem:
+            time.sleep(1)
+
+
+def place_stages(model, modelCS, modelFS, cond_device, unet_device, first_stage_device, precision="autocast"):
+    """
+    Pin every stage to its own device for pipeline mode. Nothing is swapped to the cpu
+    anymore, so each device only has to hold the stage it runs. Stages placed on a GPU are
+    converted to half precision when running in autocast, cpu stages stay in fp32.
+    """
+    modelCS.cond_stage_model.device = cond_device
+    modelCS.to(cond_device)
+    if precision == "autocast" and is_cuda(cond_device):
+        modelCS.half()
+
+    model.cdevice = unet_device
+    model.turbo = True
+    model.resident = True
+    model.to(unet_device)
+    if precision == "autocast" and is_cuda(unet_device):
+        model.half()
+
+    modelFS.to(first_stage_device)
+
+    print(f"Pipeline stages: CondStage on {cond_device}, UNet on {unet_device}, FirstStage on {first_stage_device}")
+
+
+class PromptCache(object):
+    """
+    LRU of prompt embeddings, keyed on the prompt text and the device, dtype and autocast
+    state of the encoder. The empty prompt and the negative prompts are the same for most
+    jobs, so the unconditional branch is usually a cache hit.
+    """
+    def __init__(self, max_items=64):
+        self.max_items = max_items
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(modelCS, prompt):
+        p = next(modelCS.parameters())
+        return prompt, p.device, p.dtype, torch.is_autocast_enabled()
+
+    def get(self, key):
+        if key in self.items:
+            self.items.move_to_end(key)
+            self.hits += 1
+            return self.items[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, c):
+        self.items[key] = c
+        while len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+
+
+def get_prompt_cache(modelCS):
+    """The PromptCache of modelCS, created the first time."""
+    cache = getattr(modelCS, "_prompt_cache", None)
+    if cache is None:
+        cache = PromptCache()
+        modelCS._prompt_cache = cache
+    return cache
+
+
+def encode_prompt(modelCS, prompt, n=1):
+    """Encodes a single (possibly weighted) prompt, or takes it from the cache, and repeats it n times."""
+    cache = get_prompt_cache(modelCS)
+    key = cache.key(modelCS, prompt)
+    c = cache.get(key)
+    if c is None:
+        subprompts, weights = split_weighted_subprompts(prompt)
+        if len(subprompts) > 1:
+            totalWeight = sum(weights)
+            # normalize each "sub prompt" and add it
+            for subprompt, weight in zip(subprompts, weights):
+                emb = modelCS.get_learned_conditioning(subprompt)
+                c = emb * (weight / totalWeight) if c is None else torch.add(c, emb, alpha=weight / totalWeight)
+        else:
+            c = modelCS.get_learned_conditioning([prompt])
+        cache.put(key, c)
+    return c.repeat(n, 1, 1)
+
+
+def encode_prompts(modelCS, prompts):
+    """Embeddings of a batch of prompts, every distinct prompt is only encoded once."""
+    unique = list(dict.fromkeys(prompts))
+    if len(unique) == 1:
+        return encode_prompt(modelCS, unique[0], len(prompts))
+    embs = {prompt: encode_prompt(modelCS, prompt) for prompt in unique}
+    return torch.cat([embs[prompt] for prompt in prompts])
+
+
+def get_conditioning(modelCS, prompts, scale, negative_prompts=""):
+    """
+    Returns (c, uc) for a batch of prompts. uc is the embedding of the negative prompt, a
+    single one for the batch or one per prompt, and None if scale == 1.
+    """
+    uc = None
+    if scale != 1.0:
+        if isinstance(negative_prompts, str):
+            negative_prompts = len(prompts) * [negative_prompts]
+        uc = encode_prompts(modelCS, negative_prompts)
+    return encode_prompts(modelCS, prompts), uc
+
+
+class Stage(object):
+    """
+    One step of the generation pipeline.
+
+    :param fn: callable taking a job dict and returning the (updated) job dict.
+    :param module: the model used by this stage. In sequential mode it is moved to `device`
+        before and back to the cpu after every job when `offload` is set.
+    """
+    def __init__(self, name, fn, device="cuda", precision="autocast", module=None, offload=False):
+        self.name = name
+        self.fn = fn
+        self.device = device
+        self.precision = precision
+        self.module = module
+        self.offload = offload
+        self.busy = 0.
+
+    def __call__(self, job):
+        tic = time.time()
+        with torch.no_grad(), precision_scope(self.device, self.precision), tracer.span(self.name, self.device):
+            if self.offload:
+                with tracer.span("offload", self.device, module=type(self.module).__name__):
+                    self.module.to(self.device)
+            job = self.fn(job)
+            if self.offload:
+                offload(self.module, self.device)
+        self.busy += time.time() - tic
+        return job
+
+
+class StagePipeline(object):
+    """
+    Streams jobs through a list of stages.
+
+    With threaded=False every job passes through all stages before the next one starts.
+    With threaded=True each stage gets a worker thread and the stages are connected by
+    bounded queues of size `depth`, so a fast stage can only run `depth` jobs ahead of the
+    next one. Results are yielded in submission order; an exception in any stage stops the
+    pipeline and is re-raised in the caller.
+    """
+    def __init__(self, stages, threaded=False, depth=1):
+        self.stages = stages
+        self.threaded = threaded
+        self.depth = depth
+        self._abort = threading.Event()
+
+    def run(self, jobs):
+        tic = time.time()
+        if self.threaded:
+            yield from self._run_threaded(jobs)
+        else:
+            for job in jobs:
+                for stage in self.stages:
+                    job = stage(job)
+                yield job
+        self.report(time.time() - tic)
+
+    def report(self, total):
+        if total <= 0:
+            return
+        print("Stage utilization: " + ", ".join(
+            f"{stage.name} {stage.busy:.1f}s ({100 * stage.busy / total:.0f}%)" for stage in self.stages))
+
+    def _put(self, q, item):
+        while not self._abort.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        while not self._abort.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _STOP
+
+    def _feed(self, jobs, q_out):
+        try:
+            for job in jobs:
+                if not self._put(q_out, job):
+                    return
+        except Exception as e:
+            self._put(q_out, _Failure(e))
+            return
+        self._put(q_out, _STOP)
+
+    def _work(self, stage, q_in, q_out):
+        while True:
+            item = self._get(q_in)
+            if item is _STOP or isinstance(item, _Failure):
+                self._put(q_out, item)
+                return
+            try:
+                item = stage(item)
+            except Exception as e:
+                self._put(q_out, _Failure(e))
+                return
+            if not self._put(q_out, item):
+                return
+
+    def _run_threaded(self, jobs):
+        self._abort.clear()
+        queues = [queue.Queue(maxsize=self.depth) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self._feed, args=(jobs, queues[0]), daemon=True)]
+        for i, stage in enumerate(self.stages):
+            threads.append(threading.Thread(target=self._work, args=(stage, queues[i], queues[i + 1]),
+                                            name=f"stage-{stage.name}", daemon=True))
+        for t in threads:
+            t.start()
+        try:
+            while True:
+                item = self._get(queues[-1])
+                if item is _STOP:
+                    break
+                if isinstance(item, _Failure):
+                    raise item.exc
+                yield item
+        finally:
+            self._abort.set()
+            for t in threads:
+                t.join()
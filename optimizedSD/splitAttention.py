@@ -149,6 +149,16 @@ class SpatialSelfAttention(nn.Module):
         return x+h_
 
 
+def plan_att_step(limit, n_q, n_k, element_size, budget):
+    """Largest divisor of limit whose attention scores (att_step x n_q x n_k) fit into budget bytes."""
+    per_slice = n_q * n_k * element_size
+    best = 1
+    for step in range(1, limit + 1):
+        if limit % step == 0 and step * per_slice <= budget:
+            best = step
+    return best
+
+
 class CrossAttention(nn.Module):
     def __init__(self, query_dim, context_dim=None, heads=8, dim_head=64, dropout=0., att_step=1):
         super().__init__()
@@ -158,6 +168,9 @@ class CrossAttention(nn.Module):
         self.scale = dim_head ** -0.5
         self.heads = heads
         self.att_step = att_step
+        # with a budget (bytes), att_step is planned per input shape instead, see bucketing.py
+        self.att_budget = None
+        self.att_plans = {}
 
         self.to_q = nn.Linear(query_dim, inner_dim, bias=False)
         self.to_k = nn.Linear(context_dim, inner_dim, bias=False)
@@ -182,6 +195,12 @@ class CrossAttention(nn.Module):
 
         limit = k.shape[0]
         att_step = self.att_step
+        if self.att_budget is not None:
+            key = (limit, q.shape[1], k.shape[1], q.element_size(), self.att_budget)
+            att_step = self.att_plans.get(key)
+            if att_step is None:
+                att_step = self.att_plans[key] = plan_att_step(limit, q.shape[1], k.shape[1], q.element_size(),
+                                                               self.att_budget)
         q_chunks = list(torch.tensor_split(q, limit//att_step, dim=0))
         k_chunks = list(torch.tensor_split(k, limit//att_step, dim=0))
         v_chunks = list(torch.tensor_split(v, limit//att_step, dim=0))
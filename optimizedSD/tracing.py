@@ -0,0 +1,228 @@
+"""
+Lightweight tracing for the optimized scripts.
+
+Code is instrumented with spans:
+
+    from tracing import tracer
+
+    with tracer.span("vae.decode", device):
+        ...
+
+    for i in tracer.steps(trange(n), device):   # one "sampler.step" span per iteration
+        ...
+
+The tracer is disabled by default and a span is then a no-op. When enabled, every span
+records its wall time, the time spent waiting for the device in torch.cuda.synchronize()
+at its end (i.e. queued GPU work that was not finished yet) and the peak memory allocated
+on the device while it was open. Spans are aggregated per name for the Prometheus-style
+metrics endpoint and, if requested, also kept as individual events for a Chrome trace
+(open it in chrome://tracing or https://ui.perfetto.dev).
+
+Peak memory is tracked with the per-device counters of torch, so it is only approximate
+when several threads use the same device at the same time.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import torch
+
+
+_NULL = nullcontext()
+
+
+def _cuda_device(device):
+    if device is None or not torch.cuda.is_available():
+        return None
+    device = torch.device(device)
+    return device if device.type == "cuda" else None
+
+
+class _SpanStats(object):
+    __slots__ = ("count", "wall", "sync", "peak")
+
+    def __init__(self):
+        self.count = 0
+        self.wall = 0.
+        self.sync = 0.
+        self.peak = 0
+
+
+class Tracer(object):
+    def __init__(self):
+        self.enabled = False
+        self.keep_events = False
+        self.max_events = 1000000
+        self.events = []
+        self.stats = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._t0 = time.perf_counter()
+
+    def enable(self, keep_events=True, max_events=1000000):
+        """Start recording. keep_events=False only keeps the per-name aggregates (for servers)."""
+        self.enabled = True
+        self.keep_events = keep_events
+        self.max_events = max_events
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self.events = []
+            self.stats = {}
+            self._t0 = time.perf_counter()
+
+    def span(self, name, device=None, **args):
+        if not self.enabled:
+            return _NULL
+        return self._span(name, device, args)
+
+    def steps(self, iterable, device=None, name="sampler.step"):
+        """Wraps a loop so that every iteration is recorded as one span."""
+        if not self.enabled:
+            yield from iterable
+            return
+        for i, item in enumerate(iterable):
+            with self._span(name, device, {"step": i}):
+                yield item
+
+    @contextmanager
+    def _span(self, name, device, args):
+        cuda = _cuda_device(device)
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        frame = {"child_peak": 0}
+        if cuda is not None:
+            if stack:
+                stack[-1]["child_peak"] = max(stack[-1]["child_peak"], torch.cuda.max_memory_allocated(cuda))
+            torch.cuda.reset_peak_memory_stats(cuda)
+        stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            sync = 0.
+            peak = 0
+            if cuda is not None:
+                tic = time.perf_counter()
+                torch.cuda.synchronize(cuda)
+                sync = time.perf_counter() - tic
+            end = time.perf_counter()
+            stack.pop()
+            if cuda is not None:
+                peak = max(torch.cuda.max_memory_allocated(cuda), frame["child_peak"])
+                if stack:
+                    stack[-1]["child_peak"] = max(stack[-1]["child_peak"], peak)
+                torch.cuda.reset_peak_memory_stats(cuda)
+            self._record(name, start, end, sync, peak, str(device) if device is not None else None, args)
+
+    def _record(self, name, start, end, sync, peak, device, args):
+        with self._lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = _SpanStats()
+            stats.count += 1
+            stats.wall += end - start
+            stats.sync += sync
+            stats.peak = max(stats.peak, peak)
+            if self.keep_events and len(self.events) < self.max_events:
+                event_args = dict(args, sync_ms=1e3 * sync)
+                if device is not None:
+                    event_args["device"] = device
+                if peak:
+                    event_args["peak_mem_mb"] = peak / 1e6
+                self.events.append({
+                    "name": name,
+                    "ph": "X",
+                    "ts": 1e6 * (start - self._t0),
+                    "dur": 1e6 * (end - start),
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "args": event_args,
+                })
+
+    def export_chrome_trace(self, path):
+        with self._lock:
+            events = list(self.events)
+        tids = {e["tid"] for e in events}
+        threads = {t.ident: t.name for t in threading.enumerate()}
+        meta = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid,
+                 "args": {"name": threads.get(tid, str(tid))}} for tid in tids]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": meta + events, "displayTimeUnit": "ms"}, f)
+        print(f"Trace with {len(events)} spans written to {path}")
+
+    def summary(self):
+        with self._lock:
+            items = sorted(self.stats.items(), key=lambda kv: -kv[1].wall)
+        lines = [f"{'span':<20} {'count':>7} {'total s':>9} {'mean ms':>9} {'sync s':>8} {'peak MB':>9}"]
+        for name, s in items:
+            lines.append(f"{name:<20} {s.count:>7} {s.wall:>9.2f} {1e3 * s.wall / s.count:>9.2f} "
+                         f"{s.sync:>8.2f} {s.peak / 1e6:>9.0f}")
+        return "\n".join(lines)
+
+    def prometheus_text(self, prefix="sd"):
+        with self._lock:
+            items = sorted(self.stats.items())
+        metrics = [
+            ("span_count", "counter", "Number of finished spans.", lambda s: s.count),
+            ("span_seconds_total", "counter", "Wall time spent in spans.", lambda s: s.wall),
+            ("span_sync_seconds_total", "counter", "Time spent waiting for the device at the end of spans.",
+             lambda s: s.sync),
+            ("span_peak_memory_bytes", "gauge", "Highest device memory allocated during a span.", lambda s: s.peak),
+        ]
+        lines = []
+        for metric, kind, doc, value in metrics:
+            lines.append(f"# HELP {prefix}_{metric} {doc}")
+            lines.append(f"# TYPE {prefix}_{metric} {kind}")
+            for name, s in items:
+                lines.append(f'{prefix}_{metric}{{span="{name}"}} {value(s)}')
+        if torch.cuda.is_available():
+            lines.append(f"# HELP {prefix}_cuda_memory_allocated_bytes Device memory currently allocated.")
+            lines.append(f"# TYPE {prefix}_cuda_memory_allocated_bytes gauge")
+            for i in range(torch.cuda.device_count()):
+                lines.append(f'{prefix}_cuda_memory_allocated_bytes{{device="cuda:{i}"}} '
+                             f'{torch.cuda.memory_allocated(i)}')
+        return "\n".join(lines) + "\n"
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_metrics_server(port, addr="0.0.0.0", tracer_=None):
+    """Serves the metrics of `tracer_` (default: the global tracer) at http://addr:port/metrics."""
+    tracer_ = tracer_ or tracer
+    if not tracer_.enabled:
+        tracer_.enable(keep_events=False)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = tracer_.prometheus_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = _ThreadingHTTPServer((addr, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    print(f"Serving metrics at http://{addr}:{port}/metrics")
+    return server
+
+
+tracer = Tracer()
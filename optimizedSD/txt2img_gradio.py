@@ -1,3 +1,4 @@
+import argparse
 import gradio as gr
 import numpy as np
 import torch
@@ -20,7 +21,10 @@ from pytorch_lightning import seed_everything
 from torch import autocast
 from contextlib import nullcontext
 from ldm.util import instantiate_from_config
-from optimUtils import split_weighted_subprompts, logger
+from optimUtils import logger
+from pipeline import get_conditioning, offload
+from ldm.models.diffusion.sampling import GuidanceSchedule, make_guidance_schedule, parse_sigma_interval
+from tracing import tracer, start_metrics_server
 from transformers import logging
 logging.set_verbosity_error()
 import mimetypes
@@ -41,6 +45,17 @@ def load_model_from_config(ckpt, verbose=False):
     sd = pl_sd["state_dict"]
     return sd
 
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--metrics_port",
+    type=int,
+    default=None,
+    help="serve per-stage timing and memory metrics in Prometheus format at http://0.0.0.0:<port>/metrics",
+)
+opt = parser.parse_args()
+if opt.metrics_port:
+    start_metrics_server(opt.metrics_port)
+
 config = "optimizedSD/v1-inference.yaml"
 ckpt = "models/ldm/stable-diffusion-v1/model.ckpt"
 sd = load_model_from_config(f"{ckpt}")
@@ -94,6 +109,11 @@ def generate(
     turbo,
     full_precision,
     sampler,
+    negative_prompt,
+    cfg_skip_last,
+    cfg_interval,
+    cfg_curve,
+    cfg_end_scale,
 ):
 
     C = 4
@@ -110,6 +130,8 @@ def generate(
     seed_everything(seed)
     # Logging
     logger(locals(), "logs/txt2img_gradio_logs.csv")
+    cfg_schedule = make_guidance_schedule(parse_sigma_interval(cfg_interval) if cfg_interval.strip() else None,
+                                          cfg_curve, cfg_end_scale)
 
     if device != "cpu" and full_precision == False:
         model.half()
@@ -141,32 +163,13 @@ def generate(
             for prompts in tqdm(data, desc="data"):
                 with precision_scope("cuda"):
                     modelCS.to(device)
-                    uc = None
-                    if scale != 1.0:
-                        uc = modelCS.get_learned_conditioning(batch_size * [""])
                     if isinstance(prompts, tuple):
                         prompts = list(prompts)
-
-                    subprompts, weights = split_weighted_subprompts(prompts[0])
-                    if len(subprompts) > 1:
-                        c = torch.zeros_like(uc)
-                        totalWeight = sum(weights)
-                        # normalize each "sub prompt" and add it
-                        for i in range(len(subprompts)):
-                            weight = weights[i]
-                            # if not skip_normalize:
-                            weight = weight / totalWeight
-                            c = torch.add(c, modelCS.get_learned_conditioning(subprompts[i]), alpha=weight)
-                    else:
-                        c = modelCS.get_learned_conditioning(prompts)
+                    c, uc = get_conditioning(modelCS, prompts, scale, negative_prompt)
 
                     shape = [batch_size, C, Height // f, Width // f]
 
-                    if device != "cpu":
-                        mem = torch.cuda.memory_allocated() / 1e6
-                        modelCS.to("cpu")
-                        while torch.cuda.memory_allocated() / 1e6 >= mem:
-                            time.sleep(1)
+                    offload(modelCS, device)
 
                     samples_ddim = model.sample(
                         S=ddim_steps,
@@ -179,6 +182,8 @@ def generate(
                         eta=ddim_eta,
                         x_T=start_code,
                         sampler = sampler,
+                        cfg_skip_last=int(cfg_skip_last),
+                        cfg_schedule=cfg_schedule,
                     )
 
                     modelFS.to(device)
@@ -189,18 +194,15 @@ def generate(
                         x_sample = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
                         all_samples.append(x_sample.to("cpu"))
                         x_sample = 255.0 * rearrange(x_sample[0].cpu().numpy(), "c h w -> h w c")
-                        Image.fromarray(x_sample.astype(np.uint8)).save(
-                            os.path.join(sample_path, "seed_" + str(seed) + "_" + f"{base_count:05}.{img_format}")
-                        )
+                        with tracer.span("write"):
+                            Image.fromarray(x_sample.astype(np.uint8)).save(
+                                os.path.join(sample_path, "seed_" + str(seed) + "_" + f"{base_count:05}.{img_format}")
+                            )
                         seeds += str(seed) + ","
                         seed += 1
                         base_count += 1
 
-                    if device != "cpu":
-                        mem = torch.cuda.memory_allocated() / 1e6
-                        modelFS.to("cpu")
-                        while torch.cuda.memory_allocated() / 1e6 >= mem:
-                            time.sleep(1)
+                    offload(modelFS, device)
 
                     del samples_ddim
                     del x_sample
@@ -225,8 +227,13 @@ def generate(
     return Image.fromarray(grid.astype(np.uint8)), txt
 
 
+def traced_generate(*args):
+    with tracer.span("request"):
+        return generate(*args)
+
+
 demo = gr.Interface(
-    fn=generate,
+    fn=traced_generate,
     inputs=[
         "text",
         gr.Slider(1, 1000, value=50),
@@ -244,6 +251,11 @@ demo = gr.Interface(
         "checkbox",
         "checkbox",
         gr.Radio(["ddim", "plms","heun", "euler", "euler_a", "dpm2", "dpm2_a", "lms"], value="plms"),
+        gr.Text(value="", label="negative prompt"),
+        gr.Slider(0, 50, value=0, step=1, label="cfg_skip_last (steps at the end without guidance)"),
+        gr.Text(value="", label="cfg_interval (sigmas to guide, e.g. 0.3,5)"),
+        gr.Radio(list(GuidanceSchedule.CURVES), value="constant", label="cfg_curve"),
+        gr.Slider(0, 50, value=7.5, step=0.1, label="cfg_end_scale (scale at the last step with a curve)"),
     ],
     outputs=["image", "text"],
 )
@@ -0,0 +1,31 @@
+"""
+Converts a retrieval database of .npz files (data/rdm/retrieval_databases/<name>/*.npz) into
+memory-mapped .npy shards plus a manifest, see ldm/modules/retrieval/database.py. The row
+order is kept, so searchers trained on the npz files stay valid. With --normalize the
+embeddings are stored with unit norm, an already converted database is normalized in place.
+
+    python scripts/convert_retrieval_database.py data/rdm/retrieval_databases/openimages --normalize
+"""
+import argparse
+import os
+import sys
+
+sys.path.append(os.getcwd())
+from ldm.modules.retrieval.database import MANIFEST, convert_npz, normalize_database, open_database
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("database", type=str, help="directory containing the npz files")
+    parser.add_argument("--target", "-t", type=str, default=None,
+                        help="directory to write the shards to (default: next to the npz files)")
+    parser.add_argument("--normalize", action="store_true",
+                        help="store the embeddings with unit norm, so lookups do not renormalize them")
+    opt = parser.parse_args()
+
+    if opt.normalize and opt.target is None and os.path.exists(os.path.join(opt.database, MANIFEST)):
+        normalize_database(opt.database)
+        target = opt.database
+    else:
+        target = convert_npz(opt.database, opt.target, opt.normalize)
+    db = open_database(target)
+    print(f"keys: {', '.join(f'{k} {db[k].shape} {db[k].dtype}' for k in db.keys)}")
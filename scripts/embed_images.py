@@ -0,0 +1,145 @@
+"""
+Builds a retrieval database (see ldm/modules/retrieval/database.py) from image folders and
+tar shards in a single streaming job.
+
+The images are read and resized by worker processes (tar members with one seek each),
+embedded with the CLIP image encoder in large fp16/bf16 batches of equally shaped images and
+written as fixed size memory-mapped shards of --shard_rows rows with unit norm embeddings.
+Keys: embedding (n, d) float32, img_id (n,) the path relative to the input folder, tar
+members as <tar>/<member> (utf-8, at most 256 bytes), patch_coords (n, 4) [0, 0, 1, 1] (the
+whole image).
+
+The manifest is rewritten after every shard together with the number of input images the
+shards cover, so an interrupted job continues after its last completed shard with --resume.
+
+    python scripts/embed_images.py /data/laion_shards -d data/rdm/retrieval_databases/laion --resume
+    python scripts/train_searcher.py -d data/rdm/retrieval_databases/laion -t data/rdm/searchers/laion
+"""
+import argparse
+import os
+import sys
+import time
+from contextlib import nullcontext
+
+import numpy as np
+import torch
+
+sys.path.append(os.getcwd())
+from ldm.modules.encoders.modules import FrozenClipImageEmbedder
+from ldm.modules.retrieval.database import DatabaseWriter
+from ldm.modules.retrieval.images import ImageLoader, item_id, list_images
+
+IMG_ID_BYTES = 256
+IMG_ID_DTYPE = f"S{IMG_ID_BYTES}"
+
+
+class ShardBuffer(object):
+    """Collects embedded rows and writes them as database shards of exactly shard_rows rows."""
+    def __init__(self, writer, shard_rows):
+        self.writer = writer
+        self.shard_rows = shard_rows
+        self.parts = []
+        self.rows = 0
+
+    def add(self, embeddings, img_ids, sources):
+        """sources: input index of every row, so a shard knows how many inputs it completes."""
+        self.parts.append((embeddings, img_ids, sources))
+        self.rows += len(img_ids)
+        while self.rows >= self.shard_rows:
+            self.flush(self.shard_rows)
+
+    def flush(self, rows=None):
+        if not self.parts:
+            return
+        embeddings, img_ids, sources = (np.concatenate(parts) for parts in zip(*self.parts))
+        rows = rows or len(img_ids)
+        self.writer.write_shard({"embedding": embeddings[:rows].astype(np.float32),
+                                 "img_id": img_ids[:rows],
+                                 "patch_coords": np.tile(np.array([0., 0., 1., 1.], dtype=np.float32), (rows, 1))},
+                                inputs_done=int(sources[rows - 1]) + 1)
+        rest = (embeddings[rows:], img_ids[rows:], sources[rows:])
+        self.parts = [rest] if len(rest[1]) else []
+        self.rows = len(rest[1])
+
+
+def inputs_done(writer):
+    """Number of input images covered by the shards of a database written by this script."""
+    shards = writer.manifest["shards"]
+    if not shards:
+        return 0
+    assert "info" in shards[-1], f"{writer.path} was not written by embed_images.py, can not resume it"
+    return shards[-1]["info"]["inputs_done"]
+
+
+def precision_scope(device, precision):
+    if precision == "fp32":
+        return nullcontext()
+    dtype = torch.float16 if precision == "fp16" else torch.bfloat16
+    if device.type == "cpu" and dtype == torch.float16:
+        print("fp16 is not supported on the cpu, using bf16")
+        dtype = torch.bfloat16
+    return torch.autocast(device.type, dtype=dtype)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("images", type=str,
+                        help="folder of images and/or uncompressed .tar shards (searched recursively), "
+                             "a .tar file or a text file of image paths")
+    parser.add_argument("--database", "-d", type=str, required=True, help="directory of the database to write")
+    parser.add_argument("--clip_type", type=str, default="ViT-L/14", help="CLIP model, the same the searcher is used with")
+    parser.add_argument("--precision", type=str, choices=["fp32", "fp16", "bf16"], default="fp16",
+                        help="precision of the CLIP forward passes, fp16 falls back to bf16 on the cpu")
+    parser.add_argument("--batch_size", type=int, default=256, help="images per CLIP forward pass")
+    parser.add_argument("--group", type=int, default=4096,
+                        help="decoded images collected before embedding, more gives fuller batches per shape")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="decoding processes")
+    parser.add_argument("--side", type=int, default=256, help="short side images are resized to before batching")
+    parser.add_argument("--shard_rows", type=int, default=1 << 16, help="rows per database shard")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue an interrupted job after the last shard it completed")
+    parser.add_argument("--append", action="store_true", help="add the images to an existing database")
+    opt = parser.parse_args()
+
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    embedder = FrozenClipImageEmbedder(model=opt.clip_type, device=device).to(device).eval()
+    if opt.precision == "fp32":
+        # clip.load keeps the weights in fp16 on the GPU
+        embedder.model.float()
+    items = list_images(opt.images)
+    root = opt.images if os.path.isdir(opt.images) else ""
+    # numpy silently truncates longer ids, which would no longer match their images
+    for item in items:
+        if len(item_id(item, root).encode()) > IMG_ID_BYTES:
+            raise ValueError(f"img_id {item_id(item, root)!r} is longer than {IMG_ID_BYTES} bytes")
+
+    writer = DatabaseWriter(opt.database, append=opt.append or opt.resume, normalize=True)
+    skip = inputs_done(writer) if opt.resume else 0
+    if skip:
+        print(f"Resuming after {skip} images in {len(writer.manifest['shards'])} shards")
+    print(f"Embedding {len(items) - skip} images with {opt.workers} decoding workers in {opt.precision}")
+
+    buffer = ShardBuffer(writer, opt.shard_rows)
+    tic = time.time()
+    done = 0
+    group = []
+
+    def embed(group):
+        with precision_scope(device, opt.precision):
+            embeddings = embedder.embed([image for _, _, image in group], opt.batch_size).numpy()
+        img_ids = np.array([item_id(item, root).encode() for _, item, _ in group], dtype=IMG_ID_DTYPE)
+        buffer.add(embeddings, img_ids, np.array([i for i, _, _ in group]))
+
+    for i, (item, image) in enumerate(ImageLoader(items[skip:], opt.workers, opt.side), skip):
+        done += 1
+        if image is not None:
+            group.append((i, item, image))
+        if len(group) >= opt.group:
+            embed(group)
+            group = []
+            print(f"{skip + done}/{len(items)} images, {done / (time.time() - tic):.1f} images/s")
+    if group:
+        embed(group)
+    buffer.flush()
+    print(f"Wrote {len(writer)} rows in {len(writer.manifest['shards'])} shards to {opt.database}, "
+          f"{done / max(time.time() - tic, 1e-6):.1f} images/s")
@@ -9,14 +9,21 @@ from tqdm import tqdm, trange
 from itertools import islice
 from einops import rearrange, repeat
 from torchvision.utils import make_grid
-import scann
 import time
-from multiprocessing import cpu_count
+try:
+    import scann
+except ImportError:
+    scann = None  # the built-in indices of ldm.modules.retrieval.index are used instead
 
-from ldm.util import instantiate_from_config, parallel_data_prefetch
+from ldm.util import instantiate_from_config
 from ldm.models.diffusion.ddim import DDIMSampler
 from ldm.models.diffusion.plms import PLMSSampler
 from ldm.modules.encoders.modules import FrozenClipImageEmbedder, FrozenCLIPTextEmbedder
+from ldm.modules.retrieval.database import open_database
+from ldm.modules.retrieval.index import ExactIndex, is_index, load_index
+from ldm.modules.retrieval.cache import CachedRetriever
+from ldm.modules.retrieval.images import ImageLoader, item_id, list_images
+from ldm.modules.retrieval.prefetch import RetrievalPrefetcher
 
 DATABASES = [
     "openimages",
@@ -66,9 +73,7 @@ class Searcher(object):
         self.searcher_savedir = f'data/rdm/searchers/{self.database_name}'
         self.database_path = f'data/rdm/retrieval_databases/{self.database_name}'
         self.retriever = self.load_retriever(version=retriever_version)
-        self.database = {'embedding': [],
-                         'img_id': [],
-                         'patch_coords': []}
+        self.database = None
         self.load_database()
         self.load_searcher()
 
@@ -77,48 +82,23 @@ class Searcher(object):
                        searcher_savedir=None):
 
         print('Start training searcher')
-        searcher = scann.scann_ops_pybind.builder(self.database['embedding'] /
-                                                  np.linalg.norm(self.database['embedding'], axis=1)[:, np.newaxis],
-                                                  k, metric)
-        self.searcher = searcher.score_brute_force().build()
+        if scann is None:
+            self.searcher = ExactIndex(self.database.normalized_embeddings())
+        else:
+            searcher = scann.scann_ops_pybind.builder(self.database.normalized_embeddings(), k, metric)
+            self.searcher = searcher.score_brute_force().build()
         print('Finish training searcher')
 
         if searcher_savedir is not None:
             print(f'Save trained searcher under "{searcher_savedir}"')
             os.makedirs(searcher_savedir, exist_ok=True)
-            self.searcher.serialize(searcher_savedir)
-
-    def load_single_file(self, saved_embeddings):
-        compressed = np.load(saved_embeddings)
-        self.database = {key: compressed[key] for key in compressed.files}
-        print('Finished loading of clip embeddings.')
-
-    def load_multi_files(self, data_archive):
-        out_data = {key: [] for key in self.database}
-        for d in tqdm(data_archive, desc=f'Loading datapool from {len(data_archive)} individual files.'):
-            for key in d.files:
-                out_data[key].append(d[key])
-
-        return out_data
+            if scann is None:
+                self.searcher.save(searcher_savedir)
+            else:
+                self.searcher.serialize(searcher_savedir)
 
     def load_database(self):
-
-        print(f'Load saved patch embedding from "{self.database_path}"')
-        file_content = glob.glob(os.path.join(self.database_path, '*.npz'))
-
-        if len(file_content) == 1:
-            self.load_single_file(file_content[0])
-        elif len(file_content) > 1:
-            data = [np.load(f) for f in file_content]
-            prefetched_data = parallel_data_prefetch(self.load_multi_files, data,
-                                                     n_proc=min(len(data), cpu_count()), target_data_type='dict')
-
-            self.database = {key: np.concatenate([od[key] for od in prefetched_data], axis=1)[0] for key in
-                             self.database}
-        else:
-            raise ValueError(f'No npz-files in specified path "{self.database_path}" is this directory existing?')
-
-        print(f'Finished loading of retrieval database of length {self.database["embedding"].shape[0]}.')
+        self.database = open_database(self.database_path)
 
     def load_retriever(self, version='ViT-L/14', ):
         model = FrozenClipImageEmbedder(model=version)
@@ -129,32 +109,46 @@ class Searcher(object):
 
     def load_searcher(self):
         print(f'load searcher for database {self.database_name} from {self.searcher_savedir}')
-        self.searcher = scann.scann_ops_pybind.load_searcher(self.searcher_savedir)
+        if is_index(self.searcher_savedir):
+            self.searcher = load_index(self.searcher_savedir, reorder=self.database['embedding'])
+        elif scann is not None and os.path.isdir(self.searcher_savedir):
+            self.searcher = scann.scann_ops_pybind.load_searcher(self.searcher_savedir)
+        else:
+            print(f'No searcher found, {"scann is not installed and " if scann is None else ""}'
+                  f'small databases are indexed on the fly.')
+            self.searcher = None
+            return
         print('Finished loading searcher.')
 
-    def search(self, x, k):
-        if self.searcher is None and self.database['embedding'].shape[0] < 2e4:
-            self.train_searcher(k)   # quickly fit searcher on the fly for small databases
-        assert self.searcher is not None, 'Cannot search with uninitialized searcher'
+    def _queries(self, x):
         if isinstance(x, torch.Tensor):
-            x = x.detach().cpu().numpy()
+            x = x.detach().cpu().float().numpy()
         if len(x.shape) == 3:
             x = x[:, 0]
-        query_embeddings = x / np.linalg.norm(x, axis=1)[:, np.newaxis]
+        return x, x / np.linalg.norm(x, axis=1)[:, np.newaxis]
 
+    def neighbor_ids(self, x, k):
+        """(b, k) database row ids of the neighbors of the queries x and the search time."""
+        if self.searcher is None and len(self.database) < 2e4:
+            self.train_searcher(k)   # quickly fit searcher on the fly for small databases
+        assert self.searcher is not None, 'Cannot search with uninitialized searcher'
+        _, query_embeddings = self._queries(x)
         start = time.time()
         nns, distances = self.searcher.search_batched(query_embeddings, final_num_neighbors=k)
-        end = time.time()
+        return nns, time.time() - start
+
+    def search(self, x, k):
+        x, query_embeddings = self._queries(x)
+        nns, exec_time = self.neighbor_ids(query_embeddings, k)
 
-        out_embeddings = self.database['embedding'][nns]
-        out_img_ids = self.database['img_id'][nns]
-        out_pc = self.database['patch_coords'][nns]
+        out_img_ids = self.database.gather('img_id', nns)
+        out_pc = self.database.gather('patch_coords', nns)
 
-        out = {'nn_embeddings': out_embeddings / np.linalg.norm(out_embeddings, axis=-1)[..., np.newaxis],
+        out = {'nn_embeddings': self.database.neighbor_embeddings(nns),
                'img_ids': out_img_ids,
                'patch_coords': out_pc,
                'queries': x,
-               'exec_time': end - start,
+               'exec_time': exec_time,
                'nns': nns,
                'q_embeddings': query_embeddings}
 
@@ -166,8 +160,7 @@ class Searcher(object):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    # TODO: add n_neighbors and modes (text-only, text-image-retrieval, image-image retrieval etc)
-    # TODO: add 'image variation' mode when knn=0 but a single image is given instead of a text prompt?
+    # TODO: add n_neighbors and a text-image-retrieval mode
     parser.add_argument(
         "--prompt",
         type=str,
@@ -176,6 +169,18 @@ if __name__ == "__main__":
         help="the prompt to render"
     )
 
+    parser.add_argument(
+        "--query_images",
+        type=str,
+        help="image, folder or text file of image paths to query with instead of prompts (image variations)",
+    )
+    parser.add_argument(
+        "--image_workers",
+        type=int,
+        default=4,
+        help="processes decoding the --query_images (0: in process)",
+    )
+
     parser.add_argument(
         "--outdir",
         type=str,
@@ -303,6 +308,24 @@ if __name__ == "__main__":
         type=int,
         help="The number of included neighbors, only applied when --use_neighbors=True",
     )
+    parser.add_argument(
+        "--prefetch",
+        default=2,
+        type=int,
+        help="number of batches whose neighbors are retrieved ahead of sampling in a background thread (0: off)",
+    )
+    parser.add_argument(
+        "--search_group",
+        default=1,
+        type=int,
+        help="number of upcoming batches searched with one searcher call when prefetching",
+    )
+    parser.add_argument(
+        "--retrieval_cache",
+        default=1024,
+        type=int,
+        help="number of prompts whose CLIP embedding and neighbors are cached, repeats skip encoder and search",
+    )
 
     opt = parser.parse_args()
 
@@ -324,7 +347,11 @@ if __name__ == "__main__":
 
     batch_size = opt.n_samples
     n_rows = opt.n_rows if opt.n_rows > 0 else batch_size
-    if not opt.from_file:
+    if opt.query_images:
+        # one batch of variations per image, the image embedding replaces the prompt embedding
+        data = [batch_size * [path] for path in list_images(opt.query_images)]
+        print(f"querying with {len(data)} images")
+    elif not opt.from_file:
         prompt = opt.prompt
         assert prompt is not None
         data = [batch_size * [prompt]]
@@ -342,9 +369,42 @@ if __name__ == "__main__":
 
     print(f"sampling scale for cfg is {opt.scale:.2f}")
 
-    searcher = None
+    encode = clip_text_encoder.encode
+    searcher = Searcher(opt.database, opt.clip_type) if opt.use_neighbors else None
+    if opt.query_images:
+        image_encoder = searcher.retriever if searcher is not None else \
+            FrozenClipImageEmbedder(model=opt.clip_type).to(device).eval()
+
+        # every query image is decoded once by the loader workers and embedded in resolution
+        # bucketed batches up front, a batch then only looks its embedding up
+        items, embeddings, group = [], [], []
+
+        def embed_group(group):
+            embeddings.append(image_encoder.embed([image for _, image in group]))
+            items.extend(item for item, _ in group)
+
+        for item, image in ImageLoader([prompts[0] for prompts in data], opt.image_workers):
+            assert image is not None, f"could not read query image {item_id(item)}"
+            group.append((item, image))
+            if len(group) == 256:
+                embed_group(group)
+                group = []
+        if group:
+            embed_group(group)
+        embeddings = torch.cat(embeddings)
+        rows = {item: i for i, item in enumerate(items)}
+
+        def encode(paths):
+            return embeddings[[rows[path] for path in paths]][:, None].to(device)
+
+    retriever = None
+    prefetched = None
     if opt.use_neighbors:
-        searcher = Searcher(opt.database)
+        retriever = CachedRetriever(encode, searcher, opt.knn, max_entries=opt.retrieval_cache)
+        if opt.prefetch > 0:
+            # neighbors of upcoming batches are looked up while the current one is sampled
+            prefetcher = RetrievalPrefetcher(retriever, device, depth=opt.prefetch, group=opt.search_group)
+            prefetched = prefetcher.run(prompts for _ in range(opt.n_iter) for prompts in data)
 
     with torch.no_grad():
         with model.ema_scope():
@@ -354,11 +414,15 @@ if __name__ == "__main__":
                     print("sampling prompts:", prompts)
                     if isinstance(prompts, tuple):
                         prompts = list(prompts)
-                    c = clip_text_encoder.encode(prompts)
                     uc = None
-                    if searcher is not None:
-                        nn_dict = searcher(c, opt.knn)
-                        c = torch.cat([c, torch.from_numpy(nn_dict['nn_embeddings']).cuda()], dim=1)
+                    if prefetched is not None:
+                        prompts, c, nn_embeddings = next(prefetched)
+                        c = torch.cat([c, nn_embeddings], dim=1)
+                    elif retriever is not None:
+                        c, nn_embeddings = retriever(prompts)
+                        c = torch.cat([c.to(device), torch.from_numpy(nn_embeddings).to(device)], dim=1)
+                    else:
+                        c = encode(prompts)
                     if opt.scale != 1.0:
                         uc = torch.zeros_like(c)
                     if isinstance(prompts, tuple):
@@ -395,4 +459,8 @@ if __name__ == "__main__":
                     Image.fromarray(grid.astype(np.uint8)).save(os.path.join(outpath, f'grid-{grid_count:04}.png'))
                     grid_count += 1
 
+    if prefetched is not None:
+        prefetched.close()
+    if retriever is not None:
+        print(f"Searching took {retriever.search_time:.2f} s, retrieval cache: {retriever.cache.stats()}")
     print(f"Your samples are ready and waiting for you here: \n{outpath} \nEnjoy.")
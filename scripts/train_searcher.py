@@ -1,12 +1,14 @@
 import os, sys
 import numpy as np
-import scann
 import argparse
-import glob
-from multiprocessing import cpu_count
-from tqdm import tqdm
+try:
+    import scann
+except ImportError:
+    scann = None
 
-from ldm.util import parallel_data_prefetch
+from ldm.modules.retrieval.database import open_database
+from ldm.modules.retrieval.builder import StreamingIndexBuilder, build_exact_streaming
+from ldm.modules.retrieval.index import IVFPQIndex, build_index, choose_algorithm, load_recommended
 
 
 def search_bruteforce(searcher):
@@ -25,38 +27,22 @@ def search_ah(searcher, dims_per_block, aiq_threshold, reorder_k):
     return searcher.score_ah(dims_per_block, anisotropic_quantization_threshold=aiq_threshold).reorder(
         reorder_k).build()
 
-def load_datapool(dpath):
-
-
-    def load_single_file(saved_embeddings):
-        compressed = np.load(saved_embeddings)
-        database = {key: compressed[key] for key in compressed.files}
-        return database
-
-    def load_multi_files(data_archive):
-        database = {key: [] for key in data_archive[0].files}
-        for d in tqdm(data_archive, desc=f'Loading datapool from {len(data_archive)} individual files.'):
-            for key in d.files:
-                database[key].append(d[key])
-
-        return database
-
-    print(f'Load saved patch embedding from "{dpath}"')
-    file_content = glob.glob(os.path.join(dpath, '*.npz'))
-
-    if len(file_content) == 1:
-        data_pool = load_single_file(file_content[0])
-    elif len(file_content) > 1:
-        data = [np.load(f) for f in file_content]
-        prefetched_data = parallel_data_prefetch(load_multi_files, data,
-                                                 n_proc=min(len(data), cpu_count()), target_data_type='dict')
-
-        data_pool = {key: np.concatenate([od[key] for od in prefetched_data], axis=1)[0] for key in prefetched_data[0].keys()}
+def train_streaming(opt, data_pool, reorder_k, dims_per_block, num_leaves=None, num_leaves_to_search=None,
+                    training_sample_size=None):
+    """Builds the index on disk block by block, memory does not grow with the pool size."""
+    embeddings = data_pool['embedding']
+    algorithm = choose_algorithm(len(embeddings)) if opt.algorithm == 'auto' else opt.algorithm
+    if algorithm == 'exact':
+        print('Using exact search.')
+        build_exact_streaming(opt.target_path, embeddings)
     else:
-        raise ValueError(f'No npz-files in specified path "{dpath}" is this directory existing?')
-
-    print(f'Finished loading of retrieval database of length {data_pool["embedding"].shape[0]}.')
-    return data_pool
+        print('Using partitioning, product quantization and reordering.')
+        index = IVFPQIndex.train(embeddings, num_leaves, dims_per_block, training_sample_size,
+                                 num_leaves_to_search, reorder_k)
+        builder = StreamingIndexBuilder(opt.target_path, index, segment_rows=opt.segment_rows)
+        builder.ingest(embeddings)
+        builder.finish()
+    print(f'Saved built-in index under "{opt.target_path}"')
 
 
 def train_searcher(opt,
@@ -69,16 +55,57 @@ def train_searcher(opt,
                    num_leaves=None,
                    num_leaves_to_search=None,):
 
-    data_pool = load_datapool(opt.database)
+    data_pool = open_database(opt.database)
     k = opt.knn
 
     if not reorder_k:
         reorder_k = 2 * k
 
+    # this reflects the recommended design choices proposed at
+    # https://github.com/google-research/google-research/blob/aca5f2e44e301af172590bb8e65711f0c9ee0cfd/scann/docs/algorithms.md
+    pool_size = len(data_pool)
+    if pool_size < 2e4:
+        scann_method = 'brute_force'
+    elif pool_size < 1e5:
+        scann_method = 'ah'
+    else:
+        scann_method = 'partitioned_ah'
+
+    recommended = None if opt.ignore_recommended else load_recommended(opt.target_path)
+    if recommended is not None:
+        # measured on this database by benchmarks/searchers.py, replaces the pool size rules
+        params = recommended['params']
+        print(f'Using the recommended {recommended["backend"]} {recommended["algorithm"]} searcher: {params}')
+        if opt.backend == 'auto' and (recommended['backend'] == 'builtin' or scann is not None):
+            opt.backend = recommended['backend']
+        if recommended['backend'] == 'builtin' and opt.algorithm == 'auto':
+            opt.algorithm = recommended['algorithm']
+        if recommended['backend'] == 'scann':
+            scann_method = recommended['algorithm']
+        dims_per_block = params.get('dims_per_block', dims_per_block)
+        aiq_thld = params.get('aiq_threshold', aiq_thld)
+        reorder_k = params.get('reorder_k', reorder_k)
+        if 'leaves_per_sqrt_n' in params:
+            num_leaves = max(int(params['leaves_per_sqrt_n'] * np.sqrt(pool_size)), 1)
+            if 'leaves_to_search_fraction' in params:
+                num_leaves_to_search = max(int(round(params['leaves_to_search_fraction'] * num_leaves)), 1)
+
+    if opt.backend == 'builtin' or (opt.backend == 'auto' and scann is None):
+        print(f'Building the built-in index for {len(data_pool)} samples, k: {k}, reorder_k: {reorder_k}')
+        if opt.streaming:
+            train_streaming(opt, data_pool, reorder_k, dims_per_block, num_leaves, num_leaves_to_search,
+                            partioning_trainsize)
+            return
+        searcher = build_index(data_pool['embedding'], k, reorder_k, num_leaves, num_leaves_to_search,
+                               partioning_trainsize, dims_per_block, opt.algorithm)
+        os.makedirs(opt.target_path, exist_ok=True)
+        searcher.save(opt.target_path)
+        print(f'Saved built-in index under "{opt.target_path}"')
+        return
+    assert scann is not None, 'scann is not installed, use --backend builtin'
+
     # normalize
-    # embeddings =
-    searcher = scann.scann_ops_pybind.builder(data_pool['embedding'] / np.linalg.norm(data_pool['embedding'], axis=1)[:, np.newaxis], k, metric)
-    pool_size = data_pool['embedding'].shape[0]
+    searcher = scann.scann_ops_pybind.builder(data_pool.normalized_embeddings(), k, metric)
 
     print(*(['#'] * 100))
     print('Initializing scaNN searcher with the following values:')
@@ -91,19 +118,17 @@ def train_searcher(opt,
     print('Start training searcher....')
     print(f'N samples in pool is {pool_size}')
 
-    # this reflects the recommended design choices proposed at
-    # https://github.com/google-research/google-research/blob/aca5f2e44e301af172590bb8e65711f0c9ee0cfd/scann/docs/algorithms.md
-    if pool_size < 2e4:
+    if scann_method == 'brute_force':
         print('Using brute force search.')
         searcher = search_bruteforce(searcher)
-    elif 2e4 <= pool_size and pool_size < 1e5:
+    elif scann_method == 'ah':
         print('Using asymmetric hashing search and reordering.')
         searcher = search_ah(searcher, dims_per_block, aiq_thld, reorder_k)
     else:
         print('Using using partioning, asymmetric hashing search and reordering.')
 
         if not partioning_trainsize:
-            partioning_trainsize = data_pool['embedding'].shape[0] // 10
+            partioning_trainsize = pool_size // 10
         if not num_leaves:
             num_leaves = int(np.sqrt(pool_size))
 
@@ -130,7 +155,7 @@ if __name__ == '__main__':
                         '-d',
                         default='data/rdm/retrieval_databases/openimages',
                         type=str,
-                        help='path to folder containing the clip feature of the database')
+                        help='path to folder containing the clip feature of the database (converted or npz files)')
     parser.add_argument('--target_path',
                         '-t',
                         default='data/rdm/searchers/openimages',
@@ -142,6 +167,26 @@ if __name__ == '__main__':
                         type=int,
                         help='number of nearest neighbors, for which the searcher shall be optimized')
 
+    parser.add_argument('--backend',
+                        default='auto',
+                        choices=['auto', 'scann', 'builtin'],
+                        help='scann, or the numpy indices of ldm/modules/retrieval/index.py (auto: scann if installed)')
+
+    parser.add_argument('--algorithm',
+                        default='auto',
+                        choices=['auto', 'exact', 'ivfpq'],
+                        help='index type of the builtin backend (auto: exact below 1e5 samples)')
+    parser.add_argument('--streaming',
+                        action='store_true',
+                        help='build the builtin index on disk block by block, for pools that do not fit into memory')
+    parser.add_argument('--segment_rows',
+                        default=1 << 22,
+                        type=int,
+                        help='rows encoded in memory per index segment with --streaming')
+    parser.add_argument('--ignore_recommended',
+                        action='store_true',
+                        help='ignore the recommended.json of benchmarks/searchers.py in the target folder')
+
     opt, _  = parser.parse_known_args()
 
     train_searcher(opt,)
\ No newline at end of file
@@ -0,0 +1,64 @@
+"""
+Updates a built-in searcher (see train_searcher.py --backend builtin) in place, without a
+rebuild: adds the rows appended to its database, tombstones removed images and compacts it.
+
+    python scripts/update_searcher.py --add
+    python scripts/update_searcher.py --remove removed_img_ids.txt --compact
+    python scripts/update_searcher.py --compact --rebalance 4
+    python scripts/update_searcher.py --watch 600 --rebalance 4
+
+See ldm/modules/retrieval/maintenance.py.
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.getcwd())
+from ldm.modules.retrieval.database import open_database
+from ldm.modules.retrieval.index import is_index
+from ldm.modules.retrieval.maintenance import BackgroundCompactor, append_rows, compact, remove_img_ids
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--database", "-d", type=str, default="data/rdm/retrieval_databases/openimages",
+                        help="path to the retrieval database the searcher was built from")
+    parser.add_argument("--target_path", "-t", type=str, default="data/rdm/searchers/openimages",
+                        help="path to the built-in searcher")
+    parser.add_argument("--add", action="store_true",
+                        help="add the database rows appended since the searcher was built")
+    parser.add_argument("--remove", type=str, default=None,
+                        help="text file with one img_id per line, whose rows are removed from the searcher")
+    parser.add_argument("--compact", action="store_true",
+                        help="merge all segments and drop removed rows")
+    parser.add_argument("--rebalance", type=float, default=0.,
+                        help="with --compact or --watch, split partitions larger than this multiple of the mean size (0: off)")
+    parser.add_argument("--segment_rows", type=int, default=1 << 22,
+                        help="rows per new segment with --add")
+    parser.add_argument("--watch", type=float, default=0.,
+                        help="keep running and compact the searcher whenever it needs it, checking every this many seconds")
+    parser.add_argument("--min_segments", type=int, default=4,
+                        help="with --watch, compact once the searcher has this many segments")
+    parser.add_argument("--max_tombstone_ratio", type=float, default=0.1,
+                        help="with --watch, compact once this fraction of the rows is removed")
+    opt = parser.parse_args()
+
+    assert is_index(opt.target_path), f"{opt.target_path} is no built-in searcher, scann searchers have to be retrained"
+    db = open_database(opt.database)
+    if opt.add:
+        append_rows(opt.target_path, db, opt.segment_rows)
+    if opt.remove:
+        img_ids = np.loadtxt(opt.remove, dtype=db["img_id"].dtype, ndmin=1)
+        remove_img_ids(opt.target_path, db, img_ids)
+    if opt.compact:
+        compact(opt.target_path, db if opt.rebalance > 0 else None, opt.rebalance or 4.)
+    if opt.watch > 0:
+        compactor = BackgroundCompactor(opt.target_path, db if opt.rebalance > 0 else None, opt.watch,
+                                        opt.min_segments, opt.max_tombstone_ratio, opt.rebalance or 4.)
+        compactor.start()
+        print(f"Checking {opt.target_path} every {opt.watch:.0f} s, stop with ctrl+c")
+        try:
+            compactor.join()
+        except KeyboardInterrupt:
+            compactor.stop()